@@ -1,19 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-from app.config import DB_PATH, RAW_DIR
+from app.config import ASYNC_CPU_WORKERS, ASYNC_IO_WORKERS, DB_PATH, RAW_DIR, TRACE_ENABLED
 from app.ingest.ingest import (
     sync_folder,
     delete_paths,
     compact_rebuild_index,
 )
 from app.retrieval.build_index import build_index
-from app.retrieval.retrieve import retrieve_evidence
-from app.rag.ask import create_llm, answer_once
+from app.retrieval.retrieve import retrieve_evidence, retrieve_evidence_batch
+from app.rag.ask import answer_once
+from app.rag.models import ModelRegistry
 from app.chat_manager import ChatManager
-from app.ingest.db import connect
+from app import metrics, profiling
+from app.jobs import Job, JobManager
+from app.ingest.db import get_pool
+from app.tracing import Trace, record, span, tracing
+
+
+_ASK_SECONDS = metrics.histogram("extracthelper_ask_seconds", "End-to-end latency of RAGService.ask (queueing included)")
+_LLM_QUEUE_DEPTH = metrics.gauge("extracthelper_llm_queue_depth", "Ask requests waiting for or holding the LLM")
 
 
 class KnowledgeBaseManager:
@@ -24,6 +37,10 @@ class KnowledgeBaseManager:
     def __init__(self, db_path: Path = DB_PATH, raw_dir: Path = RAW_DIR) -> None:
         self.db_path = Path(db_path)
         self.raw_dir = Path(raw_dir)
+        # 后台任务（同步 / 重建 / 压缩）：单飞、可取消、上报进度
+        self.jobs = JobManager()
+        # 索引大小与墓碑比例在抓取指标时计算
+        metrics.REGISTRY.register_collector("kb", self.collect_metrics)
 
     def sync_folder(self, folder: Optional[Path] = None, force: bool = False) -> None:
         """
@@ -45,15 +62,12 @@ class KnowledgeBaseManager:
         :param paths: 文件路径列表
         :param force: 是否强制更新
         """
-        from app.ingest.ingest import _ingest_one, connect, ensure_schema
+        from app.ingest.ingest import _ingest_one, index_pending
 
-        conn = connect(self.db_path)
-        ensure_schema(conn)
-        try:
-            for p in paths:
-                _ingest_one(conn, Path(p), force=force)
-        finally:
-            conn.close()
+        pool = get_pool(self.db_path)
+        for p in paths:
+            _ingest_one(pool, Path(p), force=force)
+        index_pending(pool)
 
     def delete_files(self, paths: List[Path]) -> None:
         """
@@ -76,25 +90,75 @@ class KnowledgeBaseManager:
     def compact(self) -> None:
         """
         压缩整理。
-        当前等同于 rebuild_index，用于清理软删除留下的空洞。
+        只重建包含删除或新增 chunk 的分片，并清理 Delta Index。
         """
         compact_rebuild_index()
 
+    def start_job(self, task: str, force: bool = False, folder: Optional[Path] = None, profile: bool = False) -> Job:
+        """
+        在后台线程中执行知识库任务，立即返回 Job（job.future 可等待结果）。
+        同组任务已在运行时直接返回运行中的 Job，不会并发重建索引。
+        新一代索引发布（原子切换 CURRENT）之前，查询继续使用当前代，不会失败。
+
+        :param task: "sync" / "rebuild" / "compact"
+        :param force: 仅对 sync 有效，强制重新处理所有文件
+        :param folder: 仅对 sync 有效，目标文件夹，默认为 raw_dir
+        :param profile: 剖析任务执行过程，报告写入 PROFILES_DIR（见 app.profiling）
+        """
+        if task == "sync":
+            fn = lambda: self.sync_folder(folder, force=force)
+        elif task == "rebuild":
+            fn = self.rebuild_index
+        elif task == "compact":
+            fn = self.compact
+        else:
+            raise ValueError(f"Unknown background task: {task}")
+        if profile:
+            return self.jobs.submit(task, lambda: profiling.profile_call(task, fn))
+        return self.jobs.submit(task, fn)
+
     def get_stats(self) -> Dict[str, Any]:
         """
         获取知识库统计信息。
-        :return: 包含 documents 和 chunks 数量的字典
+        :return: 包含 documents、chunks 数量以及索引内存占用 (index) 的字典
         """
-        from app.ingest.db import connect
-        conn = connect(self.db_path)
+        from app.retrieval.shards import index_memory_stats
         try:
+            conn = get_pool(self.db_path).reader()
             doc_count = conn.execute("SELECT COUNT(*) FROM documents WHERE is_deleted=0").fetchone()[0]
             chunk_count = conn.execute("SELECT COUNT(*) FROM chunks WHERE is_deleted=0").fetchone()[0]
-            return {"documents": doc_count, "chunks": chunk_count}
+            return {"documents": doc_count, "chunks": chunk_count, "index": index_memory_stats()}
         except Exception:
-            return {"documents": 0, "chunks": 0}
-        finally:
-            conn.close()
+            return {"documents": 0, "chunks": 0, "index": {}}
+
+
+    def collect_metrics(self) -> Dict[str, float]:
+        """
+        抓取时计算的知识库指标：Base / Delta 向量数与文件大小、Delta 相对 Base 的比例，
+        以及墓碑比例（索引中已删除 chunk 的向量占比，compact 可回收）。
+        """
+        from app.retrieval.shards import index_memory_stats, load_delta_index
+
+        stats = index_memory_stats()
+        delta = load_delta_index()
+        base_vectors = int(stats["vectors"])
+        delta_vectors = int(delta.ntotal) if delta is not None else 0
+        conn = get_pool(self.db_path).reader()
+        active, canonical = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(canonical_id IS NULL), 0) FROM chunks WHERE is_deleted=0"
+        ).fetchone()
+        indexed = base_vectors + delta_vectors
+        return {
+            "extracthelper_index_base_vectors": base_vectors,
+            "extracthelper_index_delta_vectors": delta_vectors,
+            "extracthelper_index_base_bytes": stats["base_bytes"],
+            "extracthelper_index_delta_bytes": stats["delta_bytes"],
+            "extracthelper_index_delta_ratio": delta_vectors / base_vectors if base_vectors else 0.0,
+            "extracthelper_chunks_active": active,
+            # 去重后共享向量、不单独索引的 chunk
+            "extracthelper_chunks_duplicate": active - canonical,
+            "extracthelper_index_tombstone_ratio": max(0, indexed - canonical) / indexed if indexed else 0.0,
+        }
 
 
 class RAGService:
@@ -103,14 +167,19 @@ class RAGService:
     负责管理 LLM 实例、执行向量检索和生成回答。
     """
     def __init__(self) -> None:
-        self._llm = None
+        # 按需加载的 GGUF 模型（LRU + 内存预算 + 空闲卸载），每个模型有自己的生成锁
+        self.models = ModelRegistry()
 
     @property
     def llm(self):
-        """延迟加载 LLM 实例"""
-        if self._llm is None:
-            self._llm = create_llm()
-        return self._llm
+        """默认模型实例（延迟加载，用于预热）"""
+        entry = self.models.checkout(self.models.resolve(None))
+        self.models.checkin(entry)
+        return entry.llm
+
+    def list_models(self) -> List[Dict[str, Any]]:
+        """可选模型及其加载状态"""
+        return self.models.status()
 
     def search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
         """
@@ -121,11 +190,25 @@ class RAGService:
         """
         return retrieve_evidence(query, top_k=top_k)
 
+    def search_batch(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        批量检索（一次编码、每个索引一次检索）。
+        :param queries: 查询语句列表
+        :param top_k: 每个查询返回结果数量
+        :return: 与 queries 对应的证据列表
+        """
+        return retrieve_evidence_batch(queries, top_k=top_k)
+
     def ask(
         self,
         question: str,
         history: Optional[List[Dict[str, str]]] = None,
         top_k: int = 5,
+        cancel_event: Optional[threading.Event] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        trace: Optional[Trace] = None,
+        profile: bool = False,
+        model: Optional[str] = None,
     ) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, str]]]:
         """
         执行 RAG 问答（支持多轮对话）。
@@ -133,9 +216,58 @@ class RAGService:
         :param question: 用户问题
         :param history: 对话历史 [{"role": "user", "content": ...}, ...]
         :param top_k: 检索证据数量
+        :param cancel_event: 取消信号，置位后生成中止并抛出 GenerationCancelled
+        :param on_token: 流式回调 on_token(text)，在生成线程中调用
+        :param trace: 可选的耗时追踪对象，调用结束后 trace.to_dict() 即各阶段耗时（TRACE_ENABLED 关闭时不记录）
+        :param profile: 剖析本次问答，报告写入 PROFILES_DIR（见 app.profiling）
+        :param model: 使用的模型（文件名 / "default" / "auto"），None 为默认模型，见 ModelRegistry.resolve
         :return: (回答文本, 证据列表, 新的对话历史)
+        :raises ValueError: 找不到指定的模型
         """
-        answer, evidence = answer_once(self.llm, question, history=history or [], top_k=top_k)
+        if not profile:
+            return self._ask(question, history, top_k, cancel_event, on_token, trace, model)
+        trace = trace if trace is not None else Trace()
+        with profiling.Profiler("ask") as prof:
+            with prof.stage("ask"):
+                result = self._ask(question, history, top_k, cancel_event, on_token, trace, model)
+            prof.add_timings(question[:60], trace.to_dict())
+        return result
+
+    def _ask(
+        self,
+        question: str,
+        history: Optional[List[Dict[str, str]]],
+        top_k: int,
+        cancel_event: Optional[threading.Event],
+        on_token: Optional[Callable[[str], None]],
+        trace: Optional[Trace],
+        model: Optional[str] = None,
+    ) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, str]]]:
+        model_path = self.models.resolve(model, question)
+        t0 = time.perf_counter()
+        _LLM_QUEUE_DEPTH.inc()
+        try:
+            with tracing(trace if TRACE_ENABLED else None):
+                # llm_load: 模型未加载时的加载时间（可能先按 LRU 卸载其他空闲模型）
+                with span("llm_load"):
+                    entry = self.models.checkout(model_path)
+                try:
+                    record("model", entry.name)
+                    # queue: 等待同一模型上其他请求生成结束的时间
+                    with span("queue"):
+                        entry.lock.acquire()
+                    try:
+                        answer, evidence = answer_once(
+                            entry.llm, question, history=history or [], top_k=top_k,
+                            cancel_event=cancel_event, on_token=on_token,
+                        )
+                    finally:
+                        entry.lock.release()
+                finally:
+                    self.models.checkin(entry)
+        finally:
+            _LLM_QUEUE_DEPTH.dec()
+        _ASK_SECONDS.observe(time.perf_counter() - t0)
         new_history = list(history or [])
         new_history.append({"role": "user", "content": question})
         new_history.append({"role": "assistant", "content": answer})
@@ -152,5 +284,258 @@ class ExtractHelperApp:
         self.rag = RAGService()
         
         # 初始化 ChatManager
-        self.db_conn = connect(db_path)
-        self.chat_manager = ChatManager(self.db_conn)
+        self.db = get_pool(db_path)
+        self.chat_manager = ChatManager(self.db)
+
+
+# 预热阶段（按顺序执行）
+WARMUP_STAGES = ("embedder", "index", "llm")
+
+
+def _warm_stage(core: ExtractHelperApp, stage: str) -> None:
+    """执行单个预热阶段（在工作线程中）"""
+    if stage == "embedder":
+        from app.retrieval.embedder import get_embedder
+        get_embedder().encode(["warm up"], show_progress_bar=False)
+    elif stage == "index":
+        from app.retrieval.retrieve import load_base_and_delta
+        load_base_and_delta()
+    elif stage == "llm":
+        _ = core.rag.llm
+    else:
+        raise ValueError(f"Unknown warm-up stage: {stage}")
+
+
+class AsyncExtractHelperApp:
+    """
+    ExtractHelperApp 的异步门面（供 Web 服务使用）
+    所有同步调用都在显式的线程池中执行，事件循环上不做任何阻塞操作：
+    - io 线程池：SQLite 读写（会话 / 消息 / 统计）；
+    - cpu 线程池：检索与 LLM 生成。
+    await 被取消时（例如浏览器页面断开），会通知正在进行的生成尽快停止。
+    """
+    def __init__(
+        self,
+        core: ExtractHelperApp,
+        io_workers: int = ASYNC_IO_WORKERS,
+        cpu_workers: int = ASYNC_CPU_WORKERS,
+    ) -> None:
+        """
+        :param core: 同步应用实例
+        :param io_workers: IO 线程数
+        :param cpu_workers: 计算线程数
+        """
+        self.core = core
+        self._io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="eh-io")
+        self._cpu = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="eh-cpu")
+        # 预热状态：stage 为当前 / 最后完成的阶段，errors 记录失败阶段（不影响其他阶段）
+        self.warmup: Dict[str, Any] = {"stage": "db", "done": False, "errors": {}}
+
+    @classmethod
+    async def create(cls, db_path: Path = DB_PATH, raw_dir: Path = RAW_DIR) -> "AsyncExtractHelperApp":
+        """在线程中构造 ExtractHelperApp（包含较慢的模块导入与数据库初始化）"""
+        loop = asyncio.get_running_loop()
+        core = await loop.run_in_executor(None, functools.partial(ExtractHelperApp, db_path=db_path, raw_dir=raw_dir))
+        return cls(core)
+
+    async def warm_up(self, on_stage: Optional[Callable[[str], Any]] = None) -> None:
+        """
+        分阶段预热重量级依赖，UI 在此期间已可用：
+        embedder（导入 torch 并加载模型）-> index（加载 FAISS 分片与 Delta）-> llm（加载 GGUF）。
+        某一阶段失败（例如模型文件缺失）只记录错误，后续阶段照常进行。
+
+        :param on_stage: 每个阶段开始时回调 on_stage(stage)，全部结束时以 "ready" 回调
+        """
+        for stage in WARMUP_STAGES:
+            self.warmup["stage"] = stage
+            if on_stage is not None:
+                on_stage(stage)
+            try:
+                await self._run_cpu(_warm_stage, self.core, stage)
+            except Exception as e:
+                self.warmup["errors"][stage] = str(e)
+                print(f"[warmup] {stage} failed: {e}")
+        self.warmup["stage"] = "ready"
+        self.warmup["done"] = True
+        if on_stage is not None:
+            on_stage("ready")
+
+    async def _run_io(self, fn: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, functools.partial(fn, *args, **kwargs))
+
+    async def _run_cpu(self, fn: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._cpu, functools.partial(fn, *args, **kwargs))
+
+    # --- RAG ---
+
+    async def ask(
+        self,
+        question: str,
+        history: Optional[List[Dict[str, str]]] = None,
+        top_k: int = 5,
+        trace: Optional[Trace] = None,
+        profile: bool = False,
+        model: Optional[str] = None,
+    ) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, str]]]:
+        """
+        异步问答。调用方取消（task.cancel()）时设置取消信号，工作线程在下一个 token 处停止。
+        :param trace: 可选的耗时追踪对象，见 RAGService.ask
+        :param profile: 剖析本次问答，见 RAGService.ask
+        :param model: 使用的模型，见 RAGService.ask
+        """
+        cancel_event = threading.Event()
+        try:
+            return await self._run_cpu(
+                self.core.rag.ask, question, history=history, top_k=top_k,
+                cancel_event=cancel_event, trace=trace, profile=profile, model=model,
+            )
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    async def ask_stream(
+        self,
+        question: str,
+        history: Optional[List[Dict[str, str]]] = None,
+        top_k: int = 5,
+        model: Optional[str] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式问答：逐段产出 {"type": "token", "text": ...}，结束时产出
+        {"type": "done", "answer": ..., "evidence": [...], "timings": {...}}。
+        迭代方提前退出或被取消时（例如 HTTP 客户端断开），生成在下一个 token 处停止。
+        :param model: 使用的模型，见 RAGService.ask
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancel_event = threading.Event()
+        trace = Trace()
+
+        def on_token(text: str) -> None:
+            loop.call_soon_threadsafe(queue.put_nowait, text)
+
+        future = loop.run_in_executor(
+            self._cpu,
+            functools.partial(
+                self.core.rag.ask, question, history=history, top_k=top_k,
+                cancel_event=cancel_event, on_token=on_token, trace=trace, model=model,
+            ),
+        )
+        # 完成回调与 token 一样经 call_soon_threadsafe 排队，保证在最后一个 token 之后到达
+        future.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                text = await queue.get()
+                if text is None:
+                    break
+                yield {"type": "token", "text": text}
+            answer, evidence, _ = await future
+            yield {"type": "done", "answer": answer, "evidence": evidence, "timings": trace.to_dict()}
+        finally:
+            if not future.done():
+                cancel_event.set()
+
+    async def list_models(self) -> List[Dict[str, Any]]:
+        """可选模型及其加载状态"""
+        return await self._run_io(self.core.rag.list_models)
+
+    async def search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+        """异步检索"""
+        return await self._run_cpu(self.core.rag.search, query, top_k=top_k)
+
+    async def search_batch(self, queries: List[str], top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        """异步批量检索"""
+        return await self._run_cpu(self.core.rag.search_batch, queries, top_k=top_k)
+
+    # --- Knowledge Base ---
+
+    def start_job(self, task: str, force: bool = False, profile: bool = False) -> Dict[str, Any]:
+        """提交后台任务（不阻塞），返回任务状态快照；profile 见 KnowledgeBaseManager.start_job"""
+        return self.core.kb.start_job(task, force=force, profile=profile).snapshot()
+
+    async def run_job(self, task: str, force: bool = False) -> Any:
+        """提交后台任务并等待完成；取消等待不会取消任务本身"""
+        job = self.core.kb.start_job(task, force=force)
+        return await asyncio.shield(asyncio.wrap_future(job.future))
+
+    def cancel_job(self, job_id: int) -> bool:
+        return self.core.kb.jobs.cancel(job_id)
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        return self.core.kb.jobs.jobs()
+
+    def subscribe_jobs(self, callback: Callable[[Dict[str, Any]], Any]) -> Callable[[], None]:
+        """
+        订阅任务事件，回调在当前事件循环中执行（可为协程函数）。
+        :return: 取消订阅函数
+        """
+        loop = asyncio.get_running_loop()
+
+        def deliver(event: Dict[str, Any]) -> None:
+            result = callback(event)
+            if asyncio.iscoroutine(result):
+                loop.create_task(result)
+
+        return self.core.kb.jobs.subscribe(lambda event: loop.call_soon_threadsafe(deliver, event))
+
+    async def sync(self, folder: Optional[Path] = None, force: bool = False) -> None:
+        """同步文件夹：默认目录走后台任务（单飞、可取消），指定目录时直接在 cpu 线程池执行"""
+        if folder is None:
+            await self.run_job("sync", force=force)
+        else:
+            await self._run_cpu(self.core.kb.sync_folder, folder, force=force)
+
+    async def add_files(self, paths: List[Path], force: bool = False) -> None:
+        """将指定文件入库（解析 + 写 Delta Index），在 cpu 线程池执行"""
+        await self._run_cpu(self.core.kb.add_files, paths, force=force)
+
+    async def rebuild(self) -> None:
+        """在后台任务中全量重建索引，完成后返回"""
+        await self.run_job("rebuild")
+
+    async def compact(self) -> None:
+        """在后台任务中压缩索引，完成后返回"""
+        await self.run_job("compact")
+
+    async def get_stats(self) -> Dict[str, Any]:
+        return await self._run_io(self.core.kb.get_stats)
+
+    async def get_metrics(self) -> Dict[str, Any]:
+        """指标快照（见 app.metrics.Registry.snapshot）"""
+        return await self._run_io(metrics.REGISTRY.snapshot)
+
+    # --- Chat CRUD ---
+
+    async def create_session(self, title: str) -> str:
+        return await self._run_io(self.core.chat_manager.create_new_session, title)
+
+    async def list_sessions(self, before: Optional[Tuple[float, str]] = None, limit: int = 30) -> List[Dict[str, Any]]:
+        return await self._run_io(self.core.chat_manager.list_sessions, before=before, limit=limit)
+
+    async def get_history(self, session_id: str, before: Optional[Tuple[float, str]] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        return await self._run_io(self.core.chat_manager.get_history, session_id, before=before, limit=limit)
+
+    async def get_evidence(self, message_id: str) -> List[Dict[str, Any]]:
+        return await self._run_io(self.core.chat_manager.get_evidence, message_id)
+
+    async def add_user_message(self, session_id: str, content: str) -> str:
+        return await self._run_io(self.core.chat_manager.add_user_message, session_id, content)
+
+    async def add_ai_message(
+        self, session_id: str, content: str, evidence: List[Dict[str, Any]], timings: Optional[Dict[str, Any]] = None
+    ) -> str:
+        return await self._run_io(self.core.chat_manager.add_ai_message, session_id, content, evidence, timings)
+
+    async def rename_session(self, session_id: str, title: str) -> None:
+        await self._run_io(self.core.chat_manager.update_title, session_id, title)
+
+    async def delete_session(self, session_id: str) -> None:
+        await self._run_io(self.core.chat_manager.delete_session, session_id)
+
+    def shutdown(self) -> None:
+        """关闭线程池（不等待进行中的生成），并卸载空闲的模型"""
+        self._io.shutdown(wait=False, cancel_futures=True)
+        self._cpu.shutdown(wait=False, cancel_futures=True)
+        self.core.rag.models.unload_all()
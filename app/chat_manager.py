@@ -1,56 +1,79 @@
-import uuid
 import json
+import uuid
 import time
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from app.ingest import db
 
 class ChatManager:
-    def __init__(self, conn):
-        self.conn = conn
-        # 确保表存在 (强制执行，防止新表未创建)
-        db.ensure_schema(self.conn)
+    def __init__(self, pool: db.ConnectionPool):
+        """
+        :param pool: 数据库连接池（Schema 已在连接池创建时检查）
+        读操作走当前线程的只读连接，写操作走串行化的写连接，
+        可以同时在 NiceGUI 事件循环与 run.io_bound 线程中调用。
+        """
+        self.pool = pool
 
     def create_new_session(self, title: str = "New Chat") -> str:
         sid = str(uuid.uuid4())
-        db.create_session(self.conn, sid, title, time.time())
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            db.create_session(conn, sid, title, time.time())
         return sid
 
-    def list_sessions(self):
-        """返回按时间倒序的会话列表"""
-        rows = db.list_sessions(self.conn)
+    def list_sessions(self, before: Optional[Tuple[float, str]] = None, limit: int = 30):
+        """
+        返回按时间倒序的会话列表（分页）。
+        :param before: 上一页最后一个会话的 (updated_at, id)，None 表示第一页
+        :param limit: 每页数量
+        """
+        rows = db.list_sessions(self.pool.reader(), limit=limit, before=before)
         return [{"id": r[0], "title": r[1], "updated_at": r[2]} for r in rows]
 
-    def get_history(self, session_id: str):
-        """获取会话的所有消息"""
-        rows = db.get_messages(self.conn, session_id)
-        history = []
-        for r in rows:
-            role, content, ev_json = r
-            msg = {"role": role, "content": content}
-            if ev_json:
-                try:
-                    msg["evidence"] = json.loads(ev_json)
-                except:
-                    pass
-            history.append(msg)
-        return history
-
-    def add_user_message(self, session_id: str, content: str):
+    def get_history(self, session_id: str, before: Optional[Tuple[float, str]] = None, limit: int = 20):
+        """
+        获取会话中 before 之前最近的 limit 条消息（按时间正序）。
+        引用资料不随消息加载，只返回 evidence_count，需要时调用 get_evidence。
+        timings 为回答的各阶段耗时（未记录时为 None）。
+
+        :param session_id: 会话 ID
+        :param before: 上一页最早一条消息的 (created_at, id)，None 表示最新一页
+        :param limit: 每页数量
+        """
+        rows = db.get_messages_page(self.pool.reader(), session_id, before=before, limit=limit)
+        return [
+            {
+                "id": mid, "role": role, "content": content, "created_at": created_at,
+                "evidence_count": int(ev_count or 0),
+                "timings": json.loads(timings) if timings else None,
+            }
+            for mid, role, content, created_at, ev_count, timings in rows
+        ]
+
+    def get_evidence(self, message_id: str) -> List[Dict]:
+        """按消息 ID 加载引用资料（引用面板展开时调用）"""
+        return db.get_message_evidence(self.pool.reader(), message_id)
+
+    def add_user_message(self, session_id: str, content: str) -> str:
         mid = str(uuid.uuid4())
-        db.add_message(self.conn, mid, session_id, "user", content, None, time.time())
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            db.add_message(conn, mid, session_id, "user", content, None, time.time())
+        return mid
 
-    def add_ai_message(self, session_id: str, content: str, evidence: List[Dict]):
+    def add_ai_message(self, session_id: str, content: str, evidence: List[Dict], timings: Optional[Dict] = None) -> str:
         mid = str(uuid.uuid4())
-        ev_json = json.dumps(evidence) if evidence else None
-        db.add_message(self.conn, mid, session_id, "assistant", content, ev_json, time.time())
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            # 只保存 chunk 引用，正文显示时从 chunks 回查
+            db.add_message(
+                conn, mid, session_id, "assistant", content, None, time.time(),
+                timings_json=json.dumps(timings) if timings else None,
+            )
+            if evidence:
+                db.add_message_evidence(conn, mid, evidence)
+        return mid
 
     def update_title(self, session_id: str, title: str):
-        db.update_session_title(self.conn, session_id, title)
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            db.update_session_title(conn, session_id, title)
 
     def delete_session(self, session_id: str):
-        db.delete_session(self.conn, session_id)
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            db.delete_session(conn, session_id)
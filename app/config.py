@@ -26,6 +26,8 @@ RAW_DIR = DATA_DIR / "raw"
 KB_DIR = DATA_DIR / "kb"
 # SQLite 数据库路径
 DB_PATH = KB_DIR / "kb.sqlite3"
+# SQLite 忙等待超时（毫秒），并发写入时等待锁释放而不是立即报 "database is locked"
+DB_BUSY_TIMEOUT_MS = 15000
 
 # 文档分块参数
 # CHUNK_SIZE: 每个分块的目标字符数
@@ -33,6 +35,20 @@ CHUNK_SIZE = 900
 # CHUNK_OVERLAP: 分块间的重叠字符数，用于保持上下文连贯
 CHUNK_OVERLAP = 150
 
+# 入库去重（见 app/ingest/dedup.py）：重复的 chunk 仍然入库（保留出处），但共享同一个向量，不再重复向量化与索引
+# 内容完全相同（content_hash）的 chunk 共享向量
+DEDUP_EXACT = True
+# 近似重复（SimHash 汉明距离不超过 DEDUP_SIMHASH_DISTANCE，最大 3）的 chunk 也共享向量，例如同一手册的不同版本
+DEDUP_NEAR = True
+DEDUP_SIMHASH_DISTANCE = 3
+
+# 检索多样性：按 MMR 从候选中选取证据，抑制内容几乎相同的证据占满上下文
+RETRIEVAL_MMR = True
+# MMR 中相关度的权重（1 表示只看相关度）
+RETRIEVAL_MMR_LAMBDA = 0.7
+# 与已选证据的文本相似度（字符 3-gram Jaccard）不低于该值的候选直接丢弃
+RETRIEVAL_DUP_THRESHOLD = 0.8
+
 # 自动创建必要目录
 RAW_DIR.mkdir(parents=True, exist_ok=True)
 KB_DIR.mkdir(parents=True, exist_ok=True)
@@ -41,12 +57,148 @@ KB_DIR.mkdir(parents=True, exist_ok=True)
 # 使用 BAAI/bge-small-zh-v1.5 适合中文场景
 EMBED_MODEL_NAME = "BAAI/bge-small-zh-v1.5"
 
+# Embedding 推理后端
+# "torch":      SentenceTransformer 默认 PyTorch float32 推理
+# "torch-int8": PyTorch 动态 int8 量化（仅 CPU，Linear 层量化）
+# "onnx":       ONNX Runtime 推理（需安装 optimum[onnxruntime]）
+EMBED_BACKEND = "torch"
+# Embedding 推理线程数，0 表示自动（使用全部逻辑核）
+EMBED_NUM_THREADS = 0
+# 单个批次的 token 预算（按批内最长序列 * 条数计算，含 padding）
+# 短文本可以凑成更大的批次，长文本则自动缩小批次
+EMBED_MAX_BATCH_TOKENS = 16384
+
 # FAISS 索引文件路径
-# Base Index: 全量索引，通常在 compact/rebuild 时生成
+# Base Index: 分片索引目录，每个分片可独立重建，通常在 compact/rebuild 时生成
+# 目录结构：
+#   index/CURRENT                 当前索引代的名称（原子替换）
+#   index/gen-XXXXXX/manifest.json 分片清单：各分片目录、代数、向量数与存储方式
+#   index/gen-XXXXXX/delta.index   该代的 Delta Index
+#   index/shards/<hash>/gXXXXXX/   不可变的分片数据，可被多个索引代共享
+#   index/.write.lock             Delta 追加与代切换的跨进程写锁
+INDEX_DIR = KB_DIR / "index"
+INDEX_CURRENT_PATH = INDEX_DIR / "CURRENT"
+# 保留的历史索引代数量（正在查询旧代的检索器不受清理影响）
+INDEX_KEEP_GENERATIONS = 2
+# 旧版单文件 Base / Delta Index（仅在没有 CURRENT 时使用）
 FAISS_INDEX_PATH = KB_DIR / "faiss.index"
-# Delta Index: 增量索引，用于存储新入库但未合并的 chunks
 FAISS_DELTA_INDEX_PATH = KB_DIR / "faiss.delta.index"
 
+# 分片方式
+# "folder": 按 RAW_DIR 下的一级目录分片（根目录文件归入 "_root"）
+# "none":   所有文档放在同一个分片
+INDEX_SHARD_BY = "folder"
+# 并行检索分片的线程数
+INDEX_SEARCH_THREADS = 4
+
+# Base Index 向量存储方式
+# "flat": float32 原始向量 (IndexFlatIP)
+# "fp16": 半精度标量量化，内存约 1/2
+# "sq8":  8-bit 标量量化 (IndexScalarQuantizer)，内存约 1/4
+# "pq":   乘积量化 (IndexPQ)，内存约 1/(4*dim/INDEX_PQ_M)
+INDEX_STORAGE = "flat"
+# PQ 子空间个数（需整除向量维度）与每个子空间的编码位数
+INDEX_PQ_M = 64
+INDEX_PQ_NBITS = 8
+# 量化索引检索后，是否使用全精度向量对候选精确重打分
+INDEX_EXACT_RERANK = True
+
 # LLM 模型目录与路径 (GGUF 格式)
 MODELS_DIR = DATA_DIR / "models"
 LLM_GGUF_PATH = MODELS_DIR / "qwen2.5-3b-instruct-q4_k_m.gguf"
+
+# 模型注册表（见 app/rag/models.py）：MODELS_DIR 下的 .gguf 文件均可按文件名选用，LLM_GGUF_PATH 为默认模型
+# 已加载模型的内存预算（MB，按 GGUF 文件大小估算），超出时按 LRU 卸载空闲模型；0 表示物理内存的一半
+LLM_RAM_BUDGET_MB = 0
+# 模型空闲超过该秒数后自动卸载，0 表示不卸载
+LLM_IDLE_UNLOAD_SECONDS = 900
+# 请求选择 "auto" 时，不超过 LLM_FAST_MAX_CHARS 字的问题使用的小模型文件名（留空则总用默认模型）
+LLM_FAST_MODEL = ""
+LLM_FAST_MAX_CHARS = 40
+
+# llama.cpp 运行参数（见 app/rag/llm_runtime.py）
+# 上下文窗口大小
+LLM_N_CTX = 4096
+# 生成（逐 token 解码）线程数，0 表示自动：有调优结果时用调优结果，否则用物理核数
+LLM_N_THREADS = 0
+# prompt 处理（批量解码）线程数，0 表示自动（同上）
+LLM_N_THREADS_BATCH = 0
+# prompt 处理时每批送入的最大 token 数
+LLM_N_BATCH = 512
+# 以 mmap 方式加载模型（多进程共享页缓存、加载快）；mlock 将模型锁定在内存中防止换出（需足够的锁定内存配额）
+LLM_USE_MMAP = True
+LLM_USE_MLOCK = False
+# 启用 flash attention（llama-cpp-python 支持该参数时才传入）
+LLM_FLASH_ATTN = True
+# 首次加载某个模型文件时运行微基准，分别选出 prompt 处理与生成最快的线程数，结果按模型文件缓存
+LLM_AUTOTUNE = True
+LLM_TUNING_PATH = KB_DIR / "llm_tuning.json"
+
+# 投机解码（见 app/rag/speculative.py）：先廉价地起草若干 token，再由主模型一次前向验证
+# "none":          关闭
+# "prompt_lookup": 在 prompt（含检索证据）中查找与最近生成内容相同的 n-gram，把其后续 token 作为草稿；
+#                  RAG 回答常大段引用资料，不需要额外模型
+# "draft":         使用 LLM_DRAFT_GGUF_PATH 的小模型贪心起草（须与主模型共用词表，如同系列 0.5B）
+# 注意：启用后 llama-cpp-python 会为每个上下文位置保留 logits（n_ctx * 词表大小 * 4 字节，
+# Qwen2.5 + 4096 上下文约 2.5GB），内存紧张时保持关闭
+LLM_SPECULATIVE = "none"
+# 每次起草的 token 数
+LLM_SPEC_NUM_PRED_TOKENS = 10
+# prompt_lookup 匹配的最大 n-gram 长度
+LLM_SPEC_MAX_NGRAM = 2
+# draft 模式的小模型路径
+LLM_DRAFT_GGUF_PATH = MODELS_DIR / "qwen2.5-0.5b-instruct-q4_k_m.gguf"
+
+# 多轮对话（见 app/rag/conversation.py）
+# 检索前把追问（"第二个呢？"、"它的复杂度是多少"）改写为独立的检索问题
+CONV_REWRITE = True
+# 规则改写之外，对追问再调用一次大模型改写（生成 token 数上限 CONV_REWRITE_MAX_TOKENS），会增加一次短生成的延迟
+CONV_REWRITE_LLM = False
+CONV_REWRITE_MAX_TOKENS = 48
+# 原样发送给大模型的最近轮数（一问一答为一轮），更早的轮次折叠为滚动摘要
+CONV_KEEP_TURNS = 3
+# 原样保留的每条历史消息的最大字符数
+CONV_TURN_MAX_CHARS = 1500
+# 滚动摘要的最大字符数
+CONV_SUMMARY_MAX_CHARS = 600
+# 使用大模型生成滚动摘要（否则按规则抽取每轮问题与回答首句），生成 token 数上限 CONV_SUMMARY_MAX_TOKENS
+CONV_SUMMARY_LLM = False
+CONV_SUMMARY_MAX_TOKENS = 200
+
+# 证据压缩（见 app/rag/compress.py）：构造 prompt 前按与问题的向量相似度，
+# 每条证据只保留最相关的几句及其前后相邻句，缩短 prompt 处理时间；[DocN] 编号与证据一一对应不变
+CONTEXT_COMPRESS = True
+# 每条证据保留的最相关句子数
+CONTEXT_COMPRESS_TOP_SENTENCES = 3
+# 每个保留句子前后各带上的相邻句数
+CONTEXT_COMPRESS_NEIGHBORS = 1
+# 短于该字符数的证据原样保留
+CONTEXT_COMPRESS_MIN_CHARS = 300
+
+# Web 服务异步层的线程池大小
+# IO: SQLite 读写等短任务；CPU: 检索 / 生成等计算密集任务（torch / llama.cpp 内部已多线程）
+ASYNC_IO_WORKERS = 8
+ASYNC_CPU_WORKERS = 2
+
+# 常驻服务（python -m app.daemon serve）
+# 仅监听本机回环地址；CLI 通过 DAEMON_INFO_PATH 中的端口与令牌发现服务，
+# 服务未运行时自动回退到进程内执行。设置环境变量 EXTRACTHELPER_NO_DAEMON=1 可强制进程内执行。
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8552
+DAEMON_INFO_PATH = KB_DIR / "daemon.json"
+
+# Web 服务的 HTTP JSON API（/api/search、/api/ask、/api/ingest）
+# 默认只接受本机请求；Web 界面监听所有网卡时，置 True 才允许其他主机调用
+API_ALLOW_REMOTE = False
+# /api/search 单次请求的最大查询条数
+API_MAX_BATCH = 256
+
+# 问答耗时追踪：记录检索 / 构造上下文 / prompt 处理 / 生成等各阶段耗时与 token 数，
+# 随回答保存并在聊天界面的 "Timing" 面板中显示。关闭后追踪代码为空操作
+TRACE_ENABLED = True
+
+# 性能剖析（--profile / 设置面板开关）报告目录：cProfile 结果、各阶段耗时与内存、逐文件耗时
+PROFILES_DIR = KB_DIR / "profiles"
+
+# 检索评测（python -m app.eval）结果目录
+EVAL_DIR = KB_DIR / "eval"
@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from app.config import DAEMON_HOST, DAEMON_INFO_PATH, DAEMON_PORT
+from app.tracing import Trace
+
+"""
+常驻服务（extracthelper serve）
+在一个长驻进程中保持 ExtractHelperApp 预热（向量模型、FAISS 索引、GGUF 模型），
+通过本机 HTTP 暴露 search / ask / sync / add / delete / compact，CLI 命令优先转发给它，
+省去每次启动十几秒的模型加载。
+
+- 只监听回环地址；启动后把 {host, port, pid, token} 写入 DAEMON_INFO_PATH，
+  客户端读取该文件发现服务，每个请求都需携带令牌。
+- 客户端侧只依赖标准库，不导入 torch / faiss / llama.cpp；服务未运行或不可达时
+  try_call 返回 None，由调用方回退到进程内执行。
+- 索引写入（sync / add / delete / compact）在常驻服务中执行时与其检索共用进程内的写锁，
+  避免两个进程同时写 Delta Index。
+
+用法:
+  python -m app.daemon serve [--host 127.0.0.1] [--port 8552]
+  python -m app.daemon status
+  python -m app.daemon stop
+"""
+
+# 请求头中的访问令牌
+TOKEN_HEADER = "X-ExtractHelper-Token"
+# 探测服务是否存活的超时（秒）
+PROBE_TIMEOUT = 1.0
+# 设置该环境变量时 CLI 不使用常驻服务
+NO_DAEMON_ENV = "EXTRACTHELPER_NO_DAEMON"
+
+
+class DaemonError(RuntimeError):
+    """常驻服务处理请求时出错（服务可达，但操作本身失败）"""
+
+
+def _json_default(obj: Any) -> Any:
+    # numpy 标量（score 等）
+    if hasattr(obj, "item"):
+        return obj.item()
+    if isinstance(obj, Path):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# ---------------- 客户端 ----------------
+
+def read_info(info_path: Path = DAEMON_INFO_PATH) -> Optional[Dict[str, Any]]:
+    """读取服务发现文件，不存在或损坏时返回 None"""
+    try:
+        return json.loads(Path(info_path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _request(info: Dict[str, Any], method: str, op: str, payload: Optional[dict], timeout: Optional[float]) -> Any:
+    url = f"http://{info['host']}:{info['port']}/{op}"
+    data = json.dumps(payload or {}, default=_json_default).encode("utf-8") if method == "POST" else None
+    req = urllib.request.Request(url, data=data, method=method)
+    req.add_header("Content-Type", "application/json")
+    req.add_header(TOKEN_HEADER, info.get("token", ""))
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            body = json.loads(e.read().decode("utf-8"))
+        except ValueError:
+            body = {}
+        raise DaemonError(body.get("error") or f"HTTP {e.code}") from None
+
+
+def probe(info_path: Path = DAEMON_INFO_PATH) -> Optional[Dict[str, Any]]:
+    """
+    检查常驻服务是否在运行。
+    :return: 服务信息（含 token），未运行返回 None
+    """
+    info = read_info(info_path)
+    if not info:
+        return None
+    try:
+        health = _request(info, "GET", "health", None, PROBE_TIMEOUT)
+    except (OSError, DaemonError, ValueError):
+        # 服务已退出但发现文件残留（异常终止）
+        return None
+    if health.get("pid") != info.get("pid"):
+        return None
+    return info
+
+
+def connect() -> Optional[Dict[str, Any]]:
+    """CLI 使用的服务探测：设置了 EXTRACTHELPER_NO_DAEMON 时总是返回 None"""
+    if os.environ.get(NO_DAEMON_ENV):
+        return None
+    return probe()
+
+
+def try_call(op: str, payload: Optional[dict] = None, info: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    把操作转发给常驻服务。
+    :param op: search / ask / sync / add / compact / models
+    :param payload: 请求参数
+    :param info: connect() 的结果，为 None 时自动探测
+    :return: {"result": ...}；服务未运行或连接中断时返回 None（调用方应回退到进程内执行）
+    :raises DaemonError: 服务可达但操作失败
+    """
+    info = info or connect()
+    if info is None:
+        return None
+    try:
+        return _request(info, "POST", op, payload, None)
+    except (ConnectionError, urllib.error.URLError) as e:
+        print(f"[daemon] unreachable ({e}), running in-process.", file=sys.stderr)
+        return None
+
+
+# ---------------- 服务端 ----------------
+
+class Daemon:
+    """常驻服务的操作实现，每个操作接收 JSON 参数并返回可序列化的结果"""
+    def __init__(self, core) -> None:
+        """
+        :param core: ExtractHelperApp 实例
+        """
+        self.core = core
+        self.ops: Dict[str, Callable[[dict], Any]] = {
+            "search": self.search,
+            "ask": self.ask,
+            "sync": self.sync,
+            "add": self.add,
+            "delete": self.delete,
+            "compact": self.compact,
+            "models": self.models,
+        }
+
+    def search(self, p: dict) -> Any:
+        # {"queries": [...]} 走批量检索，返回与之对应的结果列表
+        if "queries" in p:
+            return self.core.rag.search_batch(list(p["queries"]), top_k=int(p.get("top_k", 5)))
+        return self.core.rag.search(p["query"], top_k=int(p.get("top_k", 5)))
+
+    def ask(self, p: dict) -> Any:
+        trace = Trace()
+        answer, evidence, _ = self.core.rag.ask(
+            p["query"], history=p.get("history") or [], top_k=int(p.get("top_k", 5)), trace=trace,
+            model=p.get("model"),
+        )
+        return {"answer": answer, "evidence": evidence, "timings": trace.to_dict()}
+
+    def sync(self, p: dict) -> Any:
+        # 走任务管理器：与同进程内的其他同步请求单飞
+        job = self.core.kb.start_job("sync", force=bool(p.get("force")), folder=p.get("folder"))
+        return job.future.result()
+
+    def add(self, p: dict) -> Any:
+        self.core.kb.add_files([Path(x) for x in p["paths"]], force=bool(p.get("force")))
+
+    def delete(self, p: dict) -> Any:
+        self.core.kb.delete_files([Path(x) for x in p["paths"]])
+
+    def compact(self, p: dict) -> Any:
+        return self.core.kb.start_job("compact").future.result()
+
+    def models(self, p: dict) -> Any:
+        return self.core.rag.list_models()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_DaemonServer"
+
+    def _send(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self) -> bool:
+        token = self.headers.get(TOKEN_HEADER, "")
+        if secrets.compare_digest(token, self.server.token):
+            return True
+        self._send(403, {"error": "invalid token"})
+        return False
+
+    def do_GET(self) -> None:
+        if not self._authorized():
+            return
+        if self.path.strip("/") == "health":
+            self._send(200, {"pid": os.getpid(), "uptime": time.time() - self.server.started_at})
+        else:
+            self._send(404, {"error": f"unknown path: {self.path}"})
+
+    def do_POST(self) -> None:
+        if not self._authorized():
+            return
+        op = self.path.strip("/")
+        if op == "shutdown":
+            self._send(200, {"result": None})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        handler = self.server.service.ops.get(op)
+        if handler is None:
+            self._send(404, {"error": f"unknown operation: {op}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        except ValueError as e:
+            self._send(400, {"error": f"invalid JSON: {e}"})
+            return
+
+        t0 = time.perf_counter()
+        try:
+            result = handler(payload)
+        except Exception as e:
+            print(f"[daemon] {op} failed: {type(e).__name__}: {e}")
+            self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        print(f"[daemon] {op} done in {time.perf_counter() - t0:.3f}s")
+        self._send(200, {"result": result})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # 请求日志已在 do_POST 中按操作打印
+        pass
+
+
+class _DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: Daemon, token: str) -> None:
+        super().__init__(address, _Handler)
+        self.service = service
+        self.token = token
+        self.started_at = time.time()
+
+
+def serve(host: str = DAEMON_HOST, port: int = DAEMON_PORT, info_path: Path = DAEMON_INFO_PATH) -> None:
+    """
+    启动常驻服务（阻塞直到 stop 或 Ctrl+C）。
+    先绑定端口再预热，预热完成后才写入发现文件，
+    因此预热期间的 CLI 调用仍在各自进程内执行，不会排队等待。
+
+    :param host: 监听地址（应为回环地址）
+    :param port: 监听端口，0 表示随机端口
+    :param info_path: 服务发现文件路径
+    """
+    running = probe(info_path)
+    if running is not None:
+        print(f"[daemon] already running: pid={running['pid']} port={running['port']}")
+        sys.exit(1)
+
+    from app.app_core import WARMUP_STAGES, ExtractHelperApp, _warm_stage
+
+    core = ExtractHelperApp()
+    server = _DaemonServer((host, port), Daemon(core), secrets.token_urlsafe(24))
+    host, port = server.server_address[:2]
+
+    for stage in WARMUP_STAGES:
+        t0 = time.perf_counter()
+        try:
+            _warm_stage(core, stage)
+            print(f"[daemon] warm {stage}: {time.perf_counter() - t0:.1f}s")
+        except Exception as e:
+            # 某一阶段失败（例如模型文件缺失）不影响其他操作，首次使用时会再次尝试加载
+            print(f"[daemon] warm {stage} failed: {type(e).__name__}: {e}")
+
+    info = {"host": host, "port": port, "pid": os.getpid(), "token": server.token}
+    # 文件中含访问令牌：仅当前用户可读写（Windows 上 mode 只影响只读位，依赖用户目录权限）
+    tmp = Path(info_path).with_suffix(".tmp")
+    tmp.unlink(missing_ok=True)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(json.dumps(info))
+    os.replace(tmp, info_path)
+    print(f"[daemon] serving on http://{host}:{port} (pid={os.getpid()})")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        core.rag.models.unload_all()
+        current = read_info(info_path)
+        if current and current.get("pid") == os.getpid():
+            Path(info_path).unlink(missing_ok=True)
+        print("[daemon] stopped.")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.daemon")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p_serve = sub.add_parser("serve", help="start the resident daemon (default)")
+    p_serve.add_argument("--host", type=str, default=DAEMON_HOST)
+    p_serve.add_argument("--port", type=int, default=DAEMON_PORT)
+
+    sub.add_parser("status", help="show whether the daemon is running")
+    sub.add_parser("stop", help="stop the running daemon")
+
+    args = parser.parse_args()
+
+    if args.cmd in (None, "serve"):
+        serve(host=getattr(args, "host", DAEMON_HOST), port=getattr(args, "port", DAEMON_PORT))
+        return
+
+    info = probe()
+    if info is None:
+        print("[daemon] not running.")
+        sys.exit(1 if args.cmd == "status" else 0)
+
+    if args.cmd == "status":
+        print(f"[daemon] running: pid={info['pid']} url=http://{info['host']}:{info['port']}")
+        return
+
+    if args.cmd == "stop":
+        _request(info, "POST", "shutdown", None, PROBE_TIMEOUT)
+        print(f"[daemon] stop requested (pid={info['pid']}).")
+        return
+
+
+if __name__ == "__main__":
+    main()
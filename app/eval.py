@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app import config
+from app.config import EVAL_DIR
+from app.profiling import peak_rss_bytes, rss_bytes
+
+"""
+检索质量与延迟评测
+读取黄金查询集（JSONL），在当前知识库上批量检索，报告 recall@k、MRR、nDCG@k，
+以及批量吞吐、单条查询 p50 / p95 延迟与内存占用；结果连同当时的配置（分块参数、索引存储方式等）
+保存为 JSON，两次结果可并排比较（例如 flat 与 pq、不同的 CHUNK_SIZE）。
+
+黄金集每行一条：
+    {"query": "动态规划的状态定义", "doc": "dp.pdf", "page": 12}
+    {"query": "...", "expected": [{"doc": "a.md"}, {"doc": "notes/b.pdf", "page": 3}]}
+doc 为文件名或路径后缀；page 省略时命中该文档任意位置即算相关。
+
+用法:
+    python -m app.eval run golden.jsonl [--k 1,5,10] [--label flat] [--compare 上次结果.json]
+    python -m app.eval compare a.json b.json
+评测总在当前进程内执行（不转发给常驻服务），测量的就是当前配置与索引。
+"""
+
+# 默认报告的 k 值
+DEFAULT_KS = (1, 5, 10)
+
+# 记录到结果中的配置项，用于比较时说明两次运行的差异
+CONFIG_KEYS = (
+    "CHUNK_SIZE", "CHUNK_OVERLAP", "EMBED_MODEL_NAME", "EMBED_BACKEND",
+    "INDEX_SHARD_BY", "INDEX_STORAGE", "INDEX_PQ_M", "INDEX_PQ_NBITS", "INDEX_EXACT_RERANK",
+    "DEDUP_EXACT", "DEDUP_NEAR", "DEDUP_SIMHASH_DISTANCE",
+    "RETRIEVAL_MMR", "RETRIEVAL_MMR_LAMBDA", "RETRIEVAL_DUP_THRESHOLD",
+)
+
+
+@dataclass
+class GoldenQuery:
+    """一条黄金查询：targets 为 (文档名或路径后缀, 页码或 None)"""
+    query: str
+    targets: List[Tuple[str, Optional[int]]] = field(default_factory=list)
+
+
+def load_golden(path: Path) -> List[GoldenQuery]:
+    """读取黄金集 JSONL（空行与 # 开头的行忽略）"""
+    out: List[GoldenQuery] = []
+    for lineno, line in enumerate(Path(path).read_text(encoding="utf-8").splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        item = json.loads(line)
+        expected = item.get("expected") or [{"doc": item.get("doc"), "page": item.get("page")}]
+        targets = [
+            (str(e["doc"]).replace("\\", "/"), int(e["page"]) if e.get("page") is not None else None)
+            for e in expected if e.get("doc")
+        ]
+        if not item.get("query") or not targets:
+            raise ValueError(f"{path}:{lineno}: need a query and at least one expected doc")
+        out.append(GoldenQuery(query=str(item["query"]), targets=targets))
+    return out
+
+
+def _matches_one(path: str, page: Optional[int], target: Tuple[str, Optional[int]]) -> bool:
+    doc, want = target
+    path = path.replace("\\", "/")
+    if not (path.rsplit("/", 1)[-1] == doc or path.endswith("/" + doc.lstrip("/")) or path == doc):
+        return False
+    return want is None or page == want
+
+
+def _matches(evidence: Dict[str, Any], target: Tuple[str, Optional[int]]) -> bool:
+    # 去重后同一内容只返回一个 chunk，其余出处在 also_in 中，命中任一出处即视为相关
+    sources = [(evidence["path"], evidence.get("page"))]
+    sources += [(d["path"], d.get("page")) for d in evidence.get("also_in") or []]
+    return any(_matches_one(path, page, target) for path, page in sources)
+
+
+def score_ranking(evidence: List[Dict[str, Any]], targets: List[Tuple[str, Optional[int]]], ks: Sequence[int]) -> Dict[str, Any]:
+    """
+    计算单条查询的指标。每个目标只在第一次命中时计为相关（同一文档的多个 chunk 不重复计分）。
+    :return: {"first_rank", "rr", "recall@k", "ndcg@k"}，first_rank 为首个相关结果的名次（未命中为 None），
+             rr（MRR 的单条值）只在传入的 evidence 范围（即 max(ks) 条）内计算
+    """
+    # gains[i] = 1 表示第 i 个结果命中了一个此前未命中的目标
+    found = set()
+    gains: List[int] = []
+    for e in evidence:
+        hit = next((j for j, t in enumerate(targets) if j not in found and _matches(e, t)), None)
+        if hit is not None:
+            found.add(hit)
+        gains.append(1 if hit is not None else 0)
+
+    first_rank = next((i + 1 for i, g in enumerate(gains) if g), None)
+    out: Dict[str, Any] = {"first_rank": first_rank, "rr": 1.0 / first_rank if first_rank else 0.0}
+    for k in ks:
+        top = gains[:k]
+        dcg = sum(g / math.log2(i + 2) for i, g in enumerate(top))
+        idcg = sum(1 / math.log2(i + 2) for i in range(min(len(targets), k)))
+        out[f"recall@{k}"] = sum(top) / len(targets)
+        out[f"ndcg@{k}"] = dcg / idcg if idcg else 0.0
+    return out
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩分位数（与 app.metrics 的直方图一致）"""
+    if not values:
+        return None
+    data = sorted(values)
+    return data[min(len(data) - 1, max(0, math.ceil(q * len(data)) - 1))]
+
+
+def config_snapshot() -> Dict[str, Any]:
+    """当前配置与索引概况"""
+    from app.retrieval.shards import index_memory_stats
+
+    snap = {k: getattr(config, k) for k in CONFIG_KEYS}
+    try:
+        idx = index_memory_stats()
+        snap["index"] = {k: idx.get(k) for k in ("generation", "storage", "shards", "vectors", "base_bytes", "delta_bytes")}
+    except Exception as e:
+        snap["index"] = {"error": str(e)}
+    return snap
+
+
+def evaluate(
+    golden: List[GoldenQuery],
+    ks: Sequence[int] = DEFAULT_KS,
+    batch_size: int = 32,
+    latency_samples: int = 50,
+) -> Dict[str, Any]:
+    """
+    在当前知识库上评测黄金集。
+    1. 预热（加载向量模型与索引），单独计时；
+    2. 以 batch_size 为一批调用 retrieve_evidence_batch，检索 max(ks) 条并计算质量指标与吞吐；
+    3. 对前 latency_samples 条查询逐条检索，得到单条查询延迟 p50 / p95。
+
+    :param golden: 黄金查询
+    :param ks: 报告的 k 值
+    :param batch_size: 批量检索的批大小
+    :param latency_samples: 测量单条延迟的查询条数（0 表示不测）
+    :return: 结果字典（可 JSON 序列化）
+    """
+    from app.retrieval.retrieve import load_base_and_delta, retrieve_evidence, retrieve_evidence_batch
+
+    ks = sorted(set(int(k) for k in ks))
+    depth = max(ks)
+    queries = [g.query for g in golden]
+    rss0 = rss_bytes()
+
+    t0 = time.perf_counter()
+    load_base_and_delta()
+    retrieve_evidence_batch(queries[:1], top_k=depth)
+    warmup_s = time.perf_counter() - t0
+
+    results: List[List[Dict[str, Any]]] = []
+    t0 = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        results.extend(retrieve_evidence_batch(queries[i:i + batch_size], top_k=depth))
+    batch_s = time.perf_counter() - t0
+
+    latencies: List[float] = []
+    for q in queries[:latency_samples]:
+        t = time.perf_counter()
+        retrieve_evidence(q, top_k=depth)
+        latencies.append((time.perf_counter() - t) * 1e3)
+
+    per_query = []
+    for g, evidence in zip(golden, results):
+        scores = score_ranking(evidence, g.targets, ks)
+        per_query.append({
+            "query": g.query,
+            **scores,
+            "retrieved": [[e["filename"], e["page"]] for e in evidence],
+        })
+
+    n = len(per_query)
+    quality = {"mrr": sum(p["rr"] for p in per_query) / n if n else 0.0}
+    for k in ks:
+        quality[f"recall@{k}"] = sum(p[f"recall@{k}"] for p in per_query) / n if n else 0.0
+        quality[f"ndcg@{k}"] = sum(p[f"ndcg@{k}"] for p in per_query) / n if n else 0.0
+
+    return {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "queries": n,
+        "ks": ks,
+        "config": config_snapshot(),
+        "quality": quality,
+        "latency": {
+            "warmup_ms": warmup_s * 1e3,
+            "batch_size": batch_size,
+            "batch_qps": n / batch_s if batch_s > 0 else None,
+            "single_p50_ms": _percentile(latencies, 0.5),
+            "single_p95_ms": _percentile(latencies, 0.95),
+        },
+        "memory": {"rss_before": rss0, "rss_after": rss_bytes(), "peak_rss": peak_rss_bytes()},
+        "per_query": per_query,
+    }
+
+
+# --- 报告 ---
+
+def _rows(result: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    """用于显示 / 比较的 (指标名, 值) 列表"""
+    rows: List[Tuple[str, Any]] = [("queries", result["queries"])]
+    rows += list(result["quality"].items())
+    rows += [(f"latency.{k}", v) for k, v in result["latency"].items()]
+    rows += [(f"memory.{k}_mb", v / (1 << 20) if v is not None else None) for k, v in result["memory"].items()]
+    idx = result["config"].get("index") or {}
+    for k in ("base_bytes", "delta_bytes"):
+        if idx.get(k) is not None:
+            rows.append((f"index.{k[:-6]}_mb", idx[k] / (1 << 20)))
+    return rows
+
+
+def _fmt(v: Any) -> str:
+    if v is None:
+        return "n/a"
+    if isinstance(v, float):
+        return f"{v:.4f}" if abs(v) < 10 else f"{v:.1f}"
+    return str(v)
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    lines = [f"{k:<24} {_fmt(v)}" for k, v in _rows(result)]
+    cfg = {k: v for k, v in result["config"].items() if k != "index"}
+    lines.append("config: " + " ".join(f"{k}={v}" for k, v in cfg.items()))
+    return "\n".join(lines)
+
+
+def format_comparison(a: Dict[str, Any], b: Dict[str, Any], label_a: str = "A", label_b: str = "B") -> str:
+    """两次结果并排显示（B - A 的差值），并列出不同的配置项"""
+    rows_a, rows_b = dict(_rows(a)), dict(_rows(b))
+    keys = list(rows_a) + [k for k in rows_b if k not in rows_a]
+    lines = [f"{'metric':<24} {label_a:>12} {label_b:>12} {'delta':>12}"]
+    for k in keys:
+        va, vb = rows_a.get(k), rows_b.get(k)
+        delta = vb - va if isinstance(va, (int, float)) and isinstance(vb, (int, float)) else None
+        lines.append(f"{k:<24} {_fmt(va):>12} {_fmt(vb):>12} {_fmt(delta) if delta is not None else '':>12}")
+    cfg_a, cfg_b = a["config"], b["config"]
+    diff = [k for k in CONFIG_KEYS if cfg_a.get(k) != cfg_b.get(k)]
+    idx_a, idx_b = cfg_a.get("index") or {}, cfg_b.get("index") or {}
+    if idx_a.get("storage") != idx_b.get("storage") and "INDEX_STORAGE" not in diff:
+        diff.append("index.storage")
+    if diff:
+        lines.append("")
+        lines.append("config differences:")
+        for k in diff:
+            va = idx_a.get("storage") if k == "index.storage" else cfg_a.get(k)
+            vb = idx_b.get("storage") if k == "index.storage" else cfg_b.get(k)
+            lines.append(f"  {k}: {va} -> {vb}")
+    if a.get("queries") != b.get("queries"):
+        lines.append(f"warning: different query counts ({a.get('queries')} vs {b.get('queries')})")
+    return "\n".join(lines)
+
+
+def _load_result(path: str) -> Dict[str, Any]:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.eval")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run", help="evaluate the current knowledge base against a golden JSONL")
+    p_run.add_argument("golden", type=str)
+    p_run.add_argument("--k", type=str, default=",".join(map(str, DEFAULT_KS)), help="comma separated k values")
+    p_run.add_argument("--batch", type=int, default=32)
+    p_run.add_argument("--latency-samples", type=int, default=50)
+    p_run.add_argument("--label", type=str, default="run", help="name used for the result file")
+    p_run.add_argument("--out", type=str, default=None, help=f"result JSON (default: {EVAL_DIR}/<time>-<label>.json)")
+    p_run.add_argument("--compare", type=str, default=None, help="previous result JSON to compare against")
+
+    p_cmp = sub.add_parser("compare", help="compare two result JSON files side by side")
+    p_cmp.add_argument("a", type=str)
+    p_cmp.add_argument("b", type=str)
+
+    args = parser.parse_args()
+
+    if args.cmd == "compare":
+        print(format_comparison(_load_result(args.a), _load_result(args.b), Path(args.a).stem, Path(args.b).stem))
+        return
+
+    golden = load_golden(Path(args.golden))
+    if not golden:
+        print(f"[eval] no queries in {args.golden}")
+        sys.exit(1)
+    ks = [int(k) for k in args.k.split(",") if k.strip()]
+    result = evaluate(golden, ks=ks, batch_size=max(1, args.batch), latency_samples=max(0, args.latency_samples))
+    result["label"] = args.label
+
+    out = Path(args.out) if args.out else EVAL_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if args.compare:
+        prev = _load_result(args.compare)
+        print(format_comparison(prev, result, prev.get("label") or Path(args.compare).stem, args.label))
+    else:
+        print(format_result(result))
+    print(f"[eval] result written to {out}")
+
+
+if __name__ == "__main__":
+    main()
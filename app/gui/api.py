@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+from app import metrics
+from app.config import API_ALLOW_REMOTE, API_MAX_BATCH
+
+"""
+HTTP JSON API
+挂载在 NiceGUI 的 FastAPI 应用上，与 Web 界面共用同一个 AsyncExtractHelperApp（同一份已加载的模型与索引）。
+
+- POST /api/search  批量检索：所有查询一次编码、每个索引一次检索
+- POST /api/ask     流式问答（Server-Sent Events）：token 事件逐段推送，done 事件附带证据与各阶段耗时
+- POST /api/ingest  将指定路径的文件入库
+- GET  /api/models  可选的 GGUF 模型及其加载状态（问答请求可用 model 字段指定）
+- GET  /metrics     Prometheus 文本格式的进程内指标（见 app.metrics）
+"""
+
+LOOPBACK_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+
+class SearchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=API_MAX_BATCH)
+    top_k: int = Field(5, ge=1, le=100)
+
+
+class AskRequest(BaseModel):
+    question: str = Field(..., min_length=1)
+    history: List[Dict[str, str]] = Field(default_factory=list)
+    top_k: int = Field(5, ge=1, le=100)
+    # 模型名（文件名或不含 .gguf 的名称）/ "default" / "auto"，为空时使用默认模型
+    model: Optional[str] = None
+
+
+class IngestRequest(BaseModel):
+    paths: List[str] = Field(..., min_length=1)
+    force: bool = False
+
+
+def _sse(event: str, data: Any) -> str:
+    """编码一条 SSE 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=float)}\n\n"
+
+
+def _check_client(request: Request) -> None:
+    """默认只接受本机请求（见 API_ALLOW_REMOTE）"""
+    if API_ALLOW_REMOTE:
+        return
+    host = request.client.host if request.client else ""
+    if host not in LOOPBACK_HOSTS:
+        raise HTTPException(status_code=403, detail="API only accepts requests from localhost")
+
+
+def register_api(app: FastAPI, get_core: Callable[[], Awaitable[Any]]) -> None:
+    """
+    在 FastAPI 应用上注册 /api 路由。
+    :param app: NiceGUI 的 FastAPI 应用（nicegui.app）
+    :param get_core: 返回 AsyncExtractHelperApp 的协程函数（首次调用时完成初始化）
+    """
+
+    @app.post("/api/search")
+    async def api_search(body: SearchRequest, request: Request) -> Dict[str, Any]:
+        _check_client(request)
+        core = await get_core()
+        try:
+            results = await core.search_batch(body.queries, top_k=body.top_k)
+        except RuntimeError as e:
+            # 索引尚未建立
+            raise HTTPException(status_code=409, detail=str(e))
+        return {"results": results}
+
+    @app.post("/api/ask")
+    async def api_ask(body: AskRequest, request: Request) -> StreamingResponse:
+        _check_client(request)
+        core = await get_core()
+        if body.model not in (None, "", "default", "auto"):
+            names = {n for m in await core.list_models() for n in (m["name"], Path(m["name"]).stem)}
+            if body.model not in names:
+                raise HTTPException(status_code=400, detail=f"Unknown model: {body.model}")
+
+        async def events():
+            # 客户端断开时 StreamingResponse 取消本生成器，ask_stream 随之通知生成线程停止
+            try:
+                async for event in core.ask_stream(
+                    body.question, history=body.history, top_k=body.top_k, model=body.model
+                ):
+                    if event["type"] == "token":
+                        yield _sse("token", {"text": event["text"]})
+                    else:
+                        yield _sse("done", {k: event[k] for k in ("answer", "evidence", "timings")})
+            except Exception as e:
+                yield _sse("error", {"error": f"{type(e).__name__}: {e}"})
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.get("/api/models")
+    async def api_models(request: Request) -> Dict[str, Any]:
+        _check_client(request)
+        core = await get_core()
+        return {"models": await core.list_models()}
+
+    @app.get("/metrics")
+    async def metrics_endpoint(request: Request) -> PlainTextResponse:
+        _check_client(request)
+        # 抓取时的 collector 会读数据库与索引文件，放到线程池执行
+        text = await run_in_threadpool(metrics.REGISTRY.render_prometheus)
+        return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.post("/api/ingest")
+    async def api_ingest(body: IngestRequest, request: Request) -> Dict[str, Any]:
+        _check_client(request)
+        paths = [Path(p) for p in body.paths]
+        missing = [str(p) for p in paths if not p.is_file()]
+        if missing:
+            raise HTTPException(status_code=400, detail={"missing": missing})
+        core = await get_core()
+        await core.add_files(paths, force=body.force)
+        return {"ingested": len(paths)}
@@ -1,4 +1,4 @@
-from nicegui import ui, run, app
+from nicegui import ui, run, app, background_tasks
 import sys
 import os
 from pathlib import Path
@@ -9,14 +9,29 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 import asyncio
+import importlib
 import socket
 import webbrowser
 import threading
 import time
 import logging
 
+from app.gui.api import register_api
+from app.tracing import Trace
+
 # 全局变量存储 AppCore 实例
 app_core = None
+# 正在进行的初始化任务（多个页面同时打开时共用）
+_app_core_init = None
+# 后台预热进度（所有页面共享），stage: db / embedder / index / llm / ready
+WARMUP_STATUS = {'stage': 'db'}
+
+# 打开会话 / 向上滚动时每批加载并渲染的消息条数
+CHAT_RENDER_WINDOW = 20
+# 会话列表每页加载数量
+SESSION_PAGE_SIZE = 30
+# 设置面板中性能卡片的刷新间隔（秒）
+PERF_REFRESH_SECONDS = 5.0
 
 TRANSLATIONS = {
     'en': {
@@ -40,13 +55,43 @@ TRANSLATIONS = {
         'not_helpful': 'Not Helpful',
         'loading': 'Loading ExtractHelper...',
         'references': 'References',
+        'timing': 'Timing',
+        'performance': 'Performance',
+        'perf_query': 'Retrieval p50/p95',
+        'perf_ask': 'Ask p50/p95',
+        'perf_embed': 'Embedding',
+        'perf_ingest': 'Ingest',
+        'perf_index': 'Delta / Base',
+        'perf_tombstone': 'Tombstones',
+        'perf_cache': 'Index cache hits',
+        'perf_llm': 'LLM queue / speed',
+        'perf_spec': 'Draft acceptance',
+        'perf_empty': 'No data yet',
+        'profile_mode': 'Profile tasks and answers',
+        'profile_hint': 'Reports are written to data/kb/profiles/',
+        'model': 'Model',
+        'model_default': 'Default',
+        'model_auto': 'Auto (fast model for short questions)',
         'error': 'Error',
         'language': 'Language',
         'docs': 'Docs',
         'chunks': 'Chunks',
+        'index': 'Index',
         'kb_stats_error': 'Stats Error',
         'welcome_title': 'ExtractHelper AI',
         'welcome_subtitle': 'Your local knowledge assistant',
+        'load_earlier': 'Load earlier messages',
+        'compact_index': 'Compact Index',
+        'jobs': 'Jobs',
+        'job_sync': 'Sync',
+        'job_rebuild': 'Rebuild',
+        'job_compact': 'Compact',
+        'eta': 'ETA',
+        'warmup_db': 'Starting...',
+        'warmup_embedder': 'Loading embedding model...',
+        'warmup_index': 'Loading index...',
+        'warmup_llm': 'Loading LLM...',
+        'warmup_ready': '',
     },
     'zh': {
         'kb_management': '资料库管理',
@@ -69,13 +114,43 @@ TRANSLATIONS = {
         'not_helpful': '无帮助',
         'loading': '正在加载 ExtractHelper...',
         'references': '参考资料',
+        'timing': '耗时',
+        'performance': '性能',
+        'perf_query': '检索 p50/p95',
+        'perf_ask': '问答 p50/p95',
+        'perf_embed': '向量化吞吐',
+        'perf_ingest': '入库吞吐',
+        'perf_index': 'Delta / Base',
+        'perf_tombstone': '墓碑比例',
+        'perf_cache': '索引缓存命中',
+        'perf_llm': '大模型排队 / 速度',
+        'perf_spec': '投机解码接受率',
+        'perf_empty': '暂无数据',
+        'profile_mode': '剖析任务与问答',
+        'profile_hint': '报告写入 data/kb/profiles/',
+        'model': '模型',
+        'model_default': '默认',
+        'model_auto': '自动（短问题使用快速模型）',
         'error': '错误',
         'language': '语言设置',
         'docs': '文档',
         'chunks': '切片',
+        'index': '索引',
         'kb_stats_error': '统计错误',
         'welcome_title': 'ExtractHelper AI',
         'welcome_subtitle': '您的本地知识助手',
+        'load_earlier': '加载更早的消息',
+        'compact_index': '压缩索引',
+        'jobs': '后台任务',
+        'job_sync': '同步',
+        'job_rebuild': '重建',
+        'job_compact': '压缩',
+        'eta': '剩余',
+        'warmup_db': '正在启动...',
+        'warmup_embedder': '正在加载向量模型...',
+        'warmup_index': '正在加载索引...',
+        'warmup_llm': '正在加载大模型...',
+        'warmup_ready': '',
     }
 }
 
@@ -191,10 +266,10 @@ def render_drawer_content(drawer_container, core_app, app_state):
         with ui.card().classes('w-full mb-4 bg-white shadow-sm border border-gray-100 p-4 gap-3'):
             ui.label(t('language')).classes('text-xs font-bold text-gray-500 uppercase tracking-wider')
             
-            def set_lang(l):
+            async def set_lang(l):
                 app_state['lang'] = l
                 if 'refresh_ui' in app_state:
-                     app_state['refresh_ui']()
+                     await app_state['refresh_ui']()
 
             with ui.row().classes('w-full items-center gap-2'):
                  ui.button('English', on_click=lambda: set_lang('en')).props(f'flat={"zh" == app_state.get("lang", "zh")} unelevated={"en" == app_state.get("lang", "zh")} color={"indigo" if "en" == app_state.get("lang", "zh") else "grey"} size=sm').classes('flex-grow')
@@ -206,36 +281,50 @@ def render_drawer_content(drawer_container, core_app, app_state):
             with ui.row().classes('w-full items-center gap-4'):
                 ui.slider(min=1, max=20, step=1).bind_value(app_state, 'top_k').classes('flex-grow')
                 ui.label().bind_text_from(app_state, 'top_k').classes('font-mono font-bold w-6 text-right text-xs text-indigo-500')
+            # 模型选择：发现 MODELS_DIR 下的 GGUF 文件，按需加载（见 app.rag.models）
+            ui.label(t('model')).classes('text-xs font-bold text-gray-500 uppercase tracking-wider')
+            model_select = ui.select(
+                {'default': t('model_default'), 'auto': t('model_auto')}
+            ).bind_value(app_state, 'model').props('dense outlined options-dense').classes('w-full text-xs')
+
+        async def refresh_models():
+            try:
+                models = await core_app.list_models()
+            except Exception:
+                return
+            options = {'default': t('model_default'), 'auto': t('model_auto')}
+            for m in models:
+                state = ' ●' if m['loaded'] else ''
+                options[m['name']] = f"{m['name']} ({m['size_mb']:.0f} MB){state}"
+            model_select.options = options
+            model_select.update()
+
+        background_tasks.create(refresh_models())
 
         # 2. 系统状态
         with ui.card().classes('w-full mb-4 bg-white shadow-sm border border-gray-100 p-4'):
             status_label = ui.label(t('fetching')).classes('text-xs font-mono text-gray-600 break-all')
         
-        def refresh_stats():
+        async def refresh_stats():
             try:
-                stats = core_app.kb.get_stats()
-                status_label.set_text(f"{t('docs')}: {stats['documents']} | {t('chunks')}: {stats['chunks']}")
+                stats = await core_app.get_stats()
+                text = f"{t('docs')}: {stats['documents']} | {t('chunks')}: {stats['chunks']}"
+                idx = stats.get('index') or {}
+                if idx.get('base_bytes'):
+                    mem_mb = (idx['base_bytes'] + idx['delta_bytes']) / (1 << 20)
+                    text += f" | {t('index')}: {idx['storage']} {mem_mb:.1f}MB ({idx['compression']:.1f}x)"
+                status_label.set_text(text)
             except Exception as e:
                 status_label.set_text(f"{t('kb_stats_error')}: {e}")
         
-        refresh_stats()
+        background_tasks.create(refresh_stats())
 
         # 3. 操作按钮
         ui.label(t('maintenance')).classes('text-xs font-bold text-gray-400 mb-2 uppercase tracking-wider')
         with ui.column().classes('w-full gap-2'):
-            async def run_kb_task(task_type):
-                log.push(f"[{task_type}] ...")
-                try:
-                    if task_type == 'sync':
-                        await run.io_bound(core_app.kb.sync_folder)
-                    elif task_type == 'rebuild':
-                        await run.io_bound(core_app.kb.rebuild_index)
-                    elif task_type == 'compact':
-                        await run.io_bound(core_app.kb.compact)
-                    log.push(f"[{task_type}] Done")
-                    refresh_stats()
-                except Exception as e:
-                    log.push(f"Error: {e}")
+            def run_kb_task(task_type):
+                # 任务在后台运行（同类任务单飞），进度通过下方任务面板订阅展示
+                core_app.start_job(task_type, profile=app_state.get('profile', False))
 
             with ui.button(on_click=lambda: run_kb_task('sync')).classes('w-full').props('outline size=sm color=teal'):
                 ui.icon('sync', size='xs').classes('mr-2')
@@ -245,164 +334,547 @@ def render_drawer_content(drawer_container, core_app, app_state):
                 ui.icon('build', size='xs').classes('mr-2')
                 ui.label(t('rebuild_index'))
 
-        # 4. 日志
+            with ui.button(on_click=lambda: run_kb_task('compact')).classes('w-full').props('outline size=sm color=indigo'):
+                ui.icon('compress', size='xs').classes('mr-2')
+                ui.label(t('compact_index'))
+
+        # 4. 后台任务
+        ui.label(t('jobs')).classes('text-xs font-bold text-gray-400 mt-4 mb-2 uppercase tracking-wider')
+        jobs_column = ui.column().classes('w-full gap-2')
+
+        # 5. 性能（滚动指标，定时刷新；完整指标见 /metrics）
+        ui.label(t('performance')).classes('text-xs font-bold text-gray-400 mt-4 mb-2 uppercase tracking-wider')
+        with ui.card().classes('w-full bg-white shadow-sm border border-gray-100 p-3'):
+            perf_grid = ui.grid(columns=2).classes('w-full gap-x-3 gap-y-1')
+            # 剖析开关：之后提交的后台任务与问答在剖析下运行，报告路径显示在日志中
+            ui.switch(t('profile_mode')).bind_value(app_state, 'profile').props('dense size=xs color=indigo').classes('text-[11px] text-gray-600 mt-2')
+            ui.label(t('profile_hint')).classes('text-[10px] text-gray-400')
+
+        async def refresh_perf():
+            try:
+                rows = summarize_metrics(await core_app.get_metrics())
+            except Exception as e:
+                rows = [('error', str(e))]
+            perf_grid.clear()
+            with perf_grid:
+                for key, value in rows:
+                    ui.label(t(key)).classes('text-[11px] text-gray-500')
+                    ui.label(value if value is not None else t('perf_empty')).classes('text-[11px] font-mono text-gray-700 text-right')
+
+        background_tasks.create(refresh_perf())
+        ui.timer(PERF_REFRESH_SECONDS, refresh_perf)
+
+        # 6. 日志
         ui.separator().classes('my-4')
         ui.label(t('logs')).classes('text-xs font-bold text-gray-400 mb-2 uppercase tracking-wider')
         log = ui.log(max_lines=200).classes('w-full h-32 text-[10px] bg-gray-900 text-green-400 p-2 rounded font-mono shadow-inner leading-tight')
-        
-        # 简单劫持 stdout
-        class LogElementWriter:
-            def write(self, text):
-                if text.strip(): log.push(text.strip())
-            def flush(self): pass
-        sys.stdout = LogElementWriter()
 
+        panel = JobPanel(jobs_column, log, core_app, t, on_finished=refresh_stats)
+        # 重新渲染（切换语言）时先退订旧面板
+        if app_state.get('jobs_unsubscribe'):
+            app_state['jobs_unsubscribe']()
+        app_state['jobs_unsubscribe'] = core_app.subscribe_jobs(panel.update)
+        for event in core_app.list_jobs():
+            panel.update(event, replay=True)
 
-def render_left_drawer(drawer, core_app, app_state, load_session_callback):
-    """渲染左侧会话列表"""
-    t = lambda k: TRANSLATIONS[app_state.get('lang', 'zh')][k]
-    drawer.clear()
-    with drawer:
-        # 1. New Chat Button (Prominent)
-        with ui.button(on_click=lambda: load_session_callback(None)).classes('mx-3 mt-4 mb-6 rounded-xl shadow-sm border border-gray-200 hover:shadow-md transition-all duration-300').props('unelevated color=white text-color=grey-9'):
-            with ui.row().classes('items-center gap-3 w-full py-2 justify-center'):
-                ui.icon('add', size='xs').classes('text-indigo-500')
-                ui.label(t('new_chat')).classes('text-sm font-bold tracking-wide text-gray-700')
-        
-        # 2. Session List
-        ui.label(t('history')).classes('text-xs font-bold text-gray-400 mb-3 px-4 uppercase tracking-wider')
-        
-        sessions = core_app.chat_manager.list_sessions()
-        
-        with ui.scroll_area().classes('w-full flex-grow px-3'): 
-            with ui.column().classes('w-full gap-1'):
-                for s in sessions:
-                    sid = s['id']
-                    title = s['title'] or "未命名会话"
-                    is_active = app_state.get('current_session_id') == sid
-                    
-                    # Style: Clean, simple rows with subtle hover
-                    row_classes = 'w-full items-center justify-between rounded-lg group transition-all duration-200 cursor-pointer h-10 px-3 '
-                    if is_active:
-                        row_classes += 'bg-indigo-50 text-indigo-900 font-medium'
-                    else:
-                        row_classes += 'hover:bg-gray-50 text-gray-700'
-                    
-                    with ui.row().classes(row_classes):
-                        # Title with icon
-                        with ui.row().classes('items-center gap-3 flex-grow overflow-hidden'):
-                            ui.icon('chat_bubble_outline', size='xs').classes('text-gray-400')
-                            ui.label(title).classes('text-sm truncate flex-grow').on('click', lambda i=sid: load_session_callback(i))
-                        
-                        # Actions Logic
-                        async def delete_handler(i=sid):
-                            core_app.chat_manager.delete_session(i)
-                            if app_state.get('current_session_id') == i:
-                                load_session_callback(None)
-                            else:
-                                render_left_drawer(drawer, core_app, app_state, load_session_callback)
-
-                        def rename_session(i, new_title):
-                            if new_title and new_title.strip():
-                                core_app.chat_manager.update_title(i, new_title.strip())
-                                render_left_drawer(drawer, core_app, app_state, load_session_callback)
-
-                        def open_rename_dialog(i, current_title):
-                            with ui.dialog() as dialog, ui.card().classes('min-w-[320px] p-6 rounded-2xl shadow-xl'):
-                                ui.label(t('rename_session')).classes('text-lg font-bold mb-4 text-gray-800')
-                                name_input = ui.input(value=current_title).classes('w-full mb-6').props('autofocus outlined rounded dense')
-                                with ui.row().classes('w-full justify-end gap-3'):
-                                    ui.button(t('cancel'), on_click=dialog.close).props('flat color=grey rounded')
-                                    ui.button(t('save'), on_click=lambda: [rename_session(i, name_input.value), dialog.close()]).props('unelevated color=indigo rounded')
-                            dialog.on('close', dialog.delete)
-                            dialog.open()
-
-                        # More Options Menu
-                        btn_color = 'text-indigo-400' if is_active else 'text-gray-400'
-                        with ui.button(icon='more_vert').props('flat round size=xs').classes(f'opacity-0 group-hover:opacity-100 transition-opacity {btn_color}'):
-                            with ui.menu().classes('shadow-xl border border-gray-100 rounded-xl p-1 min-w-[140px] bg-white'):
-                                with ui.menu_item(on_click=lambda i=sid, t=title: open_rename_dialog(i, t)).classes('rounded-lg hover:bg-gray-50 transition-colors'):
-                                    with ui.row().classes('items-center gap-3 w-full px-2 py-1'):
-                                        ui.icon('edit', size='xs').classes('text-gray-500')
-                                        ui.label(t('rename')).classes('text-sm text-gray-700 font-medium')
-                                
-                                with ui.menu_item(on_click=lambda i=sid: delete_handler(i)).classes('rounded-lg hover:bg-red-50 transition-colors'):
-                                    with ui.row().classes('items-center gap-3 w-full px-2 py-1'):
-                                        ui.icon('delete', size='xs').classes('text-red-500')
-                                        ui.label(t('delete')).classes('text-sm text-red-500 font-medium')
-
-
-def render_chat_messages(container, history, app_state=None):
-    """渲染历史消息列表"""
-    lang = app_state.get('lang', 'zh') if app_state else 'zh'
-    t = lambda k: TRANSLATIONS[lang][k]
-    
-    container.clear()
-    with container:
-        if not history:
-             # 空状态 - 居中 Logo
-             with ui.column().classes('w-full items-center justify-center mt-24 opacity-0 animate-fade-in'):
-                # 现代风格的 Logo / 欢迎页
-                with ui.card().classes('w-24 h-24 rounded-3xl bg-indigo-500 items-center justify-center shadow-lg mb-6 flex'):
-                    ui.icon('auto_awesome', size='3rem', color='white')
-                ui.label(t('welcome_title')).classes('text-3xl font-bold text-gray-800 tracking-tight')
-                ui.label(t('welcome_subtitle')).classes('text-gray-400 font-medium text-sm mt-2')
-             return
-
-        # 消息流
-        for msg in history:
-            role = msg['role']
-            content = msg['content']
-            evidence = msg.get('evidence')
-            
-            # Message Container
-            with ui.row().classes('w-full mb-6 animate-fade-in group items-start'):
-                if role == 'user':
-                    # User: Right side
-                    with ui.row().classes('w-full justify-end gap-4'):
-                        with ui.column().classes('items-end max-w-[85%]'):
-                            with ui.card().classes('bg-[#e0e7ff] px-5 py-3.5 rounded-2xl rounded-tr-sm shadow-sm border border-indigo-100/50'):
-                                ui.label(content).classes('text-gray-800 text-base leading-relaxed whitespace-pre-wrap')
-                        ui.avatar(icon='person', color='indigo-100', text_color='indigo-600').classes('mt-1 shadow-sm ring-2 ring-indigo-50')
-                else:
-                    # AI: Left side
-                    with ui.row().classes('w-full justify-start gap-4 px-2'):
-                        ui.avatar(icon='auto_awesome', color='indigo-600', text_color='white').classes('mt-1 shadow-md ring-2 ring-indigo-50')
-                        
-                        with ui.column().classes('flex-grow min-w-0 max-w-4xl gap-1'):
-                            # AI Name
-                            ui.label('ExtractHelper').classes('font-bold text-sm text-gray-900 ml-1')
-                            
-                            # Content Bubble (Transparent for AI, Markdown)
-                            # 使用 markdown-body 类应用自定义样式
-                            ui.markdown(content).classes('markdown-body text-gray-800 text-base leading-relaxed w-full overflow-hidden')
-                            
-                            # Evidence Section (Styled)
-                            if evidence:
-                                 with ui.expansion(f'{t("references")} ({len(evidence)})', icon='menu_book').classes('w-full bg-white border border-gray-200 rounded-xl text-xs text-gray-500 mt-3 shadow-sm hover:shadow-md transition-shadow duration-300'):
-                                        with ui.column().classes('gap-3 p-3 bg-gray-50'):
-                                            for i, e in enumerate(evidence, 1):
-                                                with ui.link(target='#').classes('no-underline group/link w-full bg-white p-2 rounded-lg border border-gray-100 hover:border-indigo-300 transition-colors'):
-                                                    with ui.row().classes('items-center gap-2 mb-1'):
-                                                        ui.label(f"#{i}").classes('font-mono font-bold text-xs text-indigo-500 bg-indigo-50 px-1.5 rounded')
-                                                        ui.label(e['filename']).classes('font-bold text-xs text-gray-700 truncate flex-grow')
-                                                        ui.label(f"Score: {e['score']:.2f}").classes('text-[10px] text-gray-400')
-                                                    ui.label(e.get('snippet', '').strip()[:120] + '...').classes('text-[11px] text-gray-500 leading-relaxed font-mono pl-1')
-
-                            # Action Bar
-                            with ui.row().classes('gap-1 mt-2 ml-1 opacity-0 group-hover:opacity-100 transition-opacity duration-200'):
-                                with ui.button(icon='content_copy', on_click=lambda c=content: ui.clipboard.write(c)).props('flat round size=xs color=grey'):
-                                    ui.tooltip(t('copy'))
-                                with ui.button(icon='thumb_up_off_alt').props('flat round size=xs color=grey'):
-                                    ui.tooltip(t('helpful'))
-                                with ui.button(icon='thumb_down_off_alt').props('flat round size=xs color=grey'):
-                                    ui.tooltip(t('not_helpful'))
+
+def summarize_metrics(snap):
+    """
+    将指标快照整理为性能卡片的 (翻译键, 显示文本) 行，没有样本的项显示为 None。
+    :param snap: AsyncExtractHelperApp.get_metrics() 的结果
+    """
+    def pct_ms(name):
+        h = snap.get(name) or {}
+        if not h.get('count'):
+            return None
+        return f"{h['p50'] * 1000:.0f} / {h['p95'] * 1000:.0f} ms"
+
+    def rate(count, seconds, unit):
+        return f"{count / seconds:.1f} {unit}/s" if count and seconds else None
+
+    ingest = snap.get('extracthelper_ingest_file_seconds') or {}
+    hits = snap.get('extracthelper_shard_cache_hits_total', 0) + snap.get('extracthelper_delta_cache_hits_total', 0)
+    misses = snap.get('extracthelper_shard_cache_misses_total', 0) + snap.get('extracthelper_delta_cache_misses_total', 0)
+    speed = (snap.get('extracthelper_llm_tokens_per_second') or {}).get('p50')
+    base = snap.get('extracthelper_index_base_vectors')
+    delta = snap.get('extracthelper_index_delta_vectors')
+    tombstone = snap.get('extracthelper_index_tombstone_ratio')
+    proposed = snap.get('extracthelper_llm_draft_proposed_total', 0)
+    accepted = snap.get('extracthelper_llm_draft_accepted_total', 0)
+    return [
+        ('perf_query', pct_ms('extracthelper_retrieval_seconds')),
+        ('perf_ask', pct_ms('extracthelper_ask_seconds')),
+        ('perf_embed', rate(snap.get('extracthelper_embed_texts_total'), snap.get('extracthelper_embed_seconds_total'), 'texts')),
+        ('perf_ingest', rate(ingest.get('count'), ingest.get('sum'), 'files')),
+        ('perf_index', f"{int(delta)} / {int(base)} ({snap.get('extracthelper_index_delta_ratio', 0):.1%})" if base is not None else None),
+        ('perf_tombstone', f"{tombstone:.1%}" if tombstone is not None else None),
+        ('perf_cache', f"{hits / (hits + misses):.1%}" if hits + misses else None),
+        ('perf_llm', f"{int(snap.get('extracthelper_llm_queue_depth', 0))} / " + (f"{speed:.1f} tok/s" if speed else '-')),
+        ('perf_spec', f"{accepted / proposed:.1%} ({int(accepted)} / {int(proposed)})" if proposed else None),
+    ]
+
+
+class JobPanel:
+    """
+    后台任务面板：订阅任务事件，显示阶段、进度、吞吐与剩余时间，运行中可取消。
+    """
+    def __init__(self, container, log, core_app, t, on_finished=None):
+        self.container = container
+        self.log = log
+        self.core_app = core_app
+        self.t = t
+        self.on_finished = on_finished
+        self.rows = {}  # job id -> (label, progress, cancel_button)
+        self.last_message = {}
+
+    def update(self, event, replay=False):
+        """处理一条任务事件（在事件循环中调用）"""
+        jid = event['id']
+        if jid not in self.rows:
+            with self.container:
+                with ui.column().classes('w-full gap-1 bg-gray-50 rounded-lg p-2 border border-gray-100') as box:
+                    with ui.row().classes('w-full items-center justify-between no-wrap'):
+                        label = ui.label().classes('text-[11px] font-mono text-gray-600 truncate')
+                        cancel = ui.button(icon='close', on_click=lambda j=jid: self.core_app.cancel_job(j)).props('flat round size=xs color=grey')
+                        cancel.tooltip(self.t('cancel'))
+                    progress = ui.linear_progress(value=0, show_value=False).props('rounded color=indigo')
+            box.move(self.container, target_index=0)
+            self.rows[jid] = (label, progress, cancel)
+
+        label, progress, cancel = self.rows[jid]
+        label.set_text(self._describe(event))
+        progress.set_value(event['done'] / event['total'] if event['total'] else 0)
+        running = event['state'] in ('pending', 'running')
+        cancel.set_visibility(running)
+        progress.set_visibility(running)
+
+        if replay:
+            return
+        name = self.t(f"job_{event['type']}")
+        msg = event.get('message')
+        if msg and self.last_message.get(jid) != msg:
+            self.last_message[jid] = msg
+            self.log.push(f"[{name}] {msg}")
+        if not running:
+            self.log.push(f"[{name}] {event['state']}" + (f": {event['error']}" if event.get('error') else ''))
+            if self.on_finished is not None:
+                return self.on_finished()
+
+    def _describe(self, event):
+        text = f"{self.t('job_' + event['type'])} · {event['state']}"
+        if event['stage']:
+            text += f" · {event['stage']}"
+        if event['total']:
+            text += f" {event['done']}/{event['total']} {event['unit']}"
+        if event['rate'] and event['state'] == 'running':
+            text += f" · {event['rate']:.1f}/s"
+        if event['eta'] is not None and event['state'] == 'running':
+            text += f" · {self.t('eta')} {int(event['eta'])}s"
+        return text
+
+
+class SessionList:
+    """
+    左侧会话列表
+    - 首次只加载一页会话，滚动到底部时再按 updated_at 游标加载下一页；
+    - 重命名 / 删除 / 切换会话只原地更新对应行，不重建整个抽屉。
+    """
+    def __init__(self, drawer, core_app, app_state, load_session_callback):
+        self.drawer = drawer
+        self.core_app = core_app
+        self.app_state = app_state
+        self.load_session_callback = load_session_callback
+        self.rows = {}  # sid -> (row, title_label, icon)
+        self.column = None
+        self.cursor = None  # 已加载的最后一个会话的 (updated_at, id)
+        self.has_more = False
+
+    def t(self, k):
+        return TRANSLATIONS[self.app_state.get('lang', 'zh')][k]
+
+    async def render(self):
+        """渲染抽屉框架与第一页会话（初始化 / 切换语言时调用）"""
+        t = self.t
+        self.drawer.clear()
+        self.rows = {}
+        self.cursor = None
+        with self.drawer:
+            # 1. New Chat Button (Prominent)
+            with ui.button(on_click=lambda: self.load_session_callback(None)).classes('mx-3 mt-4 mb-6 rounded-xl shadow-sm border border-gray-200 hover:shadow-md transition-all duration-300').props('unelevated color=white text-color=grey-9'):
+                with ui.row().classes('items-center gap-3 w-full py-2 justify-center'):
+                    ui.icon('add', size='xs').classes('text-indigo-500')
+                    ui.label(t('new_chat')).classes('text-sm font-bold tracking-wide text-gray-700')
+
+            # 2. Session List
+            ui.label(t('history')).classes('text-xs font-bold text-gray-400 mb-3 px-4 uppercase tracking-wider')
+
+            scroll = ui.scroll_area().classes('w-full flex-grow px-3')
+            scroll.on_scroll(self._on_scroll)
+            with scroll:
+                self.column = ui.column().classes('w-full gap-1')
+        await self.load_more()
+
+    async def _on_scroll(self, e):
+        if e.vertical_percentage > 0.9:
+            await self.load_more()
+
+    async def load_more(self):
+        """加载下一页会话并追加到列表末尾"""
+        if self.cursor is not None and not self.has_more:
+            return
+        sessions = await self.core_app.list_sessions(before=self.cursor, limit=SESSION_PAGE_SIZE)
+        self.has_more = len(sessions) >= SESSION_PAGE_SIZE
+        if sessions:
+            self.cursor = (sessions[-1]['updated_at'], sessions[-1]['id'])
+        for s in sessions:
+            if s['id'] not in self.rows:
+                self._render_row(s)
+
+    def prepend(self, session):
+        """新建会话后插入到列表顶部"""
+        self._render_row(session)
+        self.rows[session['id']][0].move(self.column, target_index=0)
+        self.set_active(session['id'])
+
+    def set_active(self, session_id):
+        """只更新行的高亮样式"""
+        for sid, (row, _, btn) in self.rows.items():
+            active = sid == session_id
+            row.classes(
+                add='bg-indigo-50 text-indigo-900 font-medium' if active else 'hover:bg-gray-50 text-gray-700',
+                remove='hover:bg-gray-50 text-gray-700' if active else 'bg-indigo-50 text-indigo-900 font-medium',
+            )
+            btn.classes(
+                add='text-indigo-400' if active else 'text-gray-400',
+                remove='text-gray-400' if active else 'text-indigo-400',
+            )
+
+    def _render_row(self, s):
+        t = self.t
+        sid = s['id']
+        title = s['title'] or "未命名会话"
+        is_active = self.app_state.get('current_session_id') == sid
+
+        # Style: Clean, simple rows with subtle hover
+        row_classes = 'w-full items-center justify-between rounded-lg group transition-all duration-200 cursor-pointer h-10 px-3 '
+        if is_active:
+            row_classes += 'bg-indigo-50 text-indigo-900 font-medium'
+        else:
+            row_classes += 'hover:bg-gray-50 text-gray-700'
+
+        with self.column:
+            with ui.row().classes(row_classes) as row:
+                # Title with icon
+                with ui.row().classes('items-center gap-3 flex-grow overflow-hidden'):
+                    ui.icon('chat_bubble_outline', size='xs').classes('text-gray-400')
+                    title_label = ui.label(title).classes('text-sm truncate flex-grow').on('click', lambda i=sid: self.load_session_callback(i))
+
+                # More Options Menu
+                btn_color = 'text-indigo-400' if is_active else 'text-gray-400'
+                with ui.button(icon='more_vert').props('flat round size=xs').classes(f'opacity-0 group-hover:opacity-100 transition-opacity {btn_color}') as btn:
+                    with ui.menu().classes('shadow-xl border border-gray-100 rounded-xl p-1 min-w-[140px] bg-white'):
+                        with ui.menu_item(on_click=lambda i=sid: self.open_rename_dialog(i)).classes('rounded-lg hover:bg-gray-50 transition-colors'):
+                            with ui.row().classes('items-center gap-3 w-full px-2 py-1'):
+                                ui.icon('edit', size='xs').classes('text-gray-500')
+                                ui.label(t('rename')).classes('text-sm text-gray-700 font-medium')
+
+                        with ui.menu_item(on_click=lambda i=sid: self.delete_session(i)).classes('rounded-lg hover:bg-red-50 transition-colors'):
+                            with ui.row().classes('items-center gap-3 w-full px-2 py-1'):
+                                ui.icon('delete', size='xs').classes('text-red-500')
+                                ui.label(t('delete')).classes('text-sm text-red-500 font-medium')
+        self.rows[sid] = (row, title_label, btn)
+
+    # Actions Logic
+    async def delete_session(self, sid):
+        await self.core_app.delete_session(sid)
+        entry = self.rows.pop(sid, None)
+        if entry is not None:
+            entry[0].delete()
+        if self.app_state.get('current_session_id') == sid:
+            await self.load_session_callback(None)
+
+    async def rename_session(self, sid, new_title):
+        if new_title and new_title.strip():
+            await self.core_app.rename_session(sid, new_title.strip())
+            if sid in self.rows:
+                self.rows[sid][1].set_text(new_title.strip())
+
+    def open_rename_dialog(self, sid):
+        t = self.t
+        current_title = self.rows[sid][1].text if sid in self.rows else ''
+        with ui.dialog() as dialog, ui.card().classes('min-w-[320px] p-6 rounded-2xl shadow-xl'):
+            ui.label(t('rename_session')).classes('text-lg font-bold mb-4 text-gray-800')
+            name_input = ui.input(value=current_title).classes('w-full mb-6').props('autofocus outlined rounded dense')
+            with ui.row().classes('w-full justify-end gap-3'):
+                ui.button(t('cancel'), on_click=dialog.close).props('flat color=grey rounded')
+                async def save():
+                    dialog.close()
+                    await self.rename_session(sid, name_input.value)
+                ui.button(t('save'), on_click=save).props('unelevated color=indigo rounded')
+        dialog.on('close', dialog.delete)
+        dialog.open()
+
+
+def render_welcome(t):
+    """空会话欢迎页 - 居中 Logo"""
+    with ui.column().classes('w-full items-center justify-center mt-24 opacity-0 animate-fade-in') as welcome:
+        # 现代风格的 Logo / 欢迎页
+        with ui.card().classes('w-24 h-24 rounded-3xl bg-indigo-500 items-center justify-center shadow-lg mb-6 flex'):
+            ui.icon('auto_awesome', size='3rem', color='white')
+        ui.label(t('welcome_title')).classes('text-3xl font-bold text-gray-800 tracking-tight')
+        ui.label(t('welcome_subtitle')).classes('text-gray-400 font-medium text-sm mt-2')
+    return welcome
+
+
+def render_evidence_items(evidence):
+    """渲染参考资料列表（在引用面板首次展开时调用）"""
+    with ui.column().classes('gap-3 p-3 bg-gray-50'):
+        for i, e in enumerate(evidence, 1):
+            with ui.link(target='#').classes('no-underline group/link w-full bg-white p-2 rounded-lg border border-gray-100 hover:border-indigo-300 transition-colors'):
+                with ui.row().classes('items-center gap-2 mb-1'):
+                    ui.label(f"#{i}").classes('font-mono font-bold text-xs text-indigo-500 bg-indigo-50 px-1.5 rounded')
+                    ui.label(e['filename']).classes('font-bold text-xs text-gray-700 truncate flex-grow')
+                    ui.label(f"Score: {e['score']:.2f}").classes('text-[10px] text-gray-400')
+                ui.label(e.get('snippet', '').strip()[:120] + '...').classes('text-[11px] text-gray-500 leading-relaxed font-mono pl-1')
+                # 去重后内容相同 / 近似的其他出处
+                if e.get('also_in'):
+                    names = ', '.join(dict.fromkeys(d['filename'] for d in e['also_in']))
+                    ui.label(f"+ {names}").classes('text-[10px] text-gray-400 truncate pl-1')
+
+
+def render_timing_items(timings):
+    """渲染各阶段耗时（在耗时面板首次展开时调用）"""
+    total = timings.get('total_ms') or 0
+    with ui.column().classes('gap-1 p-3 bg-gray-50 w-full'):
+        for name, ms in (timings.get('spans') or {}).items():
+            with ui.row().classes('items-center gap-2 w-full no-wrap'):
+                ui.label(name).classes('font-mono text-[11px] text-gray-600 w-28 shrink-0')
+                ui.linear_progress(value=ms / total if total else 0, show_value=False, color='indigo').classes('flex-grow')
+                ui.label(f'{ms:.0f} ms').classes('font-mono text-[11px] text-gray-500 w-20 text-right shrink-0')
+        values = timings.get('values') or {}
+        if values:
+            ui.label('  '.join(f'{k}={v}' for k, v in values.items())).classes('font-mono text-[11px] text-gray-500 pt-1')
+
+
+def render_message(msg, t, fetch_evidence=None):
+    """
+    渲染单条消息，返回其最外层元素。
+    参考资料在面板首次展开时才创建，避免长会话一次性生成大量元素；
+    从数据库分页加载的消息只带 evidence_count，展开时再通过 fetch_evidence(message_id) 读取。
+    """
+    role = msg['role']
+    content = msg['content']
+    evidence = msg.get('evidence')
+    ev_count = len(evidence) if evidence else int(msg.get('evidence_count') or 0)
+
+    # Message Container
+    with ui.row().classes('w-full mb-6 animate-fade-in group items-start') as row:
+        if role == 'user':
+            # User: Right side
+            with ui.row().classes('w-full justify-end gap-4'):
+                with ui.column().classes('items-end max-w-[85%]'):
+                    with ui.card().classes('bg-[#e0e7ff] px-5 py-3.5 rounded-2xl rounded-tr-sm shadow-sm border border-indigo-100/50'):
+                        ui.label(content).classes('text-gray-800 text-base leading-relaxed whitespace-pre-wrap')
+                ui.avatar(icon='person', color='indigo-100', text_color='indigo-600').classes('mt-1 shadow-sm ring-2 ring-indigo-50')
+        else:
+            # AI: Left side
+            with ui.row().classes('w-full justify-start gap-4 px-2'):
+                ui.avatar(icon='auto_awesome', color='indigo-600', text_color='white').classes('mt-1 shadow-md ring-2 ring-indigo-50')
+
+                with ui.column().classes('flex-grow min-w-0 max-w-4xl gap-1'):
+                    # AI Name
+                    ui.label('ExtractHelper').classes('font-bold text-sm text-gray-900 ml-1')
+
+                    # Content Bubble (Transparent for AI, Markdown)
+                    # 使用 markdown-body 类应用自定义样式
+                    ui.markdown(content).classes('markdown-body text-gray-800 text-base leading-relaxed w-full overflow-hidden')
+
+                    # Evidence Section (Styled, lazily filled)
+                    if ev_count:
+                        exp = ui.expansion(f'{t("references")} ({ev_count})', icon='menu_book').classes('w-full bg-white border border-gray-200 rounded-xl text-xs text-gray-500 mt-3 shadow-sm hover:shadow-md transition-shadow duration-300')
+
+                        async def fill_evidence(e, exp=exp):
+                            if e.value and not exp.default_slot.children:
+                                if msg.get('evidence') is None and fetch_evidence and msg.get('id'):
+                                    msg['evidence'] = await fetch_evidence(msg['id'])
+                                    if exp.default_slot.children:
+                                        return
+                                with exp:
+                                    render_evidence_items(msg.get('evidence') or [])
+
+                        exp.on_value_change(fill_evidence)
+
+                    # Timing Section（各阶段耗时，展开时才渲染）
+                    timings = msg.get('timings')
+                    if timings:
+                        texp = ui.expansion(f"{t('timing')} ({(timings.get('total_ms') or 0) / 1000:.1f}s)", icon='timer').classes('w-full bg-white border border-gray-200 rounded-xl text-xs text-gray-500 mt-1 shadow-sm')
+
+                        def fill_timing(e, texp=texp, timings=timings):
+                            if e.value and not texp.default_slot.children:
+                                with texp:
+                                    render_timing_items(timings)
+
+                        texp.on_value_change(fill_timing)
+
+                    # Action Bar
+                    with ui.row().classes('gap-1 mt-2 ml-1 opacity-0 group-hover:opacity-100 transition-opacity duration-200'):
+                        with ui.button(icon='content_copy', on_click=lambda c=content: ui.clipboard.write(c)).props('flat round size=xs color=grey'):
+                            ui.tooltip(t('copy'))
+                        with ui.button(icon='thumb_up_off_alt').props('flat round size=xs color=grey'):
+                            ui.tooltip(t('helpful'))
+                        with ui.button(icon='thumb_down_off_alt').props('flat round size=xs color=grey'):
+                            ui.tooltip(t('not_helpful'))
+    return row
+
+
+class ChatView:
+    """
+    聊天消息视图（仅追加）
+    - 新消息只追加自己的元素，不重建整个列表；
+    - 加载中的 spinner 原地移除；
+    - 打开会话时只加载并渲染最近 CHAT_RENDER_WINDOW 条，向上滚动到顶部时再分页读取更早的消息。
+    """
+    def __init__(self, container, scroll, app_state, fetch_older=None, fetch_evidence=None):
+        """
+        :param fetch_older: async fetch_older((created_at, id)) -> 更早一页消息（按时间正序）
+        :param fetch_evidence: async fetch_evidence(message_id) -> 该消息的引用资料列表
+        """
+        self.container = container
+        self.scroll = scroll
+        self.app_state = app_state
+        self.fetch_older = fetch_older
+        self.fetch_evidence = fetch_evidence
+        self.history = []
+        self.first_rendered = 0  # 已渲染的最早一条消息在 history 中的下标
+        self.has_more = False  # 数据库中是否还有未加载的更早消息
+        self.welcome = None
+        self.loader = None
+        self.spinner = None
+        scroll.on_scroll(self._on_scroll)
+
+    def t(self, k):
+        return TRANSLATIONS[self.app_state.get('lang', 'zh')][k]
+
+    def reset(self, history, has_more=False):
+        """
+        整体重绘（切换会话 / 切换语言时调用），只渲染最近一个窗口
+        :param has_more: history 之前数据库中是否还有更早的消息
+        """
+        self.history = history
+        self.has_more = has_more
+        self.container.clear()
+        self.welcome = self.loader = self.spinner = None
+        self.first_rendered = max(0, len(history) - CHAT_RENDER_WINDOW)
+        with self.container:
+            if not history:
+                self.welcome = render_welcome(self.t)
+                return
+            for msg in history[self.first_rendered:]:
+                render_message(msg, self.t, self.fetch_evidence)
+        self._update_loader()
+
+    def append(self, msg):
+        """追加一条已加入 history 的消息"""
+        if self.welcome is not None:
+            self.welcome.delete()
+            self.welcome = None
+        with self.container:
+            render_message(msg, self.t, self.fetch_evidence)
+        self.scroll.scroll_to(percent=1.0, duration=0.2)
+
+    def show_spinner(self):
+        with self.container:
+            with ui.row().classes('w-full items-start gap-4 animate-fade-in') as self.spinner:
+                ui.avatar(icon='smart_toy', color='white', text_color='teal-600').classes('size-8 border border-gray-200 mt-1')
+                ui.spinner(size='1.5rem', color='teal').classes('mt-2')
+        self.scroll.scroll_to(percent=1.0, duration=0.2)
+
+    def remove_spinner(self):
+        if self.spinner is not None:
+            self.spinner.delete()
+            self.spinner = None
+
+    async def load_earlier(self):
+        """在顶部补渲染更早的一批消息；内存中已全部渲染时从数据库读取上一页"""
+        if self.first_rendered <= 0:
+            if not self.has_more or self.fetch_older is None or not self.history:
+                return
+            older = await self.fetch_older((self.history[0]['created_at'], self.history[0]['id']))
+            self.has_more = len(older) >= CHAT_RENDER_WINDOW
+            if not older:
+                self._update_loader()
+                return
+            # 原地扩展 history（app_state 持有同一个列表）
+            self.history[:0] = older
+            self.first_rendered = len(older)
+        start = max(0, self.first_rendered - CHAT_RENDER_WINDOW)
+        offset = 1 if self.loader is not None else 0
+        with self.container:
+            for i, msg in enumerate(self.history[start:self.first_rendered]):
+                render_message(msg, self.t, self.fetch_evidence).move(self.container, target_index=offset + i)
+        self.first_rendered = start
+        self._update_loader()
+
+    def _update_loader(self):
+        """顶部"加载更早消息"按钮：仍有未渲染或未加载的消息时显示"""
+        if self.first_rendered <= 0 and not self.has_more:
+            if self.loader is not None:
+                self.loader.delete()
+                self.loader = None
+            return
+        label = f"{self.t('load_earlier')} ({self.first_rendered})" if self.first_rendered else self.t('load_earlier')
+        if self.loader is None:
+            with self.container:
+                self.loader = ui.button(label, on_click=self.load_earlier).props('flat size=sm color=grey').classes('mx-auto mb-4')
+            self.loader.move(self.container, target_index=0)
+        else:
+            self.loader.set_text(label)
+
+    async def _on_scroll(self, e):
+        if e.vertical_position < 40 and (self.first_rendered > 0 or self.has_more):
+            await self.load_earlier()
 
 
 # -----------------------------------------------------------------------------
 # 页面入口
 # -----------------------------------------------------------------------------
 
+async def _create_app_instance():
+    """
+    分阶段启动：
+    1. 在子线程中导入 app_core 并初始化数据库（不加载 torch / faiss 模型 / llama.cpp），完成后 UI 即可使用；
+    2. 后台依次预热 embedder -> index -> llm，状态显示在顶栏。
+    """
+    print("Initializing AppCore in background thread...")
+    module = await run.io_bound(importlib.import_module, 'app.app_core')
+    core = await module.AsyncExtractHelperApp.create()
+    print("AppCore initialized successfully.")
+
+    def on_stage(stage):
+        WARMUP_STATUS['stage'] = stage
+        print(f"[warmup] {stage}")
+    background_tasks.create(core.warm_up(on_stage=on_stage), name='warm_up')
+    return core
+
+
+async def get_app_core():
+    """返回全局 AsyncExtractHelperApp，首次调用时初始化（多个页面与 HTTP API 共用同一次初始化）"""
+    global app_core, _app_core_init
+    if app_core is None:
+        if _app_core_init is None:
+            _app_core_init = asyncio.ensure_future(_create_app_instance())
+        try:
+            app_core = await asyncio.shield(_app_core_init)
+        except Exception:
+            _app_core_init = None
+            raise
+    return app_core
+
+
+# HTTP JSON API（/api/search、/api/ask、/api/ingest）
+register_api(app, get_app_core)
+
+
 @ui.page('/')
 async def main_page():
     global app_core
@@ -413,6 +885,8 @@ async def main_page():
         'history': [],
         'top_k': 5,
         'kb_enabled': True,
+        'profile': False,
+        'model': 'default',
         'lang': 'zh'
     }
     
@@ -441,6 +915,8 @@ async def main_page():
              ui.icon('auto_awesome', size='xs').classes('text-indigo-500')
              ui.label('ExtractHelper').classes('text-lg font-bold text-gray-700 tracking-tight')
              ui.badge('1.0', color='indigo-100', text_color='indigo-500').props('rounded').classes('text-[10px] font-bold px-1.5')
+             # 预热状态（embedder / index / llm 依次加载，完成后隐藏）
+             ui.label().bind_text_from(WARMUP_STATUS, 'stage', backward=lambda s: t(f'warmup_{s}')).classes('text-[11px] text-gray-400 animate-pulse')
         
         # Right: Settings
         with ui.row().classes('items-center gap-1'):
@@ -460,6 +936,13 @@ async def main_page():
             # 初始渲染 Loading 或 欢迎页
             # (将在 init_task 中填充)
 
+        chat_view = ChatView(
+            chat_container, chat_scroll, app_state,
+            fetch_older=lambda before: app_core.get_history(
+                app_state['current_session_id'], before=before, limit=CHAT_RENDER_WINDOW),
+            fetch_evidence=lambda mid: app_core.get_evidence(mid),
+        )
+
     # C. Input Area in Footer
     # 使用 footer 保证始终在底部，且宽度自适应
     with ui.footer().classes('bg-transparent p-0 mb-6 border-none pointer-events-none'):
@@ -476,45 +959,53 @@ async def main_page():
                     if not text: return
                     text_input.value = ''
                     
-                    # 1. User Msg
-                    app_state['history'].append({'role': 'user', 'content': text})
-                    render_chat_messages(chat_container, app_state['history'], app_state)
-                    chat_scroll.scroll_to(percent=1.0, duration=0.2)
+                    # 1. User Msg (只追加新消息)
+                    user_msg = {'role': 'user', 'content': text}
+                    app_state['history'].append(user_msg)
+                    chat_view.append(user_msg)
                     
                     # 2. Session Logic
                     if app_state['current_session_id'] is None:
                         title = text[:20] + "..." if len(text) > 20 else text
-                        sid = app_core.chat_manager.create_new_session(title)
+                        sid = await app_core.create_session(title)
                         app_state['current_session_id'] = sid
-                        app_core.chat_manager.add_user_message(sid, text)
-                        render_left_drawer(left_drawer, app_core, app_state, load_session)
+                        user_msg['id'] = await app_core.add_user_message(sid, text)
+                        session_list.prepend({'id': sid, 'title': title})
                     else:
-                        app_core.chat_manager.add_user_message(app_state['current_session_id'], text)
+                        sid = app_state['current_session_id']
+                        user_msg['id'] = await app_core.add_user_message(sid, text)
                     
                     # 3. Loading
-                    spinner_id = f'spinner_{int(time.time())}'
-                    with chat_container:
-                        with ui.row().classes('w-full items-start gap-4 animate-fade-in').id(spinner_id):
-                             ui.avatar(icon='smart_toy', color='white', text_color='teal-600').classes('size-8 border border-gray-200 mt-1')
-                             ui.spinner(size='1.5rem', color='teal').classes('mt-2')
-                    chat_scroll.scroll_to(percent=1.0, duration=0.2)
+                    chat_view.show_spinner()
                     
                     # 4. RAG Task
                     try:
                         k = app_state['top_k']
-                        context_history = app_state['history'][:-1]
-                        ans, ev, _ = await run.io_bound(app_core.rag.ask, text, history=context_history, top_k=k)
+                        context_history = [{'role': m['role'], 'content': m['content']} for m in app_state['history'][:-1]]
+                        # 页面关闭时取消生成（见 client.on_delete）
+                        trace = Trace()
+                        task = asyncio.ensure_future(app_core.ask(
+                            text, history=context_history, top_k=k, trace=trace,
+                            profile=app_state['profile'], model=app_state['model']))
+                        inflight.add(task)
+                        try:
+                            ans, ev, _ = await task
+                        finally:
+                            inflight.discard(task)
                         
                         # Save & Update
-                        app_core.chat_manager.add_ai_message(app_state['current_session_id'], ans, ev)
-                        app_state['history'].append({'role': 'assistant', 'content': ans, 'evidence': ev})
+                        timings = trace.to_dict() if trace.spans else None
+                        mid = await app_core.add_ai_message(sid, ans, ev, timings)
+                        ai_msg = {'id': mid, 'role': 'assistant', 'content': ans, 'evidence': ev, 'timings': timings}
+                    except asyncio.CancelledError:
+                        raise
                     except Exception as e:
-                        app_state['history'].append({'role': 'assistant', 'content': f"Error: {str(e)}"})
+                        ai_msg = {'role': 'assistant', 'content': f"Error: {str(e)}"}
+                    app_state['history'].append(ai_msg)
                     
-                    # Remove spinner & Render
-                    # (Simple way: re-render all. Optimized way: remove spinner element and append msg. Here we re-render for simplicity)
-                    render_chat_messages(chat_container, app_state['history'], app_state)
-                    chat_scroll.scroll_to(percent=1.0, duration=0.2)
+                    # Remove spinner in place & append the answer
+                    chat_view.remove_spinner()
+                    chat_view.append(ai_msg)
 
                 # Bind Enter key (Need JS for Textarea Enter-to-submit without Shift)
                 text_input.on('keydown.enter.prevent', lambda e: send() if not e.args['shiftKey'] else None)
@@ -529,56 +1020,59 @@ async def main_page():
 
     # --- Logic & Init ---
 
-    def load_session(session_id):
+    session_list = SessionList(left_drawer, app_core, app_state, lambda sid: load_session(sid))
+
+    # 本页面进行中的生成任务，页面关闭时全部取消，并退订后台任务事件
+    inflight = set()
+    def on_delete():
+        for task in list(inflight):
+            task.cancel()
+        if app_state.get('jobs_unsubscribe'):
+            app_state['jobs_unsubscribe']()
+    # on_delete：页面关闭且重连超时后触发（短暂断线重连不会中断生成）
+    ui.context.client.on_delete(on_delete)
+
+    async def load_session(session_id):
         """加载会话"""
         if app_core is None: return
         
         app_state['current_session_id'] = session_id
         if session_id:
-            app_state['history'] = app_core.chat_manager.get_history(session_id)
+            # 只读取最近一页，更早的消息在向上滚动时分页加载
+            app_state['history'] = await app_core.get_history(session_id, limit=CHAT_RENDER_WINDOW)
         else:
             app_state['history'] = []
             
-        render_chat_messages(chat_container, app_state['history'], app_state)
-        render_left_drawer(left_drawer, app_core, app_state, load_session)
+        chat_view.reset(app_state['history'], has_more=len(app_state['history']) >= CHAT_RENDER_WINDOW)
+        session_list.set_active(session_id)
         
         # 移动端自动关闭侧边栏
         # if ui.context.client.layout.width < 1024: left_drawer.hide()
 
-    def refresh_ui():
+    async def refresh_ui():
         # Update placeholder
         text_input.props(f'placeholder="{t("ask_placeholder")}"')
         
         render_drawer_content(right_drawer, app_core, app_state)
-        render_left_drawer(left_drawer, app_core, app_state, load_session)
-        render_chat_messages(chat_container, app_state['history'], app_state)
+        session_list.core_app = app_core
+        await session_list.render()
+        chat_view.reset(app_state['history'], has_more=chat_view.has_more)
     
     app_state['refresh_ui'] = refresh_ui
 
-    def _create_app_instance():
-        """
-        在子线程中执行初始化，避免 import 导致的长时间阻塞。
-        """
-        print("Initializing AppCore in background thread...")
-        from app.app_core import ExtractHelperApp
-        return ExtractHelperApp()
-
     async def init_task():
-        global app_core
         if app_core is None:
             try:
-                # 在线程池中执行实例化（包括 import 耗时操作）
-                app_core = await run.io_bound(_create_app_instance)
-                print("AppCore initialized successfully.")
+                await get_app_core()
                 
                 # Init UI
-                refresh_ui()
+                await refresh_ui()
                 
             except Exception as e:
                 print(f"Initialization failed: {e}")
                 ui.notify(f"Initialization failed: {e}", type='negative')
         else:
-             refresh_ui()
+             await refresh_ui()
 
     # Startup Loading
     if app_core is None:
@@ -588,7 +1082,7 @@ async def main_page():
                 ui.label(t('loading')).classes('text-gray-500 animate-pulse')
         ui.timer(0.1, init_task, once=True)
     else:
-        refresh_ui()
+        await refresh_ui()
 
 
 # -----------------------------------------------------------------------------
@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import hashlib
+import json
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterator, Optional, Tuple
+
+from app.config import DB_BUSY_TIMEOUT_MS, DB_PATH
+from app.ingest.dedup import bands, hamming, to_unsigned
 
 """
 数据库层 (SQLite)
-负责管理 documents 和 chunks 表的 Schema 定义、连接创建以及底层 CRUD 操作。
+负责管理 documents 和 chunks 表的 Schema 定义、连接池以及底层 CRUD 操作。
 """
 
 # 表结构定义
@@ -34,9 +40,28 @@ CREATE TABLE IF NOT EXISTS chunks (
   content_hash TEXT,
   is_deleted INTEGER NOT NULL DEFAULT 0,
 
+  -- 去重：重复 chunk 指向共享向量的规范 chunk（NULL 表示自身即规范 chunk，拥有向量）
+  canonical_id INTEGER,
+  -- SimHash 指纹（有符号 64 位，见 app/ingest/dedup.py），文本过短时为 NULL
+  simhash INTEGER,
+
   FOREIGN KEY(doc_id) REFERENCES documents(id)
 );
 
+-- 规范 chunk 的 SimHash 分段，用于按段精确查找近似重复的候选
+CREATE TABLE IF NOT EXISTS chunk_simhash_bands (
+  band INTEGER NOT NULL,
+  value INTEGER NOT NULL,
+  chunk_id INTEGER NOT NULL,
+
+  PRIMARY KEY(band, value, chunk_id)
+) WITHOUT ROWID;
+
+-- 被提升为规范 chunk、尚未写入向量索引的 chunk（删除文档时不加载向量模型，下次 sync / add / compact 时补齐）
+CREATE TABLE IF NOT EXISTS pending_vectors (
+  chunk_id INTEGER PRIMARY KEY
+);
+
 -- Chat History Support
 CREATE TABLE IF NOT EXISTS sessions (
   id TEXT PRIMARY KEY,
@@ -55,27 +80,133 @@ CREATE TABLE IF NOT EXISTS messages (
   
   FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
 );
+
+-- 回答引用：只保存 chunk 引用，正文显示时从 chunks 回查
+CREATE TABLE IF NOT EXISTS message_evidence (
+  message_id TEXT NOT NULL,
+  rank INTEGER NOT NULL,
+  chunk_id INTEGER NOT NULL,
+  doc_id INTEGER,
+  score REAL,
+  page INTEGER,
+  snapshot TEXT, -- JSON，仅当 chunk 已删除/不可回查时保存的快照
+
+  PRIMARY KEY(message_id, rank),
+  FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE
+);
 """
 
 # 索引定义
 INDEXES_SQL = """
 CREATE INDEX IF NOT EXISTS idx_chunks_doc_id ON chunks(doc_id);
 CREATE INDEX IF NOT EXISTS idx_chunks_active ON chunks(is_deleted, id);
+CREATE INDEX IF NOT EXISTS idx_chunks_content_hash ON chunks(content_hash);
+CREATE INDEX IF NOT EXISTS idx_chunks_canonical ON chunks(canonical_id);
 CREATE INDEX IF NOT EXISTS idx_documents_active ON documents(is_deleted, id);
 
-CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, created_at);
-CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at DESC);
+-- 会话 / 消息的 keyset 分页按 (时间, id) 排序
+DROP INDEX IF EXISTS idx_messages_session;
+DROP INDEX IF EXISTS idx_sessions_updated;
+CREATE INDEX IF NOT EXISTS idx_messages_page ON messages(session_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_sessions_page ON sessions(updated_at, id);
+CREATE INDEX IF NOT EXISTS idx_message_evidence_chunk ON message_evidence(chunk_id);
 """
 
-def connect(db_path: Path) -> sqlite3.Connection:
-    """创建并返回 SQLite 连接，启用 WAL 模式"""
+def connect(db_path: Path, busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS) -> sqlite3.Connection:
+    """创建并返回 SQLite 连接，启用 WAL 模式与忙等待超时"""
+    db_path = Path(db_path)
     db_path.parent.mkdir(parents=True, exist_ok=True)
     # check_same_thread=False 允许在不同线程中使用连接（配合 NiceGUI/Asyncio）
-    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    conn = sqlite3.connect(str(db_path), timeout=busy_timeout_ms / 1000.0, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)};")
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA foreign_keys=ON;")
     return conn
 
+
+class ConnectionPool:
+    """
+    SQLite 连接池（每个数据库文件一个）
+    - 读：每个线程一个只读连接（WAL 下读不阻塞写），线程内复用；
+    - 写：进程内只有一个写连接，由锁串行化，避免多个连接争抢写锁；
+    - Schema 检查 / 迁移只在创建连接池时执行一次。
+    """
+    def __init__(self, db_path: Path, busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS) -> None:
+        """
+        :param db_path: 数据库文件路径
+        :param busy_timeout_ms: 等待其他进程释放锁的超时时间
+        """
+        self.db_path = Path(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._readers: list[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        # RLock：同一线程内嵌套的 writer() 共享同一个事务
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._writer = connect(self.db_path, busy_timeout_ms)
+        ensure_schema(self._writer)
+
+    def reader(self) -> sqlite3.Connection:
+        """返回当前线程的只读连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path, self.busy_timeout_ms)
+            conn.execute("PRAGMA query_only=ON;")
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """
+        获取写连接（串行化）。最外层退出时提交，异常时回滚。
+        用法: with pool.writer() as conn: ...
+        """
+        with self._write_lock:
+            self._write_depth += 1
+            try:
+                yield self._writer
+            except BaseException:
+                if self._write_depth == 1:
+                    self._writer.rollback()
+                raise
+            else:
+                if self._write_depth == 1:
+                    self._writer.commit()
+            finally:
+                self._write_depth -= 1
+
+    def close(self) -> None:
+        """关闭所有连接"""
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self._local = threading.local()
+        with self._write_lock:
+            self._writer.close()
+
+
+# 进程内连接池缓存：db 路径 -> ConnectionPool
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(db_path: Path = DB_PATH) -> ConnectionPool:
+    """
+    获取（并缓存）指定数据库的连接池，首次调用时执行 Schema 检查。
+    :param db_path: 数据库文件路径
+    """
+    key = str(Path(db_path).resolve())
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = ConnectionPool(Path(db_path))
+            _POOLS[key] = pool
+        return pool
+
 def _col_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
     """检查表中是否存在指定列"""
     rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
@@ -105,6 +236,11 @@ def ensure_schema(conn: sqlite3.Connection) -> None:
     # chunks
     _add_column(conn, "chunks", "content_hash", "TEXT")
     _add_column(conn, "chunks", "is_deleted", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "chunks", "canonical_id", "INTEGER")
+    _add_column(conn, "chunks", "simhash", "INTEGER")
+
+    # messages：回答的各阶段耗时（JSON，见 app.tracing）
+    _add_column(conn, "messages", "timings", "TEXT")
 
     conn.commit()
 
@@ -112,6 +248,9 @@ def ensure_schema(conn: sqlite3.Connection) -> None:
     conn.executescript(INDEXES_SQL)
     conn.commit()
 
+    # 4) 旧版 messages.evidence JSON 迁移到 message_evidence
+    _migrate_message_evidence(conn)
+
 # 兼容旧代码别名
 def init_db(conn: sqlite3.Connection) -> None:
     ensure_schema(conn)
@@ -160,16 +299,23 @@ def mark_document_deleted(conn: sqlite3.Connection, doc_id: int) -> None:
     """软删除文档"""
     conn.execute("UPDATE documents SET is_deleted=1 WHERE id=?", (doc_id,))
 
-def mark_chunks_deleted_for_doc(conn: sqlite3.Connection, doc_id: int) -> None:
-    """软删除指定文档下的所有 chunks"""
+def mark_chunks_deleted_for_doc(conn: sqlite3.Connection, doc_id: int) -> list[tuple[int, str]]:
+    """
+    软删除指定文档下的所有 chunks（被回答引用的 chunk 先保存快照）。
+    其他文档中仍有效的重复 chunk 会被提升为新的规范 chunk，并记入 pending_vectors 等待补充向量。
+    :return: 被提升的 [(chunk_id, content), ...]
+    """
+    snapshot_evidence_for_doc(conn, doc_id)
+    promoted = promote_duplicates(conn, doc_id)
     conn.execute(
         "UPDATE chunks SET is_deleted=1 WHERE doc_id=? AND is_deleted=0",
         (doc_id,),
     )
+    return promoted
 
-def clear_chunks_for_doc(conn: sqlite3.Connection, doc_id: int) -> None:
+def clear_chunks_for_doc(conn: sqlite3.Connection, doc_id: int) -> list[tuple[int, str]]:
     """兼容别名：清除（软删除）文档 chunks"""
-    mark_chunks_deleted_for_doc(conn, doc_id)
+    return mark_chunks_deleted_for_doc(conn, doc_id)
 
 def _hash_text(t: str) -> str:
     h = hashlib.sha256()
@@ -182,18 +328,126 @@ def insert_chunk(
     chunk_index: int,
     content: str,
     page: Optional[int],
+    canonical_id: Optional[int] = None,
+    simhash: Optional[int] = None,
 ) -> int:
-    """插入单个 chunk 记录"""
+    """
+    插入单个 chunk 记录
+    :param canonical_id: 共享其向量的规范 chunk（去重），None 表示自身为规范 chunk
+    :param simhash: SimHash 指纹（有符号 64 位）
+    """
     chash = _hash_text(content)
     cur = conn.execute(
         """
-        INSERT INTO chunks(doc_id, chunk_index, page, content, content_hash, is_deleted)
-        VALUES(?, ?, ?, ?, ?, 0)
+        INSERT INTO chunks(doc_id, chunk_index, page, content, content_hash, is_deleted, canonical_id, simhash)
+        VALUES(?, ?, ?, ?, ?, 0, ?, ?)
         """,
-        (doc_id, chunk_index, page, content, chash),
+        (doc_id, chunk_index, page, content, chash, canonical_id, simhash),
     )
     return int(cur.lastrowid)
 
+# -----------------------------------------------------------------------------
+# Deduplication
+# -----------------------------------------------------------------------------
+
+def find_exact_duplicate(conn: sqlite3.Connection, content: str) -> Optional[int]:
+    """内容完全相同的有效规范 chunk"""
+    row = conn.execute(
+        """
+        SELECT c.id FROM chunks c JOIN documents d ON d.id = c.doc_id
+        WHERE c.content_hash=? AND c.canonical_id IS NULL AND c.is_deleted=0 AND d.is_deleted=0
+        ORDER BY c.id LIMIT 1
+        """,
+        (_hash_text(content),),
+    ).fetchone()
+    return int(row[0]) if row else None
+
+def find_near_duplicate(conn: sqlite3.Connection, simhash: int, max_distance: int) -> Optional[int]:
+    """
+    SimHash 汉明距离不超过 max_distance 的有效规范 chunk（取距离最小者）。
+    :param simhash: 无符号 64 位指纹
+    """
+    rows = conn.execute(
+        """
+        SELECT DISTINCT c.id, c.simhash
+        FROM chunk_simhash_bands b
+        JOIN chunks c ON c.id = b.chunk_id
+        JOIN documents d ON d.id = c.doc_id
+        WHERE (b.band, b.value) IN (SELECT key, value FROM json_each(?))
+          AND c.canonical_id IS NULL AND c.is_deleted=0 AND d.is_deleted=0
+        """,
+        (json.dumps(bands(simhash)),),
+    ).fetchall()
+    best = None
+    for cid, fp in rows:
+        dist = hamming(simhash, to_unsigned(int(fp)))
+        if dist <= max_distance and (best is None or dist < best[0] or (dist == best[0] and cid < best[1])):
+            best = (dist, int(cid))
+    return best[1] if best else None
+
+def add_simhash_bands(conn: sqlite3.Connection, chunk_id: int, simhash: int) -> None:
+    """登记规范 chunk 的指纹分段（simhash 为无符号 64 位）"""
+    conn.executemany(
+        "INSERT OR IGNORE INTO chunk_simhash_bands(band, value, chunk_id) VALUES(?, ?, ?)",
+        [(i, v, chunk_id) for i, v in enumerate(bands(simhash))],
+    )
+
+def promote_duplicates(conn: sqlite3.Connection, doc_id: int) -> list[tuple[int, str]]:
+    """
+    文档的规范 chunk 即将删除时，把其他文档中指向它的有效重复 chunk 中 id 最小者提升为规范 chunk，
+    其余重复改为指向新的规范 chunk。
+    :return: 被提升的 [(chunk_id, content), ...]（尚无向量，已记入 pending_vectors）
+    """
+    rows = conn.execute(
+        """
+        SELECT c.canonical_id, MIN(c.id)
+        FROM chunks c
+        WHERE c.canonical_id IN (
+                SELECT id FROM chunks WHERE doc_id=? AND is_deleted=0 AND canonical_id IS NULL
+              )
+          AND c.is_deleted=0 AND c.doc_id != ?
+        GROUP BY c.canonical_id
+        """,
+        (doc_id, doc_id),
+    ).fetchall()
+    promoted: list[tuple[int, str]] = []
+    for old_id, new_id in rows:
+        conn.execute("UPDATE chunks SET canonical_id=NULL WHERE id=?", (new_id,))
+        conn.execute(
+            "UPDATE chunks SET canonical_id=? WHERE canonical_id=? AND is_deleted=0 AND doc_id != ? AND id != ?",
+            (new_id, old_id, doc_id, new_id),
+        )
+        content, fp = conn.execute("SELECT content, simhash FROM chunks WHERE id=?", (new_id,)).fetchone()
+        if fp is not None:
+            add_simhash_bands(conn, int(new_id), to_unsigned(int(fp)))
+        conn.execute("INSERT OR IGNORE INTO pending_vectors(chunk_id) VALUES(?)", (int(new_id),))
+        promoted.append((int(new_id), content))
+    return promoted
+
+def pending_vector_chunks(conn: sqlite3.Connection) -> tuple[list[int], list[tuple[int, str]]]:
+    """
+    等待补充向量的 chunk。
+    :return: (pending_vectors 中的全部 id, 其中仍为有效规范 chunk 的 [(chunk_id, content), ...])
+    """
+    ids = [int(r[0]) for r in conn.execute("SELECT chunk_id FROM pending_vectors ORDER BY chunk_id")]
+    if not ids:
+        return [], []
+    rows = conn.execute(
+        """
+        SELECT c.id, c.content
+        FROM pending_vectors p
+        JOIN chunks c ON c.id = p.chunk_id
+        JOIN documents d ON d.id = c.doc_id
+        WHERE c.is_deleted = 0 AND d.is_deleted = 0 AND c.canonical_id IS NULL
+        ORDER BY c.id
+        """
+    ).fetchall()
+    return ids, [(int(cid), content) for cid, content in rows]
+
+def clear_pending_vectors(conn: sqlite3.Connection, chunk_ids: list[int]) -> None:
+    """已写入索引（或不再需要向量）的 chunk 移出 pending_vectors"""
+    conn.executemany("DELETE FROM pending_vectors WHERE chunk_id=?", [(int(i),) for i in chunk_ids])
+
 # -----------------------------------------------------------------------------
 # Chat Session Management
 # -----------------------------------------------------------------------------
@@ -204,10 +458,20 @@ def create_session(conn: sqlite3.Connection, session_id: str, title: str, now: f
         (session_id, title, now, now)
     )
 
-def list_sessions(conn: sqlite3.Connection, limit: int = 50):
+def list_sessions(conn: sqlite3.Connection, limit: int = 50, before: Optional[Tuple[float, str]] = None):
+    """
+    按 (updated_at, id) 倒序分页（keyset，走 idx_sessions_page）。
+    :param before: 上一页最后一条的 (updated_at, id)；只比较时间会跳过与分页边界时间相同的会话
+    """
+    if before is None:
+        return conn.execute(
+            "SELECT id, title, updated_at FROM sessions ORDER BY updated_at DESC, id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
     return conn.execute(
-        "SELECT id, title, updated_at FROM sessions ORDER BY updated_at DESC LIMIT ?",
-        (limit,)
+        "SELECT id, title, updated_at FROM sessions WHERE (updated_at, id) < (?, ?) "
+        "ORDER BY updated_at DESC, id DESC LIMIT ?",
+        (before[0], before[1], limit)
     ).fetchall()
 
 def get_session(conn: sqlite3.Connection, session_id: str):
@@ -221,6 +485,10 @@ def update_session_time(conn: sqlite3.Connection, session_id: str, now: float):
 
 def delete_session(conn: sqlite3.Connection, session_id: str):
     # messages will be deleted by cascade if supported, but let's be safe
+    conn.execute(
+        "DELETE FROM message_evidence WHERE message_id IN (SELECT id FROM messages WHERE session_id=?)",
+        (session_id,)
+    )
     conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
     conn.execute("DELETE FROM sessions WHERE id=?", (session_id,))
 
@@ -231,14 +499,15 @@ def add_message(
     role: str, 
     content: str, 
     evidence_json: Optional[str], 
-    now: float
+    now: float,
+    timings_json: Optional[str] = None,
 ) -> None:
     conn.execute(
         """
-        INSERT INTO messages(id, session_id, role, content, evidence, created_at)
-        VALUES(?, ?, ?, ?, ?, ?)
+        INSERT INTO messages(id, session_id, role, content, evidence, created_at, timings)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
         """,
-        (msg_id, session_id, role, content, evidence_json, now)
+        (msg_id, session_id, role, content, evidence_json, now, timings_json)
     )
     # update session time
     update_session_time(conn, session_id, now)
@@ -248,3 +517,142 @@ def get_messages(conn: sqlite3.Connection, session_id: str):
         "SELECT role, content, evidence FROM messages WHERE session_id=? ORDER BY created_at ASC",
         (session_id,)
     ).fetchall()
+
+def get_messages_page(
+    conn: sqlite3.Connection,
+    session_id: str,
+    before: Optional[Tuple[float, str]] = None,
+    limit: int = 20,
+):
+    """
+    按 (created_at, id) 倒序取一页消息（keyset 分页，走 idx_messages_page），返回时按时间正序。
+    不读取引用正文，只返回引用条数，引用在展开时再按消息 id 加载。
+    :param before: 上一页最早一条消息的 (created_at, id)，None 表示最新一页
+    :return: [(id, role, content, created_at, evidence_count, timings_json), ...]
+    """
+    sql = """
+    SELECT id, role, content, created_at,
+           (SELECT COUNT(*) FROM message_evidence me WHERE me.message_id = messages.id),
+           timings
+    FROM messages
+    WHERE session_id=? {cond}
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+    """
+    if before is None:
+        rows = conn.execute(sql.format(cond=""), (session_id, limit)).fetchall()
+    else:
+        rows = conn.execute(sql.format(cond="AND (created_at, id) < (?, ?)"), (session_id, before[0], before[1], limit)).fetchall()
+    rows.reverse()
+    return rows
+
+def add_message_evidence(conn: sqlite3.Connection, message_id: str, evidence: list[dict]) -> None:
+    """
+    保存回答引用（只存 chunk_id / score / page / doc_id，不复制正文）。
+    :param evidence: retrieve_evidence 返回的证据列表
+    """
+    conn.executemany(
+        """
+        INSERT INTO message_evidence(message_id, rank, chunk_id, doc_id, score, page)
+        VALUES(?, ?, ?, (SELECT doc_id FROM chunks WHERE id=?), ?, ?)
+        """,
+        [
+            (message_id, rank, int(e["chunk_id"]), int(e["chunk_id"]), float(e.get("score", 0.0)), e.get("page"))
+            for rank, e in enumerate(evidence)
+        ],
+    )
+
+def snapshot_evidence_for_doc(conn: sqlite3.Connection, doc_id: int) -> None:
+    """
+    文档 chunks 被删除前，为仍被回答引用的 chunk 保存快照，保证历史引用可显示。
+    """
+    conn.execute(
+        """
+        UPDATE message_evidence
+        SET snapshot = (
+            SELECT json_object('path', d.path, 'doc_type', d.doc_type, 'content', c.content)
+            FROM chunks c JOIN documents d ON d.id = c.doc_id
+            WHERE c.id = message_evidence.chunk_id
+        )
+        WHERE snapshot IS NULL
+          AND chunk_id IN (SELECT id FROM chunks WHERE doc_id=? AND is_deleted=0)
+        """,
+        (doc_id,),
+    )
+
+def get_message_evidence(conn: sqlite3.Connection, message_id: str) -> list[dict]:
+    """
+    读取单条消息的引用，正文从 chunks 回查；chunk 已删除时使用快照。
+    :return: 与 retrieve_evidence 相同结构的证据列表
+    """
+    rows = conn.execute(
+        """
+        SELECT me.chunk_id, me.score, me.page, me.snapshot,
+               c.content, c.is_deleted, d.path, d.doc_type
+        FROM message_evidence me
+        LEFT JOIN chunks c ON c.id = me.chunk_id
+        LEFT JOIN documents d ON d.id = COALESCE(c.doc_id, me.doc_id)
+        WHERE me.message_id=?
+        ORDER BY me.rank ASC
+        """,
+        (message_id,),
+    ).fetchall()
+
+    evidence = []
+    for chunk_id, score, page, snapshot, content, is_deleted, path, doc_type in rows:
+        if snapshot and (content is None or is_deleted):
+            snap = json.loads(snapshot)
+            content = snap.get("content")
+            path = snap.get("path") or path
+            doc_type = snap.get("doc_type") or doc_type
+        path = str(path or "")
+        evidence.append(
+            {
+                "score": float(score or 0.0),
+                "path": path,
+                "filename": Path(path).name,
+                "doc_type": doc_type,
+                "page": page,
+                "chunk_id": int(chunk_id),
+                "content": content or "",
+                "snippet": (content or "").replace("\n", " ")[:240],
+            }
+        )
+    return evidence
+
+def _migrate_message_evidence(conn: sqlite3.Connection) -> None:
+    """
+    将旧版 messages.evidence（完整证据 JSON）迁移为 message_evidence 引用并清空原列。
+    只有 chunk 已不存在或内容已变化时才保留快照。
+    """
+    rows = conn.execute("SELECT id, evidence FROM messages WHERE evidence IS NOT NULL").fetchall()
+    if not rows:
+        return
+
+    for mid, ev_json in rows:
+        try:
+            evidence = json.loads(ev_json) or []
+        except Exception:
+            evidence = []
+        for rank, e in enumerate(evidence):
+            if not isinstance(e, dict) or e.get("chunk_id") is None:
+                continue
+            cid = int(e["chunk_id"])
+            content = e.get("content") or e.get("snippet") or ""
+            row = conn.execute("SELECT doc_id, content_hash FROM chunks WHERE id=?", (cid,)).fetchone()
+            snapshot = None
+            if row is None or row[1] != _hash_text(content):
+                snapshot = json.dumps(
+                    {"path": e.get("path"), "doc_type": e.get("doc_type"), "content": content},
+                    ensure_ascii=False,
+                )
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO message_evidence(message_id, rank, chunk_id, doc_id, score, page, snapshot)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                """,
+                (mid, rank, cid, row[0] if row else None, float(e.get("score") or 0.0), e.get("page"), snapshot),
+            )
+        conn.execute("UPDATE messages SET evidence=NULL WHERE id=?", (mid,))
+    conn.commit()
+    print(f"[db] migrated evidence of {len(rows)} messages to message_evidence")
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from typing import List, Optional, Set
+
+import numpy as np
+
+"""
+文本去重工具
+- SimHash：64 位指纹，特征为归一化文本的字符 3-gram（中英文通用），汉明距离小即近似重复；
+  指纹按 SIMHASH_BANDS 段切分入库，距离不超过 SIMHASH_BANDS - 1 的两个指纹至少有一段完全相同（抽屉原理），
+  入库时只需按段精确查找候选，再计算汉明距离；
+- shingles / jaccard：检索阶段比较候选证据之间的文本相似度（见 retrieve 中的 MMR）。
+"""
+
+# 指纹切分的段数（每段 64 / SIMHASH_BANDS 位），决定可检测的最大汉明距离（SIMHASH_BANDS - 1）
+SIMHASH_BANDS = 4
+_BAND_BITS = 64 // SIMHASH_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+# 字符 n-gram 长度
+SHINGLE_SIZE = 3
+# 短于该字符数的文本不做近似去重（特征太少，指纹不可靠）
+NEAR_DUP_MIN_CHARS = 80
+
+
+def normalize(text: str) -> str:
+    """小写并合并空白，使排版差异不影响指纹"""
+    return re.sub(r"\s+", " ", (text or "").lower()).strip()
+
+
+def shingles(text: str, n: int = SHINGLE_SIZE) -> Set[str]:
+    t = normalize(text)
+    if len(t) <= n:
+        return {t} if t else set()
+    return {t[i:i + n] for i in range(len(t) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    inter = len(a & b)
+    return inter / (len(a) + len(b) - inter)
+
+
+def simhash(text: str) -> Optional[int]:
+    """
+    64 位 SimHash（无符号）；文本过短时返回 None。
+    特征哈希使用 blake2b，保证跨进程稳定（指纹要写入数据库）。
+    """
+    feats = shingles(text)
+    if len(normalize(text)) < NEAR_DUP_MIN_CHARS or not feats:
+        return None
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest() for f in feats),
+        dtype="<u8",
+    )
+    # 逐位统计：该位为 1 的特征数超过一半则指纹该位为 1
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    ones = bits.sum(axis=0)
+    fp = np.packbits(ones * 2 > len(feats), bitorder="little")
+    return int.from_bytes(fp.tobytes(), "little")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def bands(fp: int) -> List[int]:
+    """指纹的各段取值（第 i 段为 bits[i*16:(i+1)*16]）"""
+    return [(fp >> (_BAND_BITS * i)) & _BAND_MASK for i in range(SIMHASH_BANDS)]
+
+
+def to_signed(fp: int) -> int:
+    """无符号 64 位 -> SQLite INTEGER（有符号）"""
+    return fp - (1 << 64) if fp >= (1 << 63) else fp
+
+
+def to_unsigned(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
@@ -2,26 +2,48 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import time
 from pathlib import Path
-from typing import List, Tuple
-
-from app.config import CHUNK_OVERLAP, CHUNK_SIZE, DB_PATH, RAW_DIR
+from typing import List, Optional, Tuple
+
+from app.config import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    DB_PATH,
+    DEDUP_EXACT,
+    DEDUP_NEAR,
+    DEDUP_SIMHASH_DISTANCE,
+    RAW_DIR,
+)
 from app.ingest.loaders import iter_documents, load_document, DocText
 from app.ingest.chunker import simple_chunk
 from app.ingest.db import (
-    connect,
-    ensure_schema,
+    ConnectionPool,
+    add_simhash_bands,
+    clear_pending_vectors,
+    find_exact_duplicate,
+    find_near_duplicate,
+    get_pool,
     get_document,
     upsert_document,
     mark_document_deleted,
     mark_chunks_deleted_for_doc,
     insert_chunk,
+    pending_vector_chunks,
 )
+from app.ingest.dedup import SIMHASH_BANDS, simhash, to_signed
 # 注意：原代码中 delete_paths 是在 ingest.py 里定义的，我需要保持一致
 # db.py 里没有 delete_paths，所以我在这里保留它
 
-from app.retrieval.retrieve import add_to_delta_index
-from app.retrieval.build_index import build_index
+from app import daemon, jobs, metrics, profiling
+
+# 注意：检索 / 索引模块（faiss、Embedding 模型）在用到时才导入，
+# 这样 `ingest delete` 之类不需要向量化的命令可以快速启动
+
+_INGEST_SECONDS = metrics.histogram("extracthelper_ingest_file_seconds", "Time to parse, chunk, store and embed one changed file")
+_INGEST_CHUNKS = metrics.counter("extracthelper_ingest_chunks_total", "Chunks written by ingest")
+_DEDUP_EXACT = metrics.counter("extracthelper_ingest_dedup_exact_total", "Chunks sharing the vector of an identical chunk")
+_DEDUP_NEAR = metrics.counter("extracthelper_ingest_dedup_near_total", "Chunks sharing the vector of a near-duplicate chunk (SimHash)")
 
 
 def _file_stat(p: Path) -> Tuple[float, int]:
@@ -57,20 +79,54 @@ def _chunk_doc(doc: DocText):
         return out
     return simple_chunk(doc.text, CHUNK_SIZE, CHUNK_OVERLAP)
 
-def _ingest_one(conn, fp: Path, force: bool = False) -> int:
+def _find_canonical(conn, text: str, fingerprint: Optional[int]) -> Optional[int]:
+    """去重：返回应共享其向量的已有规范 chunk，没有重复时返回 None"""
+    if DEDUP_EXACT:
+        cid = find_exact_duplicate(conn, text)
+        if cid is not None:
+            _DEDUP_EXACT.inc()
+            return cid
+    if DEDUP_NEAR and fingerprint is not None:
+        cid = find_near_duplicate(conn, fingerprint, min(DEDUP_SIMHASH_DISTANCE, SIMHASH_BANDS - 1))
+        if cid is not None:
+            _DEDUP_NEAR.inc()
+            return cid
+    return None
+
+def index_pending(pool: Optional[ConnectionPool] = None) -> int:
+    """
+    为 pending_vectors 中的 chunk（删除规范 chunk 后被提升的重复 chunk）补充向量并写入 Delta 索引。
+    :return: 写入的 chunk 数
+    """
+    pool = pool or get_pool(DB_PATH)
+    ids, rows = pending_vector_chunks(pool.reader())
+    if not ids:
+        return 0
+    if rows:
+        from app.retrieval.retrieve import add_to_delta_index
+        add_to_delta_index([cid for cid, _ in rows], [text for _, text in rows])
+        print(f"[ingest] {len(rows)} promoted duplicate chunks indexed")
+    with pool.writer() as conn:
+        clear_pending_vectors(conn, ids)
+    return len(rows)
+
+def _ingest_one(pool: ConnectionPool, fp: Path, force: bool = False) -> int:
     """
     处理单个文件入库逻辑：
     1. 检查文件是否已存在且未修改（基于 mtime + size）。
     2. 计算哈希，读取内容。
     3. 更新 documents 表。
-    4. 软删除旧 chunks，插入新 chunks。
-    5. 更新 Delta 索引。
+    4. 软删除旧 chunks，插入新 chunks；与已有 chunk 完全相同或近似重复（SimHash）的 chunk
+       记录 canonical_id 并共享其向量，不再向量化。
+    5. 更新 Delta 索引（只包含新的规范 chunk 与被提升的重复 chunk）。
+
+    解析与向量化在写锁之外进行，写连接只在第 3、4 步短暂持有。
     
     :return: 新生成的 chunk 数量
     """
     path = str(fp)
     mtime, size = _file_stat(fp)
-    row = get_document(conn, path)
+    row = get_document(pool.reader(), path)
 
     # 增量更新检查
     if row and not force:
@@ -78,85 +134,176 @@ def _ingest_one(conn, fp: Path, force: bool = False) -> int:
         if is_deleted == 0 and old_mtime == mtime and old_size == size:
             return 0
 
+    t0 = time.perf_counter()
     file_hash = _sha256_file(fp)
     doc = load_document(fp)
-    doc_id = upsert_document(conn, path, doc.doc_type, file_hash, mtime, size)
-
-    # 更新：旧 chunks 软删除
-    mark_chunks_deleted_for_doc(conn, doc_id)
-
+    t_parse = time.perf_counter()
     chunks = _chunk_doc(doc)
+    # 指纹在写锁之外计算
+    fingerprints = [simhash(ch.text) if DEDUP_NEAR else None for ch in chunks]
+    t_chunk = time.perf_counter()
     new_ids: List[int] = []
     new_texts: List[str] = []
+    duplicates = 0
+
+    with pool.writer() as conn:
+        doc_id = upsert_document(conn, path, doc.doc_type, file_hash, mtime, size)
+
+        # 更新：旧 chunks 软删除（其他文档中的重复 chunk 可能被提升为规范 chunk）
+        promoted = mark_chunks_deleted_for_doc(conn, doc_id)
+
+        for ch, fingerprint in zip(chunks, fingerprints):
+            canonical = _find_canonical(conn, ch.text, fingerprint)
+            cid = insert_chunk(
+                conn, doc_id, ch.idx, ch.text, ch.page,
+                canonical_id=canonical, simhash=to_signed(fingerprint) if fingerprint is not None else None,
+            )
+            if canonical is not None:
+                duplicates += 1
+                continue
+            if fingerprint is not None:
+                add_simhash_bands(conn, cid, fingerprint)
+            new_ids.append(cid)
+            new_texts.append(ch.text)
+    new_ids += [cid for cid, _ in promoted]
+    new_texts += [text for _, text in promoted]
 
-    for ch in chunks:
-        cid = insert_chunk(conn, doc_id, ch.idx, ch.text, ch.page)
-        new_ids.append(cid)
-        new_texts.append(ch.text)
-
-    conn.commit()
     # 实时更新增量索引
+    from app.retrieval.retrieve import add_to_delta_index
+    t_store = time.perf_counter()
     add_to_delta_index(new_ids, new_texts)
-
-    print(f"[ingest] {fp.name}: {len(chunks)} chunks (updated)")
+    if promoted:
+        with pool.writer() as conn:
+            clear_pending_vectors(conn, [cid for cid, _ in promoted])
+    t_index = time.perf_counter()
+
+    # 剖析模式下记录逐文件耗时，报告中按总耗时排序，便于发现异常文档
+    profiling.record_file(
+        path, loader=doc.doc_type, bytes=size, chunks=len(chunks), duplicates=duplicates,
+        parse_s=t_parse - t0, chunk_s=t_chunk - t_parse, store_s=t_store - t_chunk, index_s=t_index - t_store,
+    )
+    _INGEST_SECONDS.observe(t_index - t0)
+    _INGEST_CHUNKS.inc(len(chunks))
+    dup_note = f", {duplicates} duplicates share vectors" if duplicates else ""
+    print(f"[ingest] {fp.name}: {len(chunks)} chunks (updated{dup_note})")
     return len(chunks)
 
-def delete_paths(paths: List[Path]) -> None:
+def delete_paths(paths: List[Path], index: bool = True) -> None:
     """
     批量删除文件（软删除）。
     同时标记 document 和 chunks 为 is_deleted=1。
+    :param index: 立即为被提升的重复 chunk 补充向量；为 False 时只记入 pending_vectors，
+                  留到下次 sync / add / compact（不加载向量模型与 faiss）
     """
-    conn = connect(DB_PATH)
-    ensure_schema(conn)
+    pool = get_pool(DB_PATH)
+    promoted = 0
 
     for p in paths:
-        row = get_document(conn, str(p))
+        row = get_document(pool.reader(), str(p))
         if not row:
             print(f"[delete] not found in db: {p}")
             continue
         doc_id = int(row[0])
-        mark_chunks_deleted_for_doc(conn, doc_id)
-        mark_document_deleted(conn, doc_id)
-        conn.commit()
+        with pool.writer() as conn:
+            promoted += len(mark_chunks_deleted_for_doc(conn, doc_id))
+            mark_document_deleted(conn, doc_id)
         print(f"[delete] marked deleted: {p}")
-
-    conn.close()
+    if index:
+        index_pending(pool)
+    elif promoted:
+        print(f"[delete] {promoted} promoted duplicate chunks will be indexed on the next sync / add / compact")
 
 def sync_folder(folder: Path, force: bool = False) -> None:
     """
     同步整个文件夹。
     处理新增/修改文件，并标记已不存在的文件为删除状态。
+    在后台任务中运行时，每个文件处理前检查取消，并上报文件 / chunk 进度。
     """
-    conn = connect(DB_PATH)
-    ensure_schema(conn)
+    pool = get_pool(DB_PATH)
 
-    files = list(iter_documents(folder))
+    jobs.report(stage="scan", message=f"scanning {folder}")
+    with profiling.stage("scan"):
+        files = list(iter_documents(folder))
     print(f"[sync] found {len(files)} files in {folder}")
+    jobs.checkpoint()
 
     file_set = set(str(p) for p in files)
 
     # 检查 DB 中存在但磁盘已消失的文件 -> 标记删除
-    rows = conn.execute("SELECT id, path FROM documents WHERE is_deleted=0").fetchall()
-    for doc_id, path in rows:
-        if path not in file_set:
-            mark_chunks_deleted_for_doc(conn, int(doc_id))
-            mark_document_deleted(conn, int(doc_id))
-    conn.commit()
+    with profiling.stage("mark_deleted"):
+        rows = pool.reader().execute("SELECT id, path FROM documents WHERE is_deleted=0").fetchall()
+        with pool.writer() as conn:
+            for doc_id, path in rows:
+                if path not in file_set:
+                    mark_chunks_deleted_for_doc(conn, int(doc_id))
+                    mark_document_deleted(conn, int(doc_id))
+        # 被提升的重复 chunk（含之前 ingest delete 留下的）补充向量
+        index_pending(pool)
 
     changed = 0
-    for fp in files:
-        changed += _ingest_one(conn, fp, force=force)
+    jobs.report(stage="ingest", done=0, total=len(files), unit="files", message=f"found {len(files)} files")
+    with profiling.stage("ingest"):
+        for i, fp in enumerate(files, start=1):
+            jobs.checkpoint()
+            n = _ingest_one(pool, fp, force=force)
+            changed += n
+            jobs.report(done=i, message=f"{fp.name}: {n} chunks" if n else None)
 
-    conn.close()
     print(f"[sync] done. changed_chunks={changed}. db={DB_PATH}")
+    jobs.report(message=f"done, changed_chunks={changed}")
 
 def compact_rebuild_index() -> None:
-    """调用 build_index 重建索引，物理清理已删除数据占用的空间"""
-    build_index()
-    print("[compact] base index rebuilt and delta cleared.")
+    """只重建含删除/新增数据的分片，物理清理已删除数据占用的空间并合并 Delta"""
+    from app.retrieval.build_index import compact_index
+    index_pending()
+    rebuilt = compact_index()
+    print(f"[compact] rebuilt shards: {rebuilt or 'none'}; delta merged.")
+
+def _run_command(args: argparse.Namespace, use_daemon: bool = True) -> None:
+    # 常驻服务运行时，写索引的命令转发给它执行，避免两个进程同时写 Delta Index
+    # （路径先转成绝对路径，服务进程的工作目录可能不同）
+    if args.cmd in (None, "sync"):
+        folder = Path(getattr(args, "folder", str(RAW_DIR)))
+        force = bool(getattr(args, "force", False))
+        if use_daemon and daemon.try_call("sync", {"folder": str(folder.resolve()), "force": force}) is not None:
+            print(f"[sync] done by daemon. folder={folder}")
+            return
+        sync_folder(folder, force=force)
+        return
+
+    if args.cmd == "add":
+        paths = [str(Path(x).resolve()) for x in args.paths]
+        if use_daemon and daemon.try_call("add", {"paths": paths, "force": args.force}) is not None:
+            print(f"[add] done by daemon. files={len(paths)}")
+            return
+        pool = get_pool(DB_PATH)
+        with profiling.stage("ingest"):
+            for p in [Path(x) for x in args.paths]:
+                _ingest_one(pool, p, force=args.force)
+            index_pending(pool)
+        return
+
+    if args.cmd == "delete":
+        paths = [str(Path(x).resolve()) for x in args.paths]
+        if use_daemon and daemon.try_call("delete", {"paths": paths}) is not None:
+            print(f"[delete] done by daemon. files={len(paths)}")
+            return
+        # 进程内删除不加载向量模型与 faiss：被提升的重复 chunk 留到下次 sync / add / compact 补充向量
+        delete_paths([Path(x) for x in args.paths], index=False)
+        return
+
+    if args.cmd == "compact":
+        if use_daemon and daemon.try_call("compact") is not None:
+            print("[compact] done by daemon.")
+            return
+        with profiling.stage("compact"):
+            compact_rebuild_index()
+        return
 
 def main():
     parser = argparse.ArgumentParser(prog="python -m app.ingest.ingest")
+    profile_help = "profile this run in-process and write a report under data/kb/profiles/"
+    parser.add_argument("--profile", action="store_true", help=profile_help)
     sub = parser.add_subparsers(dest="cmd")
 
     p_sync = sub.add_parser("sync", help="sync raw folder incrementally (default)")
@@ -170,31 +317,20 @@ def main():
     p_del = sub.add_parser("delete", help="delete specific files (soft delete)")
     p_del.add_argument("paths", nargs="+")
 
-    sub.add_parser("compact", help="rebuild base index from active chunks and clear delta")
-
-    args = parser.parse_args()
-
-    if args.cmd in (None, "sync"):
-        folder = Path(getattr(args, "folder", str(RAW_DIR)))
-        force = bool(getattr(args, "force", False))
-        sync_folder(folder, force=force)
-        return
+    sub.add_parser("compact", help="rebuild changed shards from active chunks and merge delta")
 
-    if args.cmd == "add":
-        conn = connect(DB_PATH)
-        ensure_schema(conn)
-        for p in [Path(x) for x in args.paths]:
-            _ingest_one(conn, p, force=args.force)
-        conn.close()
-        return
+    # 子命令后也接受 --profile（SUPPRESS 避免覆盖写在子命令前的值）
+    for p in (p_sync, p_add, p_del, sub.choices["compact"]):
+        p.add_argument("--profile", action="store_true", default=argparse.SUPPRESS, help=profile_help)
 
-    if args.cmd == "delete":
-        delete_paths([Path(x) for x in args.paths])
-        return
+    args = parser.parse_args()
 
-    if args.cmd == "compact":
-        compact_rebuild_index()
+    if args.profile:
+        # 剖析需要在本进程内执行，不转发给常驻服务
+        with profiling.Profiler(f"ingest-{args.cmd or 'sync'}"):
+            _run_command(args, use_daemon=False)
         return
+    _run_command(args)
 
 if __name__ == "__main__":
     main()
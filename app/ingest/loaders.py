@@ -3,8 +3,6 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-import fitz  # PyMuPDF
-
 """
 文档加载模块
 负责读取不同格式文件（PDF, TXT, MD），统一转换为 DocText 对象。
@@ -45,6 +43,8 @@ def load_pdf(path: Path) -> DocText:
     加载 PDF 文件
     使用 PyMuPDF 提取每一页的文本，并保留页码信息。
     """
+    import fitz  # PyMuPDF，仅在解析 PDF 时加载
+
     doc = fitz.open(path)
     full_text = []
     pages = []
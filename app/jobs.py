@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+"""
+后台任务管理
+负责知识库同步 / 索引重建 / 压缩等长任务的调度、进度上报与取消。
+
+- 同一组任务单飞（single-flight）：同组已有任务在运行时，再次提交直接返回运行中的任务；
+  rebuild 与 compact 同属 "index" 组，避免两个页面同时重建互相覆盖索引。
+- 任务函数运行在工作线程中，内部通过模块级的 report() / advance() / checkpoint()
+  上报进度与检查取消，不在任务中时这些函数为空操作，因此 CLI 调用不受影响。
+- 进度以结构化事件推送给订阅者（UI 面板），不再劫持 stdout。
+"""
+
+# 任务类型 -> 单飞分组
+JOB_GROUPS = {
+    "sync": "sync",
+    "rebuild": "index",
+    "compact": "index",
+}
+
+# 进度事件的最小推送间隔（秒），避免逐条 chunk 刷屏
+REPORT_INTERVAL = 0.5
+
+
+class JobCancelled(Exception):
+    """任务在检查点处发现已被取消"""
+
+
+class Job:
+    """
+    单个后台任务的状态
+    state: pending / running / done / failed / cancelled
+    """
+    def __init__(self, job_id: int, job_type: str, manager: "JobManager") -> None:
+        self.id = job_id
+        self.type = job_type
+        self.state = "pending"
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+        self.unit = ""
+        self.message = ""
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Future = Future()
+        self._cancel = threading.Event()
+        self._manager = manager
+        self._stage_started = time.time()
+        self._last_emit = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        """请求取消，任务在下一个检查点停止"""
+        self._cancel.set()
+
+    def checkpoint(self) -> None:
+        """取消检查点"""
+        if self._cancel.is_set():
+            raise JobCancelled(f"{self.type} cancelled")
+
+    def report(
+        self,
+        stage: Optional[str] = None,
+        done: Optional[int] = None,
+        total: Optional[int] = None,
+        unit: Optional[str] = None,
+        message: Optional[str] = None,
+    ) -> None:
+        """
+        更新进度并推送事件。切换 stage 时进度与计时重置。
+        :param stage: 阶段名，如 scan / ingest / embed / publish
+        :param done: 已完成数量
+        :param total: 总数量（未知时为 0）
+        :param unit: 单位，如 files / chunks
+        :param message: 附带的日志消息（总是立即推送）
+        """
+        if stage is not None and stage != self.stage:
+            self.stage = stage
+            self.done, self.total, self.unit = 0, 0, ""
+            self._stage_started = time.time()
+        if done is not None:
+            self.done = int(done)
+        if total is not None:
+            self.total = int(total)
+        if unit is not None:
+            self.unit = unit
+        if message is not None:
+            self.message = message
+        self._emit(force=stage is not None or message is not None)
+
+    def advance(self, n: int = 1) -> None:
+        """完成数量累加 n"""
+        self.done += int(n)
+        self._emit()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态的事件字典（含吞吐与 ETA）"""
+        now = time.time()
+        elapsed = now - self._stage_started
+        rate = self.done / elapsed if self.done and elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate and self.total > self.done else None
+        return {
+            "id": self.id,
+            "type": self.type,
+            "state": self.state,
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "unit": self.unit,
+            "rate": rate,
+            "eta": eta,
+            "message": self.message,
+            "error": self.error,
+            "elapsed": now - (self.started_at or now),
+        }
+
+    def _emit(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._last_emit < REPORT_INTERVAL:
+            return
+        self._last_emit = now
+        self._manager._publish(self.snapshot())
+
+
+# 当前线程正在执行的任务（工作线程内有效）
+_current = threading.local()
+
+
+def current_job() -> Optional[Job]:
+    return getattr(_current, "job", None)
+
+
+def checkpoint() -> None:
+    """在当前任务中检查取消；不在任务中时为空操作"""
+    job = current_job()
+    if job is not None:
+        job.checkpoint()
+
+
+def report(**kwargs) -> None:
+    """在当前任务中上报进度，参数同 Job.report；不在任务中时为空操作"""
+    job = current_job()
+    if job is not None:
+        job.report(**kwargs)
+
+
+def advance(n: int = 1) -> None:
+    """在当前任务中累加进度；不在任务中时为空操作"""
+    job = current_job()
+    if job is not None:
+        job.advance(n)
+
+
+class JobManager:
+    """
+    后台任务调度器
+    每个单飞分组一个工作线程；订阅者回调在工作线程中被调用，UI 需自行切回事件循环。
+    """
+    def __init__(self, history: int = 20) -> None:
+        """
+        :param history: 保留的已结束任务数量
+        """
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._running: Dict[str, Job] = {}  # group -> job
+        self._jobs: List[Job] = []
+        self._history = history
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self._executor = ThreadPoolExecutor(max_workers=len(set(JOB_GROUPS.values())), thread_name_prefix="kb-job")
+
+    def submit(self, job_type: str, fn: Callable[[], Any]) -> Job:
+        """
+        提交任务。同组已有任务在运行时不会重复启动，直接返回运行中的任务。
+        :param job_type: 任务类型，见 JOB_GROUPS
+        :param fn: 无参任务函数，在工作线程中执行
+        """
+        group = JOB_GROUPS.get(job_type)
+        if group is None:
+            raise ValueError(f"Unknown job type: {job_type}")
+        with self._lock:
+            running = self._running.get(group)
+            if running is not None:
+                return running
+            job = Job(next(self._ids), job_type, self)
+            self._running[group] = job
+            self._jobs.append(job)
+            finished = [j for j in self._jobs if j.finished_at is not None]
+            for old in finished[:max(0, len(finished) - self._history)]:
+                self._jobs.remove(old)
+        self._publish(job.snapshot())
+        self._executor.submit(self._run, job, group, fn)
+        return job
+
+    def _run(self, job: Job, group: str, fn: Callable[[], Any]) -> None:
+        _current.job = job
+        job.state = "running"
+        job.started_at = time.time()
+        self._publish(job.snapshot())
+        result: Any = None
+        error: Optional[BaseException] = None
+        try:
+            job.checkpoint()
+            result = fn()
+            job.state = "done"
+        except JobCancelled as e:
+            job.state = "cancelled"
+            error = e
+        except BaseException as e:
+            job.state = "failed"
+            job.error = str(e)
+            error = e
+            traceback.print_exc()
+        finally:
+            _current.job = None
+            job.finished_at = time.time()
+            # 先释放单飞位置再通知等待方，等待方收到结果后可以立即提交下一次任务
+            with self._lock:
+                if self._running.get(group) is job:
+                    del self._running[group]
+        self._publish(job.snapshot())
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    def cancel(self, job_id: int) -> bool:
+        """请求取消指定任务，返回任务是否存在且仍在进行"""
+        with self._lock:
+            for job in self._running.values():
+                if job.id == job_id:
+                    job.cancel()
+                    return True
+        return False
+
+    def jobs(self) -> List[Dict[str, Any]]:
+        """所有保留任务的状态快照（按提交顺序）"""
+        with self._lock:
+            return [j.snapshot() for j in self._jobs]
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]) -> Callable[[], None]:
+        """
+        订阅任务事件。
+        :param callback: callback(event_dict)，在工作线程中调用
+        :return: 取消订阅函数
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+        def unsubscribe() -> None:
+            with self._lock:
+                if callback in self._listeners:
+                    self._listeners.remove(callback)
+        return unsubscribe
+
+    def _publish(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            listeners = list(self._listeners)
+        for cb in listeners:
+            try:
+                cb(event)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+import traceback
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+"""
+进程内指标注册表
+计数器（Counter）、仪表（Gauge）与直方图（Histogram），以 Prometheus 文本格式导出（Web 服务的 /metrics），
+并为设置面板的 "Performance" 卡片提供快照。
+
+- 指标在模块导入时通过 counter() / gauge() / histogram() 声明（同名重复声明返回同一对象）；
+- 直方图除累计分桶外还保留最近 HISTOGRAM_WINDOW 个样本，用于计算滚动分位数（p50 / p95）；
+- 需要在抓取时才计算的指标（索引大小、墓碑比例等）通过 register_collector() 注册回调。
+"""
+
+# 直方图用于计算滚动分位数的最近样本数
+HISTOGRAM_WINDOW = 1024
+
+# 默认分桶（秒）：覆盖毫秒级检索到数十秒的生成
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """单调递增计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, n: float = 1.0) -> None:
+        with self._lock:
+            self._value += n
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def samples(self) -> List[tuple]:
+        return [(self.name, "", self._value)]
+
+
+class Gauge:
+    """可增可减的瞬时值"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, v: float) -> None:
+        self._value = float(v)
+
+    def inc(self, n: float = 1.0) -> None:
+        with self._lock:
+            self._value += n
+
+    def dec(self, n: float = 1.0) -> None:
+        with self._lock:
+            self._value -= n
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def samples(self) -> List[tuple]:
+        return [(self.name, "", self._value)]
+
+
+class Histogram:
+    """累计分桶直方图，附带最近样本窗口用于滚动分位数"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._window: deque = deque(maxlen=HISTOGRAM_WINDOW)
+        self._lock = threading.Lock()
+
+    def observe(self, v: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, v)] += 1
+            self._sum += v
+            self._count += 1
+            self._window.append(v)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def percentile(self, q: float) -> Optional[float]:
+        """最近窗口内的分位数（q 取 0~1），无样本时返回 None"""
+        with self._lock:
+            data = sorted(self._window)
+        if not data:
+            return None
+        idx = min(len(data) - 1, max(0, math.ceil(q * len(data)) - 1))
+        return data[idx]
+
+    def samples(self) -> List[tuple]:
+        with self._lock:
+            counts, total, n = list(self._counts), self._sum, self._count
+        out = []
+        acc = 0
+        for le, c in zip(list(self.buckets) + [math.inf], counts):
+            acc += c
+            out.append((f"{self.name}_bucket", f'le="{_fmt(le)}"', acc))
+        out.append((f"{self.name}_sum", "", total))
+        out.append((f"{self.name}_count", "", n))
+        return out
+
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class Registry:
+    """指标注册表"""
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, buckets=buckets)
+
+    def register_collector(self, key: str, fn: Callable[[], Dict[str, float]]) -> None:
+        """
+        注册抓取时调用的回调，返回 {指标名: 值}（按 gauge 导出）。
+        :param key: 回调标识，同一 key 重复注册时替换
+        """
+        with self._lock:
+            self._collectors[key] = fn
+
+    def collect(self) -> Dict[str, float]:
+        """调用所有回调，单个回调失败不影响其他指标"""
+        with self._lock:
+            collectors = list(self._collectors.values())
+        values: Dict[str, float] = {}
+        for fn in collectors:
+            try:
+                values.update(fn())
+            except Exception:
+                traceback.print_exc()
+        return values
+
+    def render_prometheus(self) -> str:
+        """Prometheus 文本格式（exposition format 0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                lines.append(f"{name}{{{labels}}} {_fmt(value)}" if labels else f"{name} {_fmt(value)}")
+        for name, value in self.collect().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_fmt(float(value))}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        供界面显示的快照：
+        计数器 / 仪表为数值；直方图为 {"count", "sum", "p50", "p95"}；另含 collector 的结果。
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        out: Dict[str, Any] = {}
+        for m in metrics:
+            if isinstance(m, Histogram):
+                out[m.name] = {
+                    "count": m.count,
+                    "sum": m._sum,
+                    "p50": m.percentile(0.5),
+                    "p95": m.percentile(0.95),
+                }
+            else:
+                out[m.name] = m.value
+        out.update(self.collect())
+        return out
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str) -> Counter:
+    return REGISTRY.counter(name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    return REGISTRY.gauge(name, help)
+
+
+def histogram(name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets=buckets)
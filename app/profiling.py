@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from app import jobs
+from app.config import PROFILES_DIR
+from app.tracing import format_timings
+
+"""
+性能剖析模式（--profile）
+在一次 CLI 调用或一个后台任务期间采集：
+
+- cProfile：函数级耗时，保存为 profile.prof（可用 snakeviz / pstats 查看），报告中列出累计耗时最多的函数；
+- 各阶段（stage）的耗时、RSS 与峰值 RSS，以及 tracemalloc 统计的该阶段新增内存最多的代码行；
+- 每个文档加载器（load_pdf / load_md / load_txt）的调用次数与累计耗时；
+- 入库时逐文件的解析 / 分块 / 写库 / 向量化耗时，按总耗时排序，便于发现异常文档；
+- 检索 / 问答的分阶段追踪耗时（见 app.tracing）。
+
+报告写入 PROFILES_DIR/<时间>-<名称>/（report.txt、report.json、profile.prof）。
+剖析会话绑定在当前线程上（CLI 主线程或后台任务的工作线程），cProfile 也只剖析该线程；
+检索分片线程池等其他线程中的耗时只体现在阶段耗时里。未启用剖析时，stage() / record_file() 为空操作。
+"""
+
+# 报告中列出的函数 / 内存分配 / 文件条数
+DEFAULT_TOP = 25
+
+# 需要单独统计耗时的文档加载器
+LOADER_FUNCS = ("load_pdf", "load_md", "load_txt")
+
+
+def rss_bytes() -> Optional[int]:
+    """当前常驻内存（仅 Linux，读取 /proc/self/statm）"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """进程峰值常驻内存（Linux / macOS，Windows 上返回 None）"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+
+def _mb(n: Optional[float]) -> str:
+    return f"{n / (1 << 20):.1f} MB" if n is not None else "n/a"
+
+
+class Profiler:
+    """
+    一次剖析会话（上下文管理器）
+    with Profiler("sync") as prof:
+        with prof.stage("scan"): ...
+    退出时写出报告，report_dir 为报告目录。
+    """
+    def __init__(self, name: str, out_dir: Path = PROFILES_DIR, top: int = DEFAULT_TOP, trace_malloc: bool = True) -> None:
+        """
+        :param name: 报告名称（用于目录名）
+        :param out_dir: 报告根目录
+        :param top: 报告中列出的条目数
+        :param trace_malloc: 是否启用 tracemalloc（会明显拖慢分配密集的代码）
+        """
+        self.name = re.sub(r"[^\w.-]+", "_", name)[:40] or "profile"
+        self.out_dir = Path(out_dir)
+        self.top = top
+        self.trace_malloc = trace_malloc
+        self.stages: List[Dict[str, Any]] = []
+        self.files: List[Dict[str, Any]] = []
+        self.timings: List[Dict[str, Any]] = []
+        self.report_dir: Optional[Path] = None
+        self._profile = cProfile.Profile()
+        self._started_malloc = False
+        self._t0 = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Profiler":
+        # 解释器同一时间只允许一个 profiler，多个剖析会话依次执行
+        _SESSION_LOCK.acquire()
+        if self.trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._started_malloc = True
+        _current.profiler = self
+        self._t0 = time.perf_counter()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self._profile.disable()
+        wall = time.perf_counter() - self._t0
+        _current.profiler = None
+        try:
+            self.report_dir = self._write_report(wall)
+            print(f"[profile] report written to {self.report_dir}")
+            # 在后台任务中剖析时，报告路径显示在任务日志里
+            jobs.report(message=f"profile report: {self.report_dir}")
+        finally:
+            if self._started_malloc:
+                tracemalloc.stop()
+            _SESSION_LOCK.release()
+        return False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """记录一个阶段的耗时、内存与新增内存最多的代码行"""
+        snap0 = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if snap0 is not None:
+            tracemalloc.reset_peak()
+        rss0 = rss_bytes()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            entry: Dict[str, Any] = {
+                "stage": name,
+                "seconds": seconds,
+                "rss_before": rss0,
+                "rss_after": rss_bytes(),
+                "peak_rss": peak_rss_bytes(),
+            }
+            if snap0 is not None:
+                snap1 = tracemalloc.take_snapshot()
+                entry["traced_peak"] = tracemalloc.get_traced_memory()[1]
+                entry["top_allocations"] = [
+                    {"where": str(s.traceback[0]), "size_diff": s.size_diff, "count_diff": s.count_diff}
+                    for s in snap1.compare_to(snap0, "lineno")[: self.top]
+                    if s.size_diff > 0
+                ]
+            with self._lock:
+                self.stages.append(entry)
+
+    def record_file(self, path: str, **fields: Any) -> None:
+        """记录单个文件的处理耗时（字段如 loader / parse_s / chunk_s / store_s / index_s / chunks）"""
+        fields.setdefault("total_s", sum(v for k, v in fields.items() if k.endswith("_s")))
+        with self._lock:
+            self.files.append({"path": path, **fields})
+
+    def add_timings(self, label: str, timings: Dict[str, Any]) -> None:
+        """附加一次追踪结果（Trace.to_dict()），报告中列出其分阶段耗时"""
+        if timings:
+            with self._lock:
+                self.timings.append({"label": label, **timings})
+
+    # --- 报告 ---
+
+    def _loader_stats(self, stats: pstats.Stats) -> Dict[str, Dict[str, float]]:
+        out: Dict[str, Dict[str, float]] = {}
+        for (filename, _, func), (cc, nc, tt, ct, _) in stats.stats.items():
+            if func in LOADER_FUNCS and filename.endswith("loaders.py"):
+                out[func] = {"calls": nc, "cumulative_s": ct, "self_s": tt}
+        return out
+
+    def _write_report(self, wall: float) -> Path:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        report_dir = self.out_dir / f"{stamp}-{self.name}"
+        n = 1
+        while report_dir.exists():
+            n += 1
+            report_dir = self.out_dir / f"{stamp}-{self.name}-{n}"
+        report_dir.mkdir(parents=True)
+
+        self._profile.dump_stats(str(report_dir / "profile.prof"))
+        stats = pstats.Stats(self._profile)
+        buf = io.StringIO()
+        pstats.Stats(self._profile, stream=buf).sort_stats("cumulative").print_stats(self.top)
+
+        loaders = self._loader_stats(stats)
+        files = sorted(self.files, key=lambda f: f.get("total_s", 0.0), reverse=True)
+        data = {
+            "name": self.name,
+            "wall_s": wall,
+            "peak_rss": peak_rss_bytes(),
+            "stages": self.stages,
+            "loaders": loaders,
+            "files": files,
+            "timings": self.timings,
+        }
+        (report_dir / "report.json").write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+
+        lines = [f"# profile: {self.name}", f"wall time: {wall:.3f}s   peak RSS: {_mb(data['peak_rss'])}", ""]
+        if self.stages:
+            lines.append("## stages")
+            for st in self.stages:
+                lines.append(
+                    f"{st['stage']:<16} {st['seconds']:9.3f}s  rss {_mb(st['rss_before'])} -> {_mb(st['rss_after'])}"
+                    f"  peak RSS {_mb(st['peak_rss'])}  traced peak {_mb(st.get('traced_peak'))}"
+                )
+                for a in st.get("top_allocations", [])[:10]:
+                    lines.append(f"    +{_mb(a['size_diff']):>10}  {a['count_diff']:>8} blocks  {a['where']}")
+            lines.append("")
+        if loaders:
+            lines.append("## loaders")
+            for func, v in sorted(loaders.items(), key=lambda kv: kv[1]["cumulative_s"], reverse=True):
+                lines.append(f"{func:<10} calls={v['calls']:<6} cumulative={v['cumulative_s']:.3f}s")
+            lines.append("")
+        if files:
+            lines.append(f"## slowest files (top {self.top} of {len(files)})")
+            for f in files[: self.top]:
+                detail = " ".join(
+                    f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                    for k, v in f.items() if k not in ("path", "total_s")
+                )
+                lines.append(f"{f['total_s']:8.3f}s  {f['path']}  {detail}")
+            lines.append("")
+        if self.timings:
+            lines.append("## traced timings")
+            for tm in self.timings:
+                lines.append(f"{tm['label']}: {format_timings(tm)}")
+            lines.append("")
+        lines.append("## cProfile (cumulative)")
+        lines.append(buf.getvalue())
+        (report_dir / "report.txt").write_text("\n".join(lines), encoding="utf-8")
+        return report_dir
+
+
+# 同一时间只有一个剖析会话
+_SESSION_LOCK = threading.Lock()
+
+# 当前线程中进行中的剖析会话（cProfile 也只剖析该线程）
+_current = threading.local()
+
+
+def current_profiler() -> Optional[Profiler]:
+    return getattr(_current, "profiler", None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """在当前剖析会话中记录阶段；未剖析时为空操作"""
+    prof = current_profiler()
+    if prof is None:
+        yield
+        return
+    with prof.stage(name):
+        yield
+
+
+def record_file(path: str, **fields: Any) -> None:
+    """在当前剖析会话中记录单个文件的耗时；未剖析时为空操作"""
+    prof = current_profiler()
+    if prof is not None:
+        prof.record_file(path, **fields)
+
+
+def profile_call(name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """在剖析会话中调用 fn（整个调用记为一个同名阶段），返回 fn 的结果"""
+    with Profiler(name) as prof:
+        with prof.stage(name):
+            return fn(*args, **kwargs)
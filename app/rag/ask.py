@@ -2,16 +2,44 @@ from __future__ import annotations
 
 import sys
 import re
-from llama_cpp import Llama
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
 
-from app.config import LLM_GGUF_PATH
-from app.retrieval.retrieve import retrieve_evidence
+from app import daemon, metrics, profiling
+from app.config import CONTEXT_COMPRESS, CONV_REWRITE, LLM_GGUF_PATH, LLM_SPEC_NUM_PRED_TOKENS, LLM_SPECULATIVE, TRACE_ENABLED
+from app.rag.conversation import compact_history, rewrite_query
+from app.tracing import Trace, current_trace, format_timings, record, span, tracing
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama
 
 """
 RAG 问答核心模块
 负责构造 Prompt、调用本地 LLM、管理对话历史。
 """
 
+_PROMPT_TOKENS = metrics.counter("extracthelper_llm_prompt_tokens_total", "Prompt tokens sent to the LLM")
+_COMPLETION_TOKENS = metrics.counter("extracthelper_llm_completion_tokens_total", "Tokens generated by the LLM")
+_PROMPT_EVAL_SECONDS = metrics.histogram("extracthelper_llm_prompt_eval_seconds", "Time to first token (prompt evaluation)")
+_TOKENS_PER_SECOND = metrics.histogram(
+    "extracthelper_llm_tokens_per_second", "Generation speed per answer",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 100),
+)
+_DRAFT_PROPOSED = metrics.counter("extracthelper_llm_draft_proposed_total", "Draft tokens proposed by speculative decoding")
+_DRAFT_ACCEPTED = metrics.counter("extracthelper_llm_draft_accepted_total", "Draft tokens accepted by the main model (estimated)")
+_DRAFT_ACCEPT_RATE = metrics.histogram(
+    "extracthelper_llm_draft_acceptance", "Speculative decoding acceptance rate per answer",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+_CONTEXT_CHARS = metrics.counter("extracthelper_context_chars_total", "Evidence context characters before compression")
+_CONTEXT_CHARS_KEPT = metrics.counter("extracthelper_context_chars_kept_total", "Evidence context characters sent to the LLM")
+
+class GenerationCancelled(RuntimeError):
+    """生成过程被调用方取消（例如浏览器页面已断开）"""
+
+
 def _clean_snippet(text: str, max_len: int = 220) -> str:
     """清理并截断文本片段，用于展示"""
     t = re.sub(r"\s+", " ", (text or "").strip())
@@ -51,52 +79,120 @@ def build_context_for_llm(evidence, per_doc_max_chars: int = 1200, max_total_cha
 
     return "\n\n---\n\n".join(blocks)
 
-def create_llm() -> Llama:
+def create_llm(model_path: Path = LLM_GGUF_PATH, autotune: bool = True, speculative: str = LLM_SPECULATIVE) -> Llama:
     """
     初始化 llama.cpp 模型实例。
+    上下文、线程数、批大小、mmap/mlock、flash attention 见 app.rag.llm_runtime（按主机自动检测，可在 config 中覆盖）。
+    :param model_path: GGUF 文件，默认为 LLM_GGUF_PATH（多模型的选择与卸载见 app.rag.models）
+    :param autotune: 该模型文件尚无调优结果时，加载后运行线程数微基准（见 LLM_AUTOTUNE）
+    :param speculative: 投机解码方式 "none" / "prompt_lookup" / "draft"，默认取 LLM_SPECULATIVE
     """
-    if not LLM_GGUF_PATH.exists():
-        raise FileNotFoundError(f"找不到模型文件: {LLM_GGUF_PATH}")
-
-    # n_ctx=4096: 上下文窗口大小
-    # n_threads=8: CPU 推理线程数
-    llm = Llama(
-        model_path=str(LLM_GGUF_PATH),
-        n_ctx=4096,
-        n_threads=8,
-        verbose=False,
-    )
+    from llama_cpp import Llama  # 延迟导入：只有真正需要生成时才加载 llama.cpp
+    from app.rag.llm_runtime import maybe_autotune, resolve_settings
+    model_path = Path(model_path)
+    if not model_path.exists():
+        raise FileNotFoundError(f"找不到模型文件: {model_path}")
+
+    settings = resolve_settings(model_path)
+    print(f"[llm] {model_path.name}: " + " ".join(f"{k}={v}" for k, v in settings.items()))
+    if speculative != "none":
+        # 投机解码（见 app.rag.speculative），草稿模型经 draft_model 参数接入
+        from app.rag.speculative import create_draft_model
+        draft = create_draft_model(speculative, n_ctx=settings["n_ctx"], n_threads=settings["n_threads"])
+        if draft is not None:
+            settings["draft_model"] = draft
+            print(f"[llm] speculative decoding: {draft.mode} (num_pred_tokens={LLM_SPEC_NUM_PRED_TOKENS})")
+    llm = Llama(model_path=str(model_path), verbose=False, **settings)
+    if autotune:
+        maybe_autotune(llm, model_path)
     return llm
 
 
-def build_system_message() -> dict:
-    """构建系统提示词，规定引用格式"""
-    return {
-        "role": "system",
-        "content": (
-            "你是一个本地知识库助手，请根据提供的资料详细回答问题。"
-            "如果资料内容丰富，请尽可能全面、详细地整理和总结。"
-            "【硬性要求】每句话末尾必须标注引用，格式只能是 [1] 或 [2] 或 [1][2]…（对应 Doc 编号）。"
-            "如果资料不足，直接回答“资料中没有/不确定”，并同样给出引用（引用最相关的 Doc）。"
-            "这是一个多轮对话场景，你需要在保证基于当前轮资料的前提下，结合对话历史保持答案连贯。"
-        ),
-    }
-
-def answer_once(llm: Llama, query: str, history: list[dict] | None = None, top_k: int = 5) -> tuple[str, list[dict]]:
+def build_system_message(summary: str = "") -> dict:
+    """
+    构建系统提示词，规定引用格式
+    :param summary: 较早对话轮次的滚动摘要（见 app.rag.conversation），为空时不附加
+    """
+    content = (
+        "你是一个本地知识库助手，请根据提供的资料详细回答问题。"
+        "如果资料内容丰富，请尽可能全面、详细地整理和总结。"
+        "【硬性要求】每句话末尾必须标注引用，格式只能是 [1] 或 [2] 或 [1][2]…（对应 Doc 编号）。"
+        "如果资料不足，直接回答“资料中没有/不确定”，并同样给出引用（引用最相关的 Doc）。"
+        "这是一个多轮对话场景，你需要在保证基于当前轮资料的前提下，结合对话历史保持答案连贯。"
+    )
+    if summary:
+        content += f"\n\n此前对话摘要：\n{summary}"
+    return {"role": "system", "content": content}
+
+def _record_draft(draft, before: Optional[tuple], completion_tokens: int) -> None:
+    """记录本次生成的投机解码接受情况（指标 + 当前追踪）"""
+    if before is None:
+        return
+    from app.rag.speculative import acceptance
+    stats = acceptance(before, draft.counts(), completion_tokens)
+    if stats is None:
+        return
+    _DRAFT_PROPOSED.inc(stats["proposed"])
+    _DRAFT_ACCEPTED.inc(stats["accepted"])
+    _DRAFT_ACCEPT_RATE.observe(stats["rate"])
+    record("draft_proposed", stats["proposed"])
+    record("draft_acceptance", round(stats["rate"], 3))
+
+def answer_once(
+    llm: Llama,
+    query: str,
+    history: list[dict] | None = None,
+    top_k: int = 5,
+    cancel_event: Optional[threading.Event] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    compress: Optional[bool] = None,
+) -> tuple[str, list[dict]]:
     """
     执行单次问答交互。
     
-    1. 检索 Top K 证据。
-    2. 构造 Prompt（System + History + Current User Input with Context）。
-    3. 调用 LLM 生成回答。
+    1. 把追问改写为独立的检索问题（CONV_REWRITE），检索 Top K 证据。
+    2. 把每条证据压缩为与问题最相关的句子（CONTEXT_COMPRESS，见 app.rag.compress）。
+    3. 构造 Prompt（System + 较早轮次摘要 + 最近几轮 History + Current User Input with Context）。
+    4. 调用 LLM 生成回答。
     
-    :return: (回答文本, 证据列表)
+    :param cancel_event: 可选的取消信号，生成过程中每个 token 检查一次，置位后抛出 GenerationCancelled
+    :param on_token: 可选的流式回调，每生成一段文本调用一次 on_token(text)
+    :param compress: 是否压缩证据，None 时取 CONTEXT_COMPRESS
+    :return: (回答文本, 证据列表)；证据为未压缩的原文
     """
+    from app.retrieval.retrieve import retrieve_evidence
+
     if history is None:
         history = []
 
-    evidence = retrieve_evidence(query, top_k=top_k)
-    context = build_context_for_llm(evidence)
+    search_query = query
+    if CONV_REWRITE and history:
+        with span("rewrite"):
+            search_query = rewrite_query(query, history, llm)
+        if search_query != query:
+            record("search_query", search_query)
+    with span("retrieve"):
+        evidence = retrieve_evidence(search_query, top_k=top_k)
+    compressed = 0
+    if (CONTEXT_COMPRESS if compress is None else compress) and evidence:
+        from app.rag.compress import compress_evidence
+        with span("compress"):
+            prompt_evidence, compressed = compress_evidence(search_query, evidence)
+    with span("build_context"):
+        context = build_context_for_llm(evidence)
+        # 压缩前后按同样的上下文格式（含逐条 / 总长截断）比较长度
+        full_chars = len(context)
+        if compressed:
+            context = build_context_for_llm(prompt_evidence)
+        # 历史只原样保留最近几轮，更早的轮次折叠为摘要，prompt 不随会话增长
+        recent, summary = compact_history(history, llm)
+        if len(recent) < len(history):
+            record("history_folded", len(history) - len(recent))
+    _CONTEXT_CHARS.inc(full_chars)
+    _CONTEXT_CHARS_KEPT.inc(len(context))
+    record("context_chars", len(context))
+    if compressed:
+        record("context_chars_uncompressed", full_chars)
 
     user_content = (
         "下面是当前轮检索到的资料，请严格基于这些资料回答当前问题。"
@@ -105,17 +201,80 @@ def answer_once(llm: Llama, query: str, history: list[dict] | None = None, top_k
         f"{context}\n\n当前问题：{query}"
     )
 
-    messages = [build_system_message()]
-    messages.extend(history)
+    messages = [build_system_message(summary)]
+    messages.extend(recent)
     messages.append({"role": "user", "content": user_content})
 
-    out = llm.create_chat_completion(
+    if cancel_event is not None and cancel_event.is_set():
+        raise GenerationCancelled()
+
+    traced = current_trace() is not None
+    draft = getattr(llm, "draft_model", None)
+    draft_before = draft.counts() if hasattr(draft, "counts") else None
+    if cancel_event is None and on_token is None and not traced:
+        out = llm.create_chat_completion(
+            messages=messages,
+            temperature=0.2, # 低温度以减少幻觉
+            max_tokens=2048,
+        )
+        answer = out["choices"][0]["message"]["content"]
+        usage = out.get("usage") or {}
+        _PROMPT_TOKENS.inc(usage.get("prompt_tokens") or 0)
+        _COMPLETION_TOKENS.inc(usage.get("completion_tokens") or 0)
+        _record_draft(draft, draft_before, usage.get("completion_tokens") or 0)
+        return answer, evidence
+
+    # 可取消 / 流式 / 追踪模式：逐 token 检查取消信号并回调；关闭生成器即停止 llama.cpp 推理
+    # 追踪时以首个 token 到达为界，拆分 prompt 处理（prompt_eval）与逐 token 生成（generate）
+    t0 = time.perf_counter()
+    t_first: Optional[float] = None
+    n_tokens = 0
+    stream = llm.create_chat_completion(
         messages=messages,
-        temperature=0.2, # 低温度以减少幻觉
+        temperature=0.2,
         max_tokens=2048,
+        stream=True,
     )
-    answer = out["choices"][0]["message"]["content"]
-    return answer, evidence
+    parts: list[str] = []
+    try:
+        for chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled()
+            if t_first is None:
+                t_first = time.perf_counter()
+            text = chunk["choices"][0]["delta"].get("content") or ""
+            if text:
+                n_tokens += 1
+            parts.append(text)
+            if text and on_token is not None:
+                on_token(text)
+    finally:
+        stream.close()
+
+    t_end = time.perf_counter()
+    t_first = t_first or t_end
+    # 流式输出每个 chunk 对应一个 token；n_tokens 为上下文中的 token 总数（prompt + 生成）
+    ctx_tokens = getattr(llm, "n_tokens", None)
+    prompt_tokens = ctx_tokens - n_tokens if isinstance(ctx_tokens, int) and ctx_tokens >= n_tokens else None
+    tokens_per_s = n_tokens / (t_end - t_first) if t_end > t_first else None
+
+    _PROMPT_EVAL_SECONDS.observe(t_first - t0)
+    _PROMPT_TOKENS.inc(prompt_tokens or 0)
+    _COMPLETION_TOKENS.inc(n_tokens)
+    if tokens_per_s is not None and n_tokens > 1:
+        _TOKENS_PER_SECOND.observe(tokens_per_s)
+    _record_draft(draft, draft_before, n_tokens)
+
+    if traced:
+        trace = current_trace()
+        trace.add_span("prompt_eval", (t_first - t0) * 1e3)
+        trace.add_span("generate", (t_end - t_first) * 1e3)
+        if prompt_tokens is not None:
+            record("prompt_tokens", prompt_tokens)
+        record("completion_tokens", n_tokens)
+        if tokens_per_s is not None:
+            record("tokens_per_s", round(tokens_per_s, 2))
+    return "".join(parts), evidence
 
 def print_answer_and_refs(answer: str, evidence: list[dict]) -> None:
     """格式化打印回答和引用"""
@@ -129,18 +288,95 @@ def print_answer_and_refs(answer: str, evidence: list[dict]) -> None:
         print(f"[{i}] (Doc{i}) {e['filename']}{page_str} (score={e['score']:.4f}, chunk_id={e['chunk_id']})")
         print(f"    {_clean_snippet(e['content'], 240)}\n")
 
-def run_single_turn(query: str) -> None:
-    """单轮命令行模式"""
-    llm = create_llm()
-    answer, evidence = answer_once(llm, query, history=[])
+def _ask_via_daemon(
+    info: dict | None, query: str, history: list[dict], model: str | None = None
+) -> tuple[str, list[dict], dict] | None:
+    """转发给常驻服务，服务未运行或连接中断时返回 None"""
+    if info is None:
+        return None
+    resp = daemon.try_call("ask", {"query": query, "history": history, "model": model}, info=info)
+    if resp is None:
+        return None
+    result = resp["result"]
+    return result["answer"], result["evidence"], result.get("timings") or {}
+
+
+def _ask_local(llm: Llama, query: str, history: list[dict]) -> tuple[str, list[dict], dict]:
+    """进程内问答并记录各阶段耗时"""
+    trace = Trace() if TRACE_ENABLED else None
+    with tracing(trace):
+        answer, evidence = answer_once(llm, query, history=history)
+    timings = trace.to_dict() if trace is not None else {}
+    prof = profiling.current_profiler()
+    if prof is not None:
+        prof.add_timings(query[:60], timings)
+    return answer, evidence, timings
+
+
+_registry = None
+
+
+def _load_llm(model: str | None = None, question: str = "") -> Llama:
+    """
+    进程内加载模型（同一进程中已加载的模型直接复用）
+    :param model: 模型名，见 ModelRegistry.resolve
+    """
+    global _registry
+    if _registry is None:
+        from app.rag.models import ModelRegistry
+        # 命令行单线程使用，不需要后台空闲卸载
+        _registry = ModelRegistry(idle_seconds=0)
+    with profiling.stage("llm_load"):
+        entry = _registry.checkout(_registry.resolve(model, question))
+        _registry.checkin(entry)
+        return entry.llm
+
+
+def _print_timings(timings: dict) -> None:
+    if timings:
+        print(f"[timing] {format_timings(timings)}")
+
+
+def run_single_turn(query: str, profile: bool = False, model: str | None = None) -> None:
+    """
+    单轮命令行模式（常驻服务运行时转发给它，否则在进程内加载模型）
+    :param profile: 在进程内执行并写出剖析报告（见 app.profiling）
+    :param model: 模型名（--model），见 ModelRegistry.resolve
+    """
+    if profile:
+        with profiling.Profiler("ask"):
+            llm = _load_llm(model, query)
+            with profiling.stage("ask"):
+                result = _ask_local(llm, query, [])
+    else:
+        result = _ask_via_daemon(daemon.connect(), query, [], model)
+        if result is None:
+            llm = _load_llm(model, query)
+            result = _ask_local(llm, query, [])
+    answer, evidence, timings = result
     print_answer_and_refs(answer, evidence)
+    _print_timings(timings)
 
 
-def run_chat() -> None:
-    """交互式多轮对话模式"""
+def run_chat(profile: bool = False, model: str | None = None) -> None:
+    """
+    交互式多轮对话模式
+    :param profile: 在进程内执行，退出时写出整个会话的剖析报告（每轮为一个阶段）
+    :param model: 模型名（--model），见 ModelRegistry.resolve
+    """
     print("进入多轮对话模式。输入内容后回车提问，输入 exit/quit 退出。")
-    llm = create_llm()
+    if profile:
+        with profiling.Profiler("chat"):
+            _chat_loop(None, model)
+        return
+    _chat_loop(daemon.connect(), model)
+
+
+def _chat_loop(info: dict | None, model: str | None = None) -> None:
+    if info is not None:
+        print(f"(使用常驻服务 pid={info['pid']})")
     history: list[dict] = []
+    turn = 0
 
     while True:
         try:
@@ -157,8 +393,17 @@ def run_chat() -> None:
             print("已退出。")
             break
 
-        answer, evidence = answer_once(llm, user_input, history=history)
+        result = _ask_via_daemon(info, user_input, history, model)
+        if result is None:
+            # 常驻服务不可用（或中途退出）：切换到进程内模型
+            info = None
+            llm = _load_llm(model, user_input)
+            turn += 1
+            with profiling.stage(f"turn{turn}"):
+                result = _ask_local(llm, user_input, history)
+        answer, evidence, timings = result
         print_answer_and_refs(answer, evidence)
+        _print_timings(timings)
 
         # 更新历史（仅保留原始问答，不包含庞大的 Context，防止 Prompt 爆炸）
         history.append({"role": "user", "content": user_input})
@@ -166,12 +411,23 @@ def run_chat() -> None:
 
 
 def main():
-    if len(sys.argv) < 2:
-        run_chat()
+    argv = sys.argv[1:]
+    profile = "--profile" in argv
+    argv = [a for a in argv if a != "--profile"]
+    model = None
+    if "--model" in argv:
+        i = argv.index("--model")
+        if i + 1 >= len(argv):
+            print("用法: python -m app.rag.ask [--profile] [--model 模型名] [问题]")
+            sys.exit(2)
+        model = argv[i + 1]
+        del argv[i:i + 2]
+    if not argv:
+        run_chat(profile=profile, model=model)
         return
 
-    query = " ".join(sys.argv[1:])
-    run_single_turn(query)
+    query = " ".join(argv)
+    run_single_turn(query, profile=profile, model=model)
 
 
 if __name__ == "__main__":
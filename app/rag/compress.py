@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from app.config import (
+    CONTEXT_COMPRESS_MIN_CHARS,
+    CONTEXT_COMPRESS_NEIGHBORS,
+    CONTEXT_COMPRESS_TOP_SENTENCES,
+    EMBED_MODEL_NAME,
+)
+
+"""
+证据压缩（抽取式）
+检索到的 chunk 往往只有两三句与问题相关，而 CPU 上 prompt 处理耗时与 prompt 长度成正比。
+构造 prompt 前把每条证据切分为句子，用已加载的向量模型计算句子与问题的相似度
+（问题与所有证据的全部句子合并为一次 encode 调用），每条证据保留得分最高的几句及其前后相邻句，
+按原文顺序拼接，省略处以 "…" 标记。
+
+- 证据条数与顺序不变，[DocN] 编号仍对应原证据（界面与引用展示原文）；
+- 短证据（CONTEXT_COMPRESS_MIN_CHARS）与句子数不多的证据原样保留。
+"""
+
+# 句子边界：中文句末标点之后、换行处、英文句号 / 问号 / 叹号后的空白（不切分 "1." 这类编号）
+_SENT_SPLIT = re.compile(r"(?<=[。！？；!?;])|\n+|(?<=[^\d\s][.!?])\s+")
+# 短于该字符数的片段并入前一句（如列表编号、标题残片）
+_MIN_SENTENCE_CHARS = 6
+_GAP = " … "
+
+
+def _sep(prev: str) -> str:
+    """拼接两句时的分隔符：中文句末标点后不加空格"""
+    return "" if prev.endswith(("。", "！", "？", "；")) else " "
+
+
+def split_sentences(text: str) -> List[str]:
+    """把文本切分为句子（过短的片段并入前一句）"""
+    out: List[str] = []
+    for piece in _SENT_SPLIT.split(text or ""):
+        piece = re.sub(r"[ \t]+", " ", piece).strip()
+        if not piece:
+            continue
+        if out and (len(piece) < _MIN_SENTENCE_CHARS or len(out[-1]) < _MIN_SENTENCE_CHARS):
+            out[-1] = out[-1] + _sep(out[-1]) + piece
+        else:
+            out.append(piece)
+    return out
+
+
+def select_sentences(
+    scores: np.ndarray,
+    top_n: int = CONTEXT_COMPRESS_TOP_SENTENCES,
+    neighbors: int = CONTEXT_COMPRESS_NEIGHBORS,
+) -> List[int]:
+    """得分最高的 top_n 句及其前后 neighbors 句的下标（升序）"""
+    n = len(scores)
+    keep = set()
+    for i in np.argsort(-scores)[:top_n]:
+        keep.update(range(max(0, int(i) - neighbors), min(n, int(i) + neighbors + 1)))
+    return sorted(keep)
+
+
+def _join(sentences: List[str], keep: List[int]) -> str:
+    """按原文顺序拼接保留的句子，不连续处（含首尾）插入省略号"""
+    parts: List[str] = []
+    prev = -1
+    for i in keep:
+        if i != prev + 1:
+            parts.append(_GAP.strip() if not parts else _GAP)
+        elif parts:
+            parts.append(_sep(parts[-1]))
+        parts.append(sentences[i])
+        prev = i
+    if keep and keep[-1] != len(sentences) - 1:
+        parts.append(_GAP.rstrip())
+    return "".join(parts)
+
+
+def compress_evidence(query: str, evidence: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    压缩证据内容，返回 (新证据列表, 被压缩的证据条数)。
+    新列表与输入一一对应（仅 content 被替换为压缩后的文本），输入不被修改。
+    压缩前后的 prompt 长度由调用方按同样的上下文格式（build_context_for_llm 的截断）比较。
+    """
+    window = CONTEXT_COMPRESS_TOP_SENTENCES + 2 * CONTEXT_COMPRESS_NEIGHBORS
+    split: List[Tuple[int, List[str]]] = []
+    for idx, e in enumerate(evidence):
+        content = e.get("content") or ""
+        if len(content) < CONTEXT_COMPRESS_MIN_CHARS:
+            continue
+        sentences = split_sentences(content)
+        if len(sentences) > window:
+            split.append((idx, sentences))
+
+    out = list(evidence)
+    if not split:
+        return out, 0
+
+    from app.retrieval.embedder import get_embedder
+    texts = [query] + [s for _, sentences in split for s in sentences]
+    vecs = get_embedder(EMBED_MODEL_NAME).encode(texts, show_progress_bar=False)
+    # 向量已归一化，点积即余弦相似度
+    scores = vecs[1:] @ vecs[0]
+
+    pos = 0
+    compressed = 0
+    for idx, sentences in split:
+        keep = select_sentences(scores[pos:pos + len(sentences)])
+        pos += len(sentences)
+        text = _join(sentences, keep)
+        if len(text) < len(evidence[idx].get("content") or ""):
+            out[idx] = {**evidence[idx], "content": text}
+            compressed += 1
+    return out, compressed
@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+from app import metrics
+from app.config import (
+    CONV_KEEP_TURNS,
+    CONV_REWRITE_LLM,
+    CONV_REWRITE_MAX_TOKENS,
+    CONV_SUMMARY_LLM,
+    CONV_SUMMARY_MAX_CHARS,
+    CONV_SUMMARY_MAX_TOKENS,
+    CONV_TURN_MAX_CHARS,
+)
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+
+"""
+多轮对话状态
+answer_once 在检索与构造 prompt 之前调用：
+
+- rewrite_query：把依赖上文的追问改写为独立的检索问题。先用规则消解
+  （"第二个" / "the second one" 映射到上一轮回答中的第 N 个列表项（该项存在时），代词 / "呢" 式追问拼接上一轮问题），
+  开启 CONV_REWRITE_LLM 时再用一次短生成（最多 CONV_REWRITE_MAX_TOKENS 个 token）改写，失败时保留规则结果；
+- compact_history：最近 CONV_KEEP_TURNS 轮原样发送（单条截断到 CONV_TURN_MAX_CHARS），
+  更早的轮次折叠为不超过 CONV_SUMMARY_MAX_CHARS 字的滚动摘要，随会话增长 prompt 中的历史开销保持有界。
+  摘要按折叠部分的内容哈希缓存，下一轮只需把新折叠的一轮并入上一轮的摘要。
+
+用法: python -m app.rag.conversation（运行规则改写的回归用例，修改规则后执行）
+"""
+
+_REWRITES = metrics.counter("extracthelper_query_rewrites_total", "Follow-up questions rewritten into standalone retrieval queries")
+_REWRITES_LLM = metrics.counter("extracthelper_query_rewrites_llm_total", "Query rewrites produced by the LLM")
+_SUMMARY_FOLDS = metrics.counter("extracthelper_history_summary_folds_total", "Turns folded into the rolling history summary")
+
+# 改写后检索问题的最大长度
+MAX_QUERY_CHARS = 200
+# 滚动摘要缓存条数（键为折叠部分的内容哈希，跨会话共享）
+SUMMARY_CACHE_SIZE = 256
+
+_CN_NUM = {"一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+_EN_ORD = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10, "last": -1,
+}
+
+# 序数必须带量词（"第二个"、"最后一种"），"第一章"、"第三次" 不是指代
+_ORDINAL_CN = re.compile(r"(?:第([一二两三四五六七八九十\d]+)|最后一)(?:个|种|条|点|项|步|类|部分)")
+_ORDINAL_EN = re.compile(r"\bthe\s+(" + "|".join(_EN_ORD) + r")(?:\s+(?:one|item|point|step|option))?\b", re.I)
+# 指代代词只在句首（"这个算法为什么…"）或短问句（"为什么它更快"）中计入：
+# 完整的问题往往自己点明了主题，句中的 "这个" 指的是前文已出现的名词（"Dijkstra 算法…为什么这个算法…"）
+_PRONOUN_CN = re.compile(r"它们|它|他们|这个|那个|这种|那种|这些|那些|上述|上面|前面|刚才")
+_PRONOUN_EN = re.compile(r"\b(?:they|them|their|these|those|what about|how about)\b", re.I)
+# 常出现在独立问题中的代词：中文只在句首计入（排除 "其他"、"其中"、"该怎么" 等），
+# 英文只在短问句中计入（"how does it work"，而非 "what is a B-tree and how does it work"）
+_WEAK_PRONOUN_CN = re.compile(r"^(?:其(?![他它中实余次])|该(?!怎|如何|不|是|用|选))")
+_WEAK_PRONOUN_EN = re.compile(r"\b(?:it|its|this|that)\b", re.I)
+# 句首判断时跳过的引导词（"那这个呢"、"so they are…"）
+_LEAD = re.compile(r"^[\s，,]*(?:那么|那|请问|所以|and|so|then)?[\s，,]*", re.I)
+# 短问句：中文不超过 _SHORT_CHARS 个字符，英文不超过 _SHORT_WORDS 个词
+_SHORT_CHARS = 12
+_SHORT_WORDS = 5
+_TRAILING_NE = re.compile(r"呢[？?]*$")
+_LIST_ITEM = re.compile(r"^\s*(?:\d+[.、)）]|[-*•])\s*(.+)$", re.M)
+_CITATION = re.compile(r"\[\d+\]")
+_SENTENCE_END = re.compile(r"(?<=[。！？!?；;])|(?<=[^\d\s]\.)\s")
+
+
+def _strip(text: str) -> str:
+    """去掉引用标记与多余空白"""
+    return re.sub(r"\s+", " ", _CITATION.sub("", text or "")).strip()
+
+
+def _clip(text: str, n: int) -> str:
+    return text if len(text) <= n else text[:n] + "…"
+
+
+def _first_sentence(text: str, n: int = 120) -> str:
+    text = _strip(text)
+    parts = [p for p in _SENTENCE_END.split(text) if p and p.strip()]
+    return _clip(parts[0].strip() if parts else text, n)
+
+
+def _last(history: list[dict], role: str) -> Optional[int]:
+    """最后一条 role 消息的下标"""
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].get("role") == role and history[i].get("content"):
+            return i
+    return None
+
+
+def _ordinal(query: str) -> Optional[tuple[int, str]]:
+    """查询中的序数指代，返回 (序号, 匹配文本)；-1 表示最后一个"""
+    m = _ORDINAL_CN.search(query)
+    if m:
+        if m.group(1) is None:
+            return -1, m.group(0)
+        s = m.group(1)
+        if s.isdigit():
+            return int(s), m.group(0)
+        if s in _CN_NUM:
+            return _CN_NUM[s], m.group(0)
+        return None
+    m = _ORDINAL_EN.search(query)
+    if m:
+        return _EN_ORD[m.group(1).lower()], m.group(0)
+    return None
+
+
+def _list_item(answer: str, n: int) -> Optional[str]:
+    """上一轮回答中的第 n 个列表项（取冒号前的标题部分）"""
+    items = [_strip(i) for i in _LIST_ITEM.findall(answer or "")]
+    items = [i for i in items if i]
+    if not items or n == 0 or abs(n) > len(items):
+        return None
+    item = items[n - 1] if n > 0 else items[n]
+    head = re.split(r"[：:]", item, maxsplit=1)[0].strip(" *")
+    return _clip(head or item, 60)
+
+
+def _is_short(q: str) -> bool:
+    if re.search(r"[\u4e00-\u9fff]", q):
+        return len(q) <= _SHORT_CHARS
+    return len(q.split()) <= _SHORT_WORDS
+
+
+def _refers_back(q: str) -> bool:
+    """以代词开头，或为含代词 / 以 "呢" 结尾的短省略问句"""
+    head = _LEAD.sub("", q, count=1)
+    if _PRONOUN_CN.match(head) or _PRONOUN_EN.match(head) or _WEAK_PRONOUN_CN.search(head):
+        return True
+    if not _is_short(q):
+        return False
+    return bool(
+        _PRONOUN_CN.search(q) or _PRONOUN_EN.search(q) or _WEAK_PRONOUN_EN.search(q) or _TRAILING_NE.search(q)
+    )
+
+
+def is_follow_up(query: str) -> bool:
+    """是否为依赖上文的追问（含代词 / 序数指代，或以 "呢" 结尾的短省略问句）"""
+    q = query.strip()
+    return bool(_ordinal(q) or _refers_back(q))
+
+
+def rewrite_rule(query: str, history: list[dict], depth: int = 3) -> Optional[str]:
+    """
+    规则改写；不是追问或没有可用的上文时返回 None
+    :param depth: 上一轮问题本身也是追问时，向前消解的最大轮数
+    """
+    q = query.strip()
+    i = _last(history, "user")
+    if i is None:
+        return None
+    ordinal = _ordinal(q)
+    if ordinal is not None:
+        # 只有上一轮回答确实有第 N 个列表项时才按序数消解
+        j = _last(history, "assistant")
+        item = _list_item(history[j]["content"], ordinal[0]) if j is not None else None
+        if item:
+            # "第二个的复杂度呢" -> "<第二项> 的复杂度"
+            return _clip(_TRAILING_NE.sub("", q.replace(ordinal[1], f"{item} ", 1)).strip(), MAX_QUERY_CHARS)
+    if not _refers_back(q):
+        return None
+    # 代词 / 省略：拼接上一轮（消解后的）问题作为主题
+    prev_q = history[i]["content"]
+    if depth > 1:
+        prev_q = rewrite_rule(prev_q, history[:i], depth - 1) or prev_q
+    rest = _TRAILING_NE.sub("", q).strip()
+    return _clip(f"{_strip(prev_q)} {rest}".strip(), MAX_QUERY_CHARS)
+
+
+def _rewrite_llm(llm: Llama, query: str, history: list[dict]) -> Optional[str]:
+    recent = "\n".join(
+        f"{'用户' if m['role'] == 'user' else '助手'}：{_clip(_strip(m['content']), 200)}"
+        for m in history[-4:] if m.get("content")
+    )
+    out = llm.create_chat_completion(
+        messages=[
+            {"role": "system", "content": "把用户的追问改写为不依赖上文、可独立检索的问题。只输出改写后的问题，不要回答。"},
+            {"role": "user", "content": f"对话：\n{recent}\n\n追问：{query}"},
+        ],
+        temperature=0.0,
+        max_tokens=CONV_REWRITE_MAX_TOKENS,
+    )
+    text = (out["choices"][0]["message"]["content"] or "").strip()
+    text = text.splitlines()[0].strip().strip("\"'“”") if text else ""
+    if not text or len(text) > MAX_QUERY_CHARS:
+        return None
+    return text
+
+
+def rewrite_query(query: str, history: list[dict], llm: Optional[Llama] = None) -> str:
+    """
+    生成本轮的检索问题。
+    :param history: 之前的对话 [{"role", "content"}, ...]
+    :param llm: 开启 CONV_REWRITE_LLM 时用于改写的模型（调用方应已持有其生成锁）
+    :return: 独立的检索问题；不是追问时原样返回 query
+    """
+    rewritten = rewrite_rule(query, history)
+    if rewritten is None:
+        return query
+    _REWRITES.inc()
+    if CONV_REWRITE_LLM and llm is not None:
+        try:
+            text = _rewrite_llm(llm, query, history)
+        except Exception as e:
+            print(f"[conv] LLM rewrite failed: {type(e).__name__}: {e}")
+            text = None
+        if text:
+            _REWRITES_LLM.inc()
+            return text
+    return rewritten
+
+
+# --- 滚动摘要 ---
+
+_summaries: "OrderedDict[str, str]" = OrderedDict()
+_summaries_lock = threading.Lock()
+
+
+def _prefix_keys(messages: list[dict]) -> list[str]:
+    """链式哈希：keys[i] 为前 i 条消息的内容哈希"""
+    keys = [""]
+    h = hashlib.sha1()
+    for m in messages:
+        h.update(f"{m.get('role')}\x00{m.get('content')}\x01".encode("utf-8"))
+        keys.append(h.copy().hexdigest())
+    return keys
+
+
+def _fold_rule(summary: str, messages: list[dict]) -> str:
+    """把消息按轮并入摘要：每轮一行（问题 + 回答首句），超长时丢弃最早的行"""
+    lines = summary.splitlines() if summary else []
+    question = None
+    for m in messages:
+        if m.get("role") == "user":
+            if question is not None:
+                lines.append(f"- 问：{question}")
+            question = _clip(_strip(m.get("content") or ""), 80)
+        elif m.get("role") == "assistant":
+            answer = _first_sentence(m.get("content") or "")
+            lines.append(f"- 问：{question} 答：{answer}" if question is not None else f"- 答：{answer}")
+            question = None
+    if question is not None:
+        lines.append(f"- 问：{question}")
+    while len(lines) > 1 and sum(len(line) + 1 for line in lines) > CONV_SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return _clip("\n".join(lines), CONV_SUMMARY_MAX_CHARS)
+
+
+def _fold_llm(llm: Llama, summary: str, messages: list[dict]) -> Optional[str]:
+    turns = "\n".join(
+        f"{'用户' if m['role'] == 'user' else '助手'}：{_clip(_strip(m['content']), 400)}"
+        for m in messages if m.get("content")
+    )
+    out = llm.create_chat_completion(
+        messages=[
+            {"role": "system", "content": (
+                f"把已有摘要与新增对话合并为不超过 {CONV_SUMMARY_MAX_CHARS} 字的对话摘要，"
+                "保留讨论的主题、关键结论与专有名词。只输出摘要。"
+            )},
+            {"role": "user", "content": f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{turns}"},
+        ],
+        temperature=0.0,
+        max_tokens=CONV_SUMMARY_MAX_TOKENS,
+    )
+    text = (out["choices"][0]["message"]["content"] or "").strip()
+    return _clip(text, CONV_SUMMARY_MAX_CHARS) if text else None
+
+
+def _fold(summary: str, messages: list[dict], llm: Optional[Llama]) -> str:
+    if CONV_SUMMARY_LLM and llm is not None:
+        try:
+            text = _fold_llm(llm, summary, messages)
+            if text:
+                return text
+        except Exception as e:
+            print(f"[conv] LLM summary failed: {type(e).__name__}: {e}")
+    return _fold_rule(summary, messages)
+
+
+def summarize(messages: list[dict], llm: Optional[Llama] = None) -> str:
+    """
+    折叠消息的滚动摘要：从缓存中最长的已摘要前缀出发，只并入其后新增的消息。
+    :param llm: 开启 CONV_SUMMARY_LLM 时用于摘要的模型（调用方应已持有其生成锁）
+    """
+    if not messages:
+        return ""
+    keys = _prefix_keys(messages)
+    with _summaries_lock:
+        start, summary = 0, ""
+        for i in range(len(messages), 0, -1):
+            if keys[i] in _summaries:
+                start, summary = i, _summaries[keys[i]]
+                _summaries.move_to_end(keys[i])
+                break
+    if start == len(messages):
+        return summary
+    summary = _fold(summary, messages[start:], llm)
+    _SUMMARY_FOLDS.inc((len(messages) - start + 1) // 2)
+    with _summaries_lock:
+        _summaries[keys[-1]] = summary
+        while len(_summaries) > SUMMARY_CACHE_SIZE:
+            _summaries.popitem(last=False)
+    return summary
+
+
+def compact_history(history: list[dict], llm: Optional[Llama] = None) -> tuple[list[dict], str]:
+    """
+    有界的对话历史。
+    :return: (最近 CONV_KEEP_TURNS 轮消息（单条截断），更早轮次的滚动摘要)
+    """
+    keep = max(0, CONV_KEEP_TURNS) * 2
+    older, recent = (history[:-keep], history[-keep:]) if keep else (history, [])
+    # 保留部分从用户消息开始，避免以助手消息开头
+    while recent and recent[0].get("role") != "user":
+        older, recent = older + recent[:1], recent[1:]
+    recent = [
+        {"role": m["role"], "content": _clip(m.get("content") or "", CONV_TURN_MAX_CHARS)}
+        for m in recent
+    ]
+    return recent, summarize(older, llm)
+
+
+# --- 规则改写自检（python -m app.rag.conversation） ---
+
+_CHECK_HISTORY = [
+    {"role": "user", "content": "常见的排序算法有哪些？"},
+    {"role": "assistant", "content": "常见排序算法[1]：\n1. 快速排序：分治[1]。\n2. 归并排序：稳定[2]。\n3. 堆排序：原地[2]。"},
+]
+# (问题, 期望的改写结果；None 表示不是追问，原样检索)
+_CHECK_CASES = [
+    ("第一章讲了什么", None),
+    ("第三次作业要求是什么", None),
+    ("第五个的复杂度", None),
+    ("这一章的重点是什么", None),
+    ("其他数据结构有哪些", None),
+    ("尤其是图算法怎么学", None),
+    ("其中哪些是稳定的算法呀", None),
+    ("该怎么选择哈希函数", None),
+    ("快速排序的平均时间复杂度是多少呢", None),
+    ("Dijkstra 算法的时间复杂度是多少？为什么这个算法不能处理负权边？", None),
+    ("请比较红黑树和 AVL 树，上述两种结构各适合什么场景", None),
+    ("What is a B-tree and how does it work", None),
+    ("Explain why this matters for database indexes", None),
+    ("How do hash maps differ from trees and when are these preferred", None),
+    ("第二个的时间复杂度呢？", "归并排序 的时间复杂度"),
+    ("最后一种怎么实现", "堆排序 怎么实现"),
+    ("what about the second one?", "what about 归并排序 ?"),
+    ("它们的区别是什么", "常见的排序算法有哪些？ 它们的区别是什么"),
+    ("这个算法为什么不能处理负权边", "常见的排序算法有哪些？ 这个算法为什么不能处理负权边"),
+    ("那这些算法哪个最快", "常见的排序算法有哪些？ 那这些算法哪个最快"),
+    ("为什么它更快", "常见的排序算法有哪些？ 为什么它更快"),
+    ("其时间复杂度是多少", "常见的排序算法有哪些？ 其时间复杂度是多少"),
+    ("该算法是否稳定", "常见的排序算法有哪些？ 该算法是否稳定"),
+    ("稳定性呢", "常见的排序算法有哪些？ 稳定性"),
+    ("how does it work", "常见的排序算法有哪些？ how does it work"),
+    ("these are all comparison sorts?", "常见的排序算法有哪些？ these are all comparison sorts?"),
+]
+
+
+def main():
+    failed = 0
+    for query, expected in _CHECK_CASES:
+        got = rewrite_rule(query, _CHECK_HISTORY)
+        ok = got == expected
+        failed += not ok
+        print(f"[conv] {'ok  ' if ok else 'FAIL'} {query!r} -> {got!r}" + ("" if ok else f" (expected {expected!r})"))
+    print(f"[conv] {len(_CHECK_CASES) - failed}/{len(_CHECK_CASES)} rewrite cases passed")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import argparse
+import inspect
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from app.config import (
+    LLM_AUTOTUNE,
+    LLM_FLASH_ATTN,
+    LLM_GGUF_PATH,
+    LLM_N_BATCH,
+    LLM_N_CTX,
+    LLM_N_THREADS,
+    LLM_N_THREADS_BATCH,
+    LLM_TUNING_PATH,
+    LLM_USE_MLOCK,
+    LLM_USE_MMAP,
+)
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+
+"""
+llama.cpp 运行参数
+根据主机与配置决定 create_llm 传给 Llama 的参数：
+
+- 线程数默认取物理核数（受 CPU 亲和性 / 容器限制），超线程对解码几乎没有收益，反而会争抢；
+- prompt 处理（n_threads_batch）与逐 token 生成（n_threads）分开设置：前者偏计算密集，后者偏内存带宽；
+- 首次加载某个模型文件时运行微基准（LLM_AUTOTUNE），在同一个已加载的模型上切换线程数，
+  分别测量 prompt 处理与生成的 tokens/s 并选出最快者，结果按模型文件（路径 + 大小 + 修改时间）
+  与主机核数缓存在 LLM_TUNING_PATH，之后直接复用；
+- flash_attn / n_threads_batch 仅在所装 llama-cpp-python 支持时传入，mlock 在系统不支持时自动关闭。
+
+用法: python -m app.rag.llm_runtime [--model 文件名] show | tune [--force]
+"""
+
+# 微基准的 prompt 长度与生成 token 数
+BENCH_PROMPT_TOKENS = 256
+BENCH_GEN_TOKENS = 16
+
+_BENCH_TEXT = (
+    "动态规划的核心是定义状态与状态转移方程，并确定边界条件。"
+    "Dynamic programming solves problems by combining solutions to overlapping subproblems. "
+)
+
+
+def logical_cores() -> int:
+    """当前进程可用的逻辑核数（考虑 CPU 亲和性）"""
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def physical_cores() -> int:
+    """物理核数（不超过可用逻辑核数）；无法识别时退化为逻辑核数"""
+    logical = logical_cores()
+    physical = 0
+    if sys.platform.startswith("linux"):
+        try:
+            text = Path("/proc/cpuinfo").read_text(encoding="utf-8", errors="ignore")
+            cores = set()
+            for block in text.split("\n\n"):
+                pid = re.search(r"^physical id\s*:\s*(\d+)", block, re.M)
+                cid = re.search(r"^core id\s*:\s*(\d+)", block, re.M)
+                if pid and cid:
+                    cores.add((pid.group(1), cid.group(1)))
+            physical = len(cores)
+        except OSError:
+            physical = 0
+    elif sys.platform == "darwin":
+        try:
+            out = subprocess.run(["sysctl", "-n", "hw.physicalcpu"], capture_output=True, text=True, timeout=2)
+            physical = int(out.stdout.strip() or 0)
+        except (OSError, ValueError, subprocess.SubprocessError):
+            physical = 0
+    return min(physical, logical) if physical > 0 else logical
+
+
+def _llama_params() -> set:
+    """所装 llama-cpp-python 的 Llama 构造参数名"""
+    from llama_cpp import Llama
+    try:
+        return set(inspect.signature(Llama.__init__).parameters)
+    except (TypeError, ValueError):
+        return set()
+
+
+# --- 调优缓存 ---
+
+def _model_key(model_path: Path) -> str:
+    return str(Path(model_path).resolve())
+
+
+def _model_fingerprint(model_path: Path) -> Dict[str, Any]:
+    st = Path(model_path).stat()
+    return {
+        "size": int(st.st_size),
+        "mtime": float(st.st_mtime),
+        "logical": logical_cores(),
+        "physical": physical_cores(),
+    }
+
+
+def _read_cache(path: Path = LLM_TUNING_PATH) -> Dict[str, Any]:
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def cached_tuning(model_path: Path, path: Path = LLM_TUNING_PATH) -> Optional[Dict[str, Any]]:
+    """读取该模型文件的调优结果；模型文件或主机核数变化后视为失效"""
+    entry = _read_cache(path).get(_model_key(model_path))
+    if not entry:
+        return None
+    try:
+        fp = _model_fingerprint(model_path)
+    except OSError:
+        return None
+    if any(entry.get(k) != v for k, v in fp.items()):
+        return None
+    return entry
+
+
+def _write_cache(model_path: Path, entry: Dict[str, Any], path: Path = LLM_TUNING_PATH) -> None:
+    data = _read_cache(path)
+    data[_model_key(model_path)] = entry
+    tmp = Path(path).with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# --- 参数 ---
+
+def resolve_settings(model_path: Path = LLM_GGUF_PATH) -> Dict[str, Any]:
+    """
+    计算 Llama 构造参数（不含 model_path / verbose）。
+    线程数为 0（自动）时优先用调优结果，其次用物理核数。
+    """
+    params = _llama_params()
+    tuned = cached_tuning(model_path) or {}
+    cores = physical_cores()
+
+    n_threads = LLM_N_THREADS or tuned.get("n_threads") or cores
+    n_threads_batch = LLM_N_THREADS_BATCH or tuned.get("n_threads_batch") or cores
+    use_mlock = LLM_USE_MLOCK
+    if use_mlock:
+        import llama_cpp
+        supports = getattr(llama_cpp, "llama_supports_mlock", None)
+        if supports is not None and not supports():
+            print("[llm] mlock is not supported on this system, disabled")
+            use_mlock = False
+
+    kwargs: Dict[str, Any] = {
+        "n_ctx": LLM_N_CTX,
+        "n_threads": int(n_threads),
+        "n_batch": LLM_N_BATCH,
+        "use_mmap": LLM_USE_MMAP,
+        "use_mlock": use_mlock,
+    }
+    # 旧版本没有的参数不传，避免构造失败
+    if "n_threads_batch" in params:
+        kwargs["n_threads_batch"] = int(n_threads_batch)
+    if LLM_FLASH_ATTN and "flash_attn" in params:
+        kwargs["flash_attn"] = True
+    return kwargs
+
+
+def _set_threads(llm: Llama, n_threads: int, n_threads_batch: int) -> bool:
+    """在已加载的模型上切换线程数；所装版本不支持时返回 False"""
+    import llama_cpp
+    fn = getattr(llama_cpp, "llama_set_n_threads", None)
+    ctx = getattr(getattr(llm, "_ctx", None), "ctx", None)
+    if fn is None or ctx is None:
+        return False
+    fn(ctx, int(n_threads), int(n_threads_batch))
+    return True
+
+
+def _thread_candidates() -> List[int]:
+    """候选线程数：物理核数的 1/4、1/2、3/4、全部，以及全部逻辑核"""
+    physical, logical = physical_cores(), logical_cores()
+    cands = {max(1, physical // 4), max(1, physical // 2), max(1, physical * 3 // 4), physical, logical}
+    return sorted(c for c in cands if c <= logical)
+
+
+def _bench_threads(llm: Llama, prompt: List[int], threads: int) -> tuple:
+    """以给定线程数测量 prompt 处理与生成的 tokens/s"""
+    _set_threads(llm, threads, threads)
+    llm.reset()
+    t0 = time.perf_counter()
+    llm.eval(prompt)
+    prompt_tps = len(prompt) / max(time.perf_counter() - t0, 1e-9)
+
+    t0 = time.perf_counter()
+    for _ in range(BENCH_GEN_TOKENS):
+        llm.eval([prompt[-1]])
+    gen_tps = BENCH_GEN_TOKENS / max(time.perf_counter() - t0, 1e-9)
+    return prompt_tps, gen_tps
+
+
+def autotune(llm: Llama, model_path: Path = LLM_GGUF_PATH) -> Optional[Dict[str, Any]]:
+    """
+    在已加载的模型上运行线程数微基准，写入缓存并把最快的线程数应用到该实例。
+    :return: 调优结果；所装 llama-cpp-python 不支持运行时切换线程数时返回 None
+    """
+    n_prompt = min(BENCH_PROMPT_TOKENS, LLM_N_BATCH, max(16, LLM_N_CTX // 2 - BENCH_GEN_TOKENS))
+    tokens = llm.tokenize(_BENCH_TEXT.encode("utf-8"))
+    while len(tokens) < n_prompt:
+        tokens += tokens
+    prompt = tokens[:n_prompt]
+
+    candidates = _thread_candidates()
+    if not _set_threads(llm, candidates[-1], candidates[-1]):
+        print("[llm] this llama-cpp-python build cannot change threads at runtime, autotune skipped")
+        return None
+
+    print(f"[llm] autotuning threads {candidates} (prompt={n_prompt} tokens, gen={BENCH_GEN_TOKENS} tokens)...")
+    # 预热：第一次解码会触发 mmap 缺页，不计入
+    _bench_threads(llm, prompt, candidates[-1])
+    prompt_tps: Dict[str, float] = {}
+    gen_tps: Dict[str, float] = {}
+    for t in candidates:
+        p, g = _bench_threads(llm, prompt, t)
+        prompt_tps[str(t)], gen_tps[str(t)] = round(p, 1), round(g, 2)
+        print(f"[llm]   threads={t:<3} prompt {p:8.1f} tok/s   gen {g:6.2f} tok/s")
+    llm.reset()
+
+    entry = {
+        **_model_fingerprint(model_path),
+        "n_threads": int(max(gen_tps, key=gen_tps.get)),
+        "n_threads_batch": int(max(prompt_tps, key=prompt_tps.get)),
+        "prompt_tps": prompt_tps,
+        "gen_tps": gen_tps,
+        "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _write_cache(model_path, entry)
+    _set_threads(
+        llm,
+        LLM_N_THREADS or entry["n_threads"],
+        LLM_N_THREADS_BATCH or entry["n_threads_batch"],
+    )
+    print(f"[llm] tuned n_threads={entry['n_threads']} n_threads_batch={entry['n_threads_batch']} -> {LLM_TUNING_PATH}")
+    return entry
+
+
+def maybe_autotune(llm: Llama, model_path: Path = LLM_GGUF_PATH) -> None:
+    """线程数为自动、开启了 LLM_AUTOTUNE 且该模型没有有效调优结果时运行 autotune"""
+    if not LLM_AUTOTUNE or (LLM_N_THREADS and LLM_N_THREADS_BATCH):
+        return
+    if cached_tuning(model_path) is not None:
+        return
+    try:
+        autotune(llm, model_path)
+    except Exception as e:
+        # 调优失败不影响使用，保持按物理核数设置的线程数
+        print(f"[llm] autotune failed: {type(e).__name__}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.rag.llm_runtime")
+    parser.add_argument("--model", type=str, default=None, help="model file name in MODELS_DIR (default: LLM_GGUF_PATH)")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("show", help="print detected cores, cached tuning and the resolved Llama settings (default)")
+    p_tune = sub.add_parser("tune", help="run the thread micro-benchmark for the model")
+    p_tune.add_argument("--force", action="store_true", help="re-run even if a cached result exists")
+    args = parser.parse_args()
+
+    from app.rag.models import ModelRegistry
+    model_path = ModelRegistry().resolve(args.model)
+
+    if args.cmd == "tune":
+        if not args.force and cached_tuning(model_path) is not None:
+            print(f"[llm] cached tuning exists for {model_path.name} (use --force to re-run)")
+        else:
+            from app.rag.ask import create_llm
+            llm = create_llm(model_path, autotune=False)
+            autotune(llm, model_path)
+            return
+
+    print(f"[llm] cores: physical={physical_cores()} logical={logical_cores()}")
+    tuned = cached_tuning(model_path)
+    print(f"[llm] tuning: {json.dumps(tuned, ensure_ascii=False) if tuned else 'none'}")
+    print(f"[llm] settings: {resolve_settings(model_path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from app import metrics
+from app.config import (
+    LLM_FAST_MAX_CHARS,
+    LLM_FAST_MODEL,
+    LLM_GGUF_PATH,
+    LLM_IDLE_UNLOAD_SECONDS,
+    LLM_RAM_BUDGET_MB,
+    MODELS_DIR,
+)
+
+"""
+模型注册表
+发现 MODELS_DIR 下的 GGUF 文件，按需加载（mmap 权重，见 LLM_USE_MMAP），
+已加载的模型组成 LRU：总占用（按文件大小估算）超出 LLM_RAM_BUDGET_MB 时卸载最久未用的空闲模型，
+空闲超过 LLM_IDLE_UNLOAD_SECONDS 的模型由后台线程卸载。
+
+- 每个请求可指定模型（文件名或不含 .gguf 的名称）；None / "default" 为 LLM_GGUF_PATH，
+  "auto" 对短问题使用 LLM_FAST_MODEL，其余使用默认模型；
+- 每个已加载模型有自己的生成锁（llama.cpp 实例不是线程安全的），不同模型可以同时生成；
+- checkout() 期间模型被固定，不会被卸载；用完后 checkin()。
+"""
+
+_MODELS_LOADED = metrics.gauge("extracthelper_llm_models_loaded", "GGUF models currently loaded")
+_MODELS_BYTES = metrics.gauge("extracthelper_llm_models_bytes", "Estimated memory of loaded models (GGUF file size)")
+_MODEL_LOADS = metrics.counter("extracthelper_llm_model_loads_total", "GGUF model loads")
+_MODEL_UNLOADS = metrics.counter("extracthelper_llm_model_unloads_total", "GGUF models unloaded (LRU or idle)")
+
+
+@dataclass
+class ModelInfo:
+    name: str
+    path: Path
+    size_bytes: int
+
+
+class LoadedModel:
+    """已加载的模型；lock 为该实例的生成锁"""
+    def __init__(self, path: Path, llm: Any, size_bytes: int) -> None:
+        self.path = path
+        self.name = path.name
+        self.llm = llm
+        self.size_bytes = size_bytes
+        self.lock = threading.Lock()
+        self.pins = 0
+        self.last_used = time.time()
+
+
+def _default_budget_bytes() -> float:
+    if LLM_RAM_BUDGET_MB > 0:
+        return LLM_RAM_BUDGET_MB * (1 << 20)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2
+    except (ValueError, OSError, AttributeError):
+        # 无法获取物理内存（如 Windows）：不限制
+        return float("inf")
+
+
+def _close(llm: Any) -> None:
+    close = getattr(llm, "close", None)
+    if close is not None:
+        close()
+
+
+class ModelRegistry:
+    """GGUF 模型注册表（LRU + 内存预算 + 空闲卸载）"""
+    def __init__(
+        self,
+        models_dir: Path = MODELS_DIR,
+        default_path: Path = LLM_GGUF_PATH,
+        budget_bytes: Optional[float] = None,
+        idle_seconds: float = LLM_IDLE_UNLOAD_SECONDS,
+        loader: Optional[Callable[[Path], Any]] = None,
+    ) -> None:
+        """
+        :param budget_bytes: 内存预算（字节），默认见 LLM_RAM_BUDGET_MB
+        :param idle_seconds: 空闲卸载秒数，0 表示不卸载
+        :param loader: 加载函数 loader(path) -> Llama，默认为 create_llm
+        """
+        self.models_dir = Path(models_dir)
+        self.default_path = Path(default_path)
+        self.budget_bytes = budget_bytes if budget_bytes is not None else _default_budget_bytes()
+        self.idle_seconds = idle_seconds
+        self._loader = loader
+        self._loaded: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 加载很重，串行执行（同时也避免同一模型被重复加载）
+        self._load_lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # --- 发现与选择 ---
+
+    def discover(self) -> List[ModelInfo]:
+        """MODELS_DIR 下的 GGUF 文件（默认模型在目录外时也包含在内）"""
+        paths = sorted(self.models_dir.glob("*.gguf")) if self.models_dir.exists() else []
+        if self.default_path.exists() and self.default_path.resolve() not in {p.resolve() for p in paths}:
+            paths.insert(0, self.default_path)
+        return [ModelInfo(p.name, p, p.stat().st_size) for p in paths]
+
+    def resolve(self, model: Optional[str] = None, question: str = "") -> Path:
+        """
+        把请求中的模型名解析为文件路径。
+        :param model: 文件名 / 不含 .gguf 的名称 / "default" / "auto"，None 为默认模型
+        :param question: "auto" 时按问题长度选择
+        :raises ValueError: 找不到该模型
+        """
+        if not model or model == "default":
+            return self.default_path
+        if model == "auto":
+            if LLM_FAST_MODEL and len(question.strip()) <= LLM_FAST_MAX_CHARS:
+                fast = self.models_dir / LLM_FAST_MODEL
+                if fast.exists():
+                    return fast
+            return self.default_path
+        for info in self.discover():
+            if model in (info.name, info.path.stem):
+                return info.path
+        raise ValueError(f"Unknown model: {model}")
+
+    # --- 加载 / 卸载 ---
+
+    def checkout(self, path: Path) -> LoadedModel:
+        """取得已加载的模型（必要时加载），在 checkin 之前不会被卸载"""
+        key = str(Path(path).resolve())
+        entry = self._pin(key)
+        if entry is not None:
+            return entry
+        with self._load_lock:
+            entry = self._pin(key)
+            if entry is not None:
+                return entry
+            size = Path(path).stat().st_size
+            self._evict(size)
+            loader = self._loader
+            if loader is None:
+                from app.rag.ask import create_llm
+                loader = lambda p: create_llm(model_path=p)
+            llm = loader(Path(path))
+            entry = LoadedModel(Path(path), llm, size)
+            entry.pins = 1
+            with self._lock:
+                self._loaded[key] = entry
+                self._update_gauges()
+            _MODEL_LOADS.inc()
+            print(f"[models] loaded {entry.name} ({size / (1 << 20):.0f} MB)")
+        self._start_reaper()
+        return entry
+
+    def checkin(self, entry: LoadedModel) -> None:
+        with self._lock:
+            entry.pins -= 1
+            entry.last_used = time.time()
+
+    def _pin(self, key: str) -> Optional[LoadedModel]:
+        with self._lock:
+            entry = self._loaded.get(key)
+            if entry is not None:
+                entry.pins += 1
+                entry.last_used = time.time()
+                self._loaded.move_to_end(key)
+            return entry
+
+    def _evict(self, need: int) -> None:
+        """按 LRU 卸载空闲模型，直到能放下 need 字节（被固定的模型不卸载）"""
+        victims: List[LoadedModel] = []
+        with self._lock:
+            used = sum(e.size_bytes for e in self._loaded.values())
+            for key in list(self._loaded):
+                if used + need <= self.budget_bytes:
+                    break
+                entry = self._loaded[key]
+                if entry.pins > 0:
+                    continue
+                victims.append(self._loaded.pop(key))
+                used -= entry.size_bytes
+            self._update_gauges()
+            if used + need > self.budget_bytes:
+                print(f"[models] over budget: {(used + need) / (1 << 20):.0f} MB > {self.budget_bytes / (1 << 20):.0f} MB (models in use)")
+        self._release(victims, "lru")
+
+    def unload_idle(self, now: Optional[float] = None) -> List[str]:
+        """卸载空闲超时的模型，返回被卸载的模型名"""
+        if self.idle_seconds <= 0:
+            return []
+        now = now if now is not None else time.time()
+        with self._lock:
+            victims = [
+                self._loaded.pop(key) for key, e in list(self._loaded.items())
+                if e.pins == 0 and now - e.last_used >= self.idle_seconds
+            ]
+            self._update_gauges()
+        self._release(victims, "idle")
+        return [v.name for v in victims]
+
+    def unload_all(self) -> None:
+        """卸载所有空闲模型（退出时调用）"""
+        self._stop.set()
+        with self._lock:
+            victims = [self._loaded.pop(k) for k, e in list(self._loaded.items()) if e.pins == 0]
+            self._update_gauges()
+        self._release(victims, "shutdown")
+
+    def _release(self, victims: List[LoadedModel], reason: str) -> None:
+        for entry in victims:
+            _close(entry.llm)
+            entry.llm = None
+            _MODEL_UNLOADS.inc()
+            print(f"[models] unloaded {entry.name} ({reason})")
+        if victims:
+            gc.collect()
+
+    def _update_gauges(self) -> None:
+        _MODELS_LOADED.set(len(self._loaded))
+        _MODELS_BYTES.set(sum(e.size_bytes for e in self._loaded.values()))
+
+    def _start_reaper(self) -> None:
+        if self.idle_seconds <= 0 or self._reaper is not None:
+            return
+        interval = max(1.0, min(60.0, self.idle_seconds / 2))
+
+        def loop() -> None:
+            while not self._stop.wait(interval):
+                self.unload_idle()
+
+        self._reaper = threading.Thread(target=loop, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    # --- 状态 ---
+
+    def status(self) -> List[Dict[str, Any]]:
+        """可选模型列表及其加载状态"""
+        now = time.time()
+        with self._lock:
+            loaded = {e.name: e for e in self._loaded.values()}
+        out = []
+        for info in self.discover():
+            e = loaded.get(info.name)
+            out.append({
+                "name": info.name,
+                "size_mb": round(info.size_bytes / (1 << 20), 1),
+                "default": info.path.resolve() == self.default_path.resolve(),
+                "loaded": e is not None,
+                "in_use": bool(e and e.pins),
+                "idle_s": round(now - e.last_used, 1) if e is not None else None,
+            })
+        return out
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from app.config import (
+    LLM_DRAFT_GGUF_PATH,
+    LLM_SPEC_MAX_NGRAM,
+    LLM_SPEC_NUM_PRED_TOKENS,
+    LLM_SPECULATIVE,
+)
+
+"""
+投机解码（speculative decoding）
+通过 llama-cpp-python 的 draft_model 扩展点接入：每轮生成前由草稿模型提出若干候选 token，
+主模型一次前向验证，接受最长的一致前缀。
+
+- prompt_lookup：在当前输入（系统提示 + 检索证据 + 已生成内容）中查找最近的 n-gram，
+  取其后续 token 作为草稿（LlamaPromptLookupDecoding），RAG 回答大段引用资料时接受率很高；
+- draft：用小模型（LLM_DRAFT_GGUF_PATH）贪心起草，须与主模型共用词表。
+
+CountingDraft 统计起草次数与起草 token 数。llama-cpp-python 不直接报告接受数，
+每次起草之后主模型恰好前向一次、产出 “接受数 + 1” 个 token，因此
+接受数 ≈ 生成 token 数 - 1 - 起草次数（首个 token 来自 prompt 处理）。
+本模块依赖 llama_cpp，仅在 create_llm 中延迟导入。
+"""
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """用小 GGUF 模型贪心起草（与主模型共用词表）"""
+    def __init__(self, model_path: str, num_pred_tokens: int = LLM_SPEC_NUM_PRED_TOKENS, **llama_kwargs: Any) -> None:
+        from llama_cpp import Llama
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, verbose=False, **llama_kwargs)
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        out = []
+        # generate(reset=True) 会复用与上次输入相同的前缀，只处理新增的 token
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            if token == self.llm.token_eos():
+                break
+            out.append(token)
+            if len(out) >= self.num_pred_tokens:
+                break
+        return np.array(out, dtype=np.intc)
+
+
+class CountingDraft(LlamaDraftModel):
+    """包装草稿模型，累计起草次数与起草 token 数"""
+    def __init__(self, inner: LlamaDraftModel, mode: str) -> None:
+        self.inner = inner
+        self.mode = mode
+        self.calls = 0
+        self.proposed = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs: Any) -> np.ndarray:
+        draft = self.inner(input_ids, **kwargs)
+        with self._lock:
+            self.calls += 1
+            self.proposed += len(draft)
+        return draft
+
+    def counts(self) -> tuple:
+        with self._lock:
+            return self.calls, self.proposed
+
+
+def create_draft_model(mode: str = LLM_SPECULATIVE, n_ctx: int = 4096, n_threads: Optional[int] = None) -> Optional[CountingDraft]:
+    """
+    按配置创建草稿模型，关闭时返回 None。
+    :param n_ctx: draft 模式下小模型的上下文大小（应与主模型一致）
+    :param n_threads: draft 模式下小模型的线程数
+    """
+    if mode in (None, "", "none"):
+        return None
+    if mode == "prompt_lookup":
+        inner = LlamaPromptLookupDecoding(max_ngram_size=LLM_SPEC_MAX_NGRAM, num_pred_tokens=LLM_SPEC_NUM_PRED_TOKENS)
+    elif mode == "draft":
+        if not LLM_DRAFT_GGUF_PATH.exists():
+            print(f"[llm] draft model not found: {LLM_DRAFT_GGUF_PATH}, speculative decoding disabled")
+            return None
+        kwargs: Dict[str, Any] = {"n_ctx": n_ctx}
+        if n_threads:
+            kwargs["n_threads"] = n_threads
+        inner = GGUFDraftModel(str(LLM_DRAFT_GGUF_PATH), **kwargs)
+    else:
+        raise ValueError(f"Unknown LLM_SPECULATIVE mode: {mode}")
+    return CountingDraft(inner, mode)
+
+
+def acceptance(before: tuple, after: tuple, completion_tokens: int) -> Optional[Dict[str, float]]:
+    """
+    由一次生成前后的 CountingDraft.counts() 估算接受情况。
+    :return: {"proposed", "accepted", "rate"}；本次没有起草时返回 None
+    """
+    calls = after[0] - before[0]
+    proposed = after[1] - before[1]
+    if proposed <= 0:
+        return None
+    accepted = min(proposed, max(0, completion_tokens - 1 - calls))
+    return {"proposed": proposed, "accepted": accepted, "rate": accepted / proposed}
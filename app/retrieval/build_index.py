@@ -1,75 +1,361 @@
 from __future__ import annotations
 
-import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
 import faiss
 import numpy as np
 
-from app.config import DB_PATH, EMBED_MODEL_NAME, FAISS_INDEX_PATH, FAISS_DELTA_INDEX_PATH
-from app.retrieval.embedder import Embedder
-from app.ingest.db import connect, ensure_schema
+from app.config import (
+    DB_PATH,
+    EMBED_MODEL_NAME,
+    FAISS_INDEX_PATH,
+    FAISS_DELTA_INDEX_PATH,
+    INDEX_STORAGE,
+    INDEX_PQ_M,
+    INDEX_PQ_NBITS,
+)
+from app import jobs, metrics
+from app.retrieval.embedder import get_embedder
+from app.retrieval.shards import (
+    cleanup_generations,
+    current_generation,
+    delta_path,
+    index_write_lock,
+    load_shard_vectors,
+    publish_generation,
+    read_manifest,
+    write_shard,
+    shard_key_for_path,
+)
+from app.ingest.db import clear_pending_vectors, get_pool, pending_vector_chunks
 
 """
 索引构建模块
-负责从 SQLite 数据库中读取所有 Active Chunks，全量构建 FAISS 索引。
+负责从 SQLite 数据库中读取所有 Active Chunks，按分片构建 FAISS 索引。
 通常在初次入库后、或需要整理碎片时调用。
 """
 
-def build_index(top_n: int | None = None) -> None:
+# 支持的 Base Index 存储方式
+SUPPORTED_STORAGES = ("flat", "fp16", "sq8", "pq")
+# PQ 训练时每个聚类中心至少需要的样本数（低于此值 FAISS 会告警且精度明显下降）
+PQ_MIN_TRAIN_PER_CENTROID = 39
+
+
+def create_base_index(dim: int, storage: str, train_vecs: np.ndarray):
     """
-    全量重建索引流程：
-    1. 连接 DB，读取所有未删除的 Chunks。
-    2. 计算所有文本的 Embedding。
-    3. 创建新的 IndexIDMap2 (FlatIP)。
-    4. 写入 Base Index 文件。
-    5. 重置（清空）Delta Index 文件。
-    
-    :param top_n: 仅处理前 N 条数据（用于测试）
+    按存储方式创建（并训练）底层向量索引，外层统一包 IndexIDMap2。
+
+    :param dim: 向量维度
+    :param storage: 存储方式，见 SUPPORTED_STORAGES
+    :param train_vecs: 训练样本（量化索引需要）
+    :return: (index, 实际使用的 storage)
     """
-    conn = connect(DB_PATH)
-    ensure_schema(conn)
+    storage = (storage or "flat").lower()
+    if storage not in SUPPORTED_STORAGES:
+        raise ValueError(f"Unsupported index storage: {storage}")
+
+    # PQ 每个子空间需要 2^nbits 个聚类中心，样本不足或维度不整除时退化为 sq8
+    if storage == "pq" and (dim % INDEX_PQ_M != 0 or len(train_vecs) < PQ_MIN_TRAIN_PER_CENTROID * (1 << INDEX_PQ_NBITS)):
+        print(f"[index] pq unavailable (dim={dim}, samples={len(train_vecs)}), fallback to sq8")
+        storage = "sq8"
 
-    # 读取 Active Chunks
+    if storage == "flat":
+        base = faiss.IndexFlatIP(dim)
+    elif storage == "fp16":
+        base = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif storage == "sq8":
+        base = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        base = faiss.IndexPQ(dim, INDEX_PQ_M, INDEX_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+
+    if not base.is_trained:
+        base.train(train_vecs)
+    return faiss.IndexIDMap2(base), storage
+
+
+def load_active_chunks_by_shard(top_n: Optional[int] = None) -> Tuple[Dict[str, List[Tuple[int, str]]], int]:
+    """
+    读取所有 Active Chunks 并按分片分组（只含规范 chunk，重复 chunk 共享其向量，见入库去重）。
+    :param top_n: 仅处理前 N 条数据（用于测试）
+    :return: ({shard_key: [(chunk_id, content), ...]}, 快照时的 chunk id 高水位)
+             组内按 chunk id 升序；id 大于高水位的 chunk 均在快照之后写入
+    """
+    conn = get_pool(DB_PATH).reader()
+    high_water = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM chunks").fetchone()[0])
     rows = conn.execute(
         """
-        SELECT c.id, c.content
+        SELECT c.id, c.content, d.path
         FROM chunks c
         JOIN documents d ON d.id = c.doc_id
-        WHERE c.is_deleted = 0 AND d.is_deleted = 0
+        WHERE c.is_deleted = 0 AND d.is_deleted = 0 AND c.canonical_id IS NULL
         ORDER BY c.id ASC
         """
     ).fetchall()
-    conn.close()
 
     if top_n is not None:
         rows = rows[:top_n]
 
+    groups: Dict[str, List[Tuple[int, str]]] = {}
+    key_cache: Dict[str, str] = {}
+    for cid, content, path in rows:
+        key = key_cache.get(path)
+        if key is None:
+            key = key_cache[path] = shard_key_for_path(path)
+        groups.setdefault(key, []).append((int(cid), content))
+    return groups, high_water
+
+
+def _vector_pool(sources: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """合并若干 (ids, vecs) 来源为按 id 升序的向量池，用于复用已计算的向量"""
+    sources = [(np.asarray(i, dtype="int64"), np.asarray(v, dtype="float32")) for i, v in sources if len(i)]
+    if not sources:
+        return np.zeros(0, dtype="int64"), np.zeros((0, 0), dtype="float32")
+    ids = np.concatenate([s[0] for s in sources])
+    vecs = np.concatenate([s[1] for s in sources])
+    order = np.argsort(ids, kind="stable")
+    return ids[order], vecs[order]
+
+
+_REUSE_HITS = metrics.counter("extracthelper_vector_reuse_hits_total", "Chunk vectors reused from existing shards during rebuild")
+_REUSE_MISSES = metrics.counter("extracthelper_vector_reuse_misses_total", "Chunk vectors that had to be embedded during rebuild")
+
+
+def _embed_with_reuse(rows: List[Tuple[int, str]], pool_ids: np.ndarray, pool_vecs: np.ndarray) -> np.ndarray:
+    """优先从向量池取向量，池中没有的 chunk 再计算 Embedding"""
+    ids = np.array([r[0] for r in rows], dtype="int64")
+    out: Optional[np.ndarray] = None
+    missing = np.ones(len(ids), dtype=bool)
+    if len(pool_ids):
+        pos = np.clip(np.searchsorted(pool_ids, ids), 0, len(pool_ids) - 1)
+        hit = pool_ids[pos] == ids
+        out = np.empty((len(ids), pool_vecs.shape[1]), dtype="float32")
+        out[hit] = pool_vecs[pos[hit]]
+        missing = ~hit
+        # 复用的向量不经过 Embedding，直接计入进度
+        jobs.advance(int(hit.sum()))
+        _REUSE_HITS.inc(int(hit.sum()))
+
+    if missing.any():
+        todo = np.nonzero(missing)[0]
+        _REUSE_MISSES.inc(len(todo))
+        vecs = get_embedder(EMBED_MODEL_NAME).encode([rows[i][1] for i in todo], on_batch=_on_embed_batch)
+        if out is None:
+            out = np.empty((len(ids), vecs.shape[1]), dtype="float32")
+        out[todo] = vecs
+    return out
+
+
+def _on_embed_batch(n: int) -> None:
+    """Embedding 批次回调：上报进度并检查后台任务是否已取消"""
+    jobs.advance(n)
+    jobs.checkpoint()
+
+
+def _read_delta(gen: Optional[str]):
+    """直接从磁盘读取 Delta Index（不走检索缓存，避免修改共享对象）"""
+    path = delta_path(gen)
+    if path.exists():
+        return faiss.read_index(str(path))
+    return None
+
+
+def _delta_vectors(delta) -> Tuple[np.ndarray, np.ndarray]:
+    """取出 Delta Index 中的全部 (ids, vecs)"""
+    if delta is None or delta.ntotal == 0:
+        return np.zeros(0, dtype="int64"), np.zeros((0, 0), dtype="float32")
+    ids = faiss.vector_to_array(delta.id_map).astype("int64")
+    vecs = delta.index.reconstruct_n(0, delta.ntotal)
+    return ids, vecs
+
+
+def _build_one_shard(
+    key: str,
+    rows: List[Tuple[int, str]],
+    entries: Dict[str, dict],
+    covered: List[np.ndarray],
+    rebuilt: List[str],
+    storage: str,
+    reuse: bool,
+    delta_src,
+) -> Optional[np.ndarray]:
+    """
+    重建单个分片并更新 entries / covered / rebuilt。
+    :return: 分片向量；分片已无有效数据（被下线）时返回 None
+    """
     if not rows:
+        # 分片已无任何有效数据，直接下线
+        if entries.pop(key, None) is not None:
+            print(f"[index] shard {key}: empty, removed")
+            rebuilt.append(key)
+        return None
+
+    if reuse:
+        sources = [delta_src]
+        old = entries.get(key)
+        if old is not None:
+            sources.append(load_shard_vectors(old))
+        pool_ids, pool_vecs = _vector_pool(sources)
+        vecs = _embed_with_reuse(rows, pool_ids, pool_vecs)
+    else:
+        vecs = get_embedder(EMBED_MODEL_NAME).encode([r[1] for r in rows], on_batch=_on_embed_batch)
+
+    ids = np.array([r[0] for r in rows], dtype="int64")
+    dim = int(vecs.shape[1])
+    index, used = create_base_index(dim, storage, vecs)
+    index.add_with_ids(vecs, ids)
+
+    generation = int(entries.get(key, {}).get("generation", 0)) + 1
+    entries[key] = write_shard(key, index, vecs, ids, used, generation)
+    covered.append(ids)
+    rebuilt.append(key)
+    print(f"[index] shard {key}: {len(ids)} vectors ({used}) -> g{generation:06d}")
+    return vecs
+
+
+def _rebuild_shards(
+    groups: Dict[str, List[Tuple[int, str]]],
+    high_water: int,
+    keys: Iterable[str],
+    storage: str,
+    reuse: bool,
+) -> List[str]:
+    """
+    在后台构建新一代索引：重建指定分片，未变化的分片直接沿用，然后原子切换 CURRENT。
+
+    1. 以当前代为基础（快照），在不持锁的情况下写出新分片目录。
+    2. 持锁读取当前代最新的 Delta，把未并入新分片、且仍然有效（或在快照之后新增）的条目重放到新 Delta。
+    3. 写出新一代并切换 CURRENT，清理过旧的索引代。
+
+    :param groups: 快照时按分片分组的 Active Chunks
+    :param high_water: 快照时的 chunk id 高水位
+    :param keys: 需要重建的分片
+    :param storage: 存储方式
+    :param reuse: 是否复用旧分片 / Delta 中已有的向量（否则全部重新 Embedding）
+    :return: 实际重建的分片列表
+    """
+    base_gen = current_generation()
+    manifest = read_manifest(base_gen)
+    entries = dict(manifest.get("shards", {}))
+    delta_src = _delta_vectors(_read_delta(base_gen)) if reuse else None
+
+    rebuilt: List[str] = []
+    covered: List[np.ndarray] = []
+    dim = int(manifest.get("dim", 0))
+
+    keys = sorted(set(keys))
+    jobs.report(stage="embed", total=sum(len(groups.get(k, [])) for k in keys), unit="chunks")
+    try:
+        for key in keys:
+            jobs.checkpoint()
+            vecs = _build_one_shard(key, groups.get(key, []), entries, covered, rebuilt, storage, reuse, delta_src)
+            if vecs is not None:
+                dim = int(vecs.shape[1])
+        jobs.checkpoint()
+    except jobs.JobCancelled:
+        # 已写出的新分片目录未被任何索引代引用，清理后退出，当前代保持不变
+        cleanup_generations()
+        raise
+
+    jobs.report(stage="publish")
+    new_manifest = {"version": manifest.get("version", 1), "dim": dim, "shards": entries}
+    active = np.array([cid for rows in groups.values() for cid, _ in rows], dtype="int64")
+    covered_ids = np.concatenate(covered) if covered else np.zeros(0, dtype="int64")
+
+    with index_write_lock:
+        # 构建期间可能有新的 Delta 写入当前代，这里读取最新内容进行重放
+        live_gen = current_generation()
+        cur_ids, cur_vecs = _delta_vectors(_read_delta(live_gen))
+        keep = ~np.isin(cur_ids, covered_ids) & (np.isin(cur_ids, active) | (cur_ids > high_water))
+        new_delta = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        if keep.any():
+            new_delta.add_with_ids(np.ascontiguousarray(cur_vecs[keep], dtype="float32"), cur_ids[keep])
+        name = publish_generation(new_manifest, new_delta)
+        replayed = int((cur_ids[keep] > high_water).sum())
+        print(
+            f"[index] published {name}: delta kept {int(keep.sum())} "
+            f"(replayed {replayed} added during build), dropped {int((~keep).sum())}"
+        )
+
+    # 已并入新分片的待补向量 chunk（见入库去重）不再单独写入 Delta
+    pool = get_pool(DB_PATH)
+    pending, _ = pending_vector_chunks(pool.reader())
+    done = np.asarray(pending, dtype="int64")[np.isin(pending, covered_ids)].tolist() if pending else []
+    if done:
+        with pool.writer() as conn:
+            clear_pending_vectors(conn, done)
+
+    cleanup_generations()
+    return rebuilt
+
+
+def _remove_legacy_files() -> None:
+    """发布过索引代之后，旧版单文件 Base/Delta Index 已不再被读取"""
+    if current_generation() is None:
+        return
+    for legacy in (FAISS_INDEX_PATH, FAISS_DELTA_INDEX_PATH):
+        if legacy.exists():
+            legacy.unlink()
+
+
+def build_index(top_n: int | None = None, storage: str = INDEX_STORAGE, shards: Optional[Iterable[str]] = None) -> None:
+    """
+    全量重建索引流程：
+    1. 连接 DB，读取所有未删除的 Chunks，按分片分组（快照）。
+    2. 计算所有文本的 Embedding。
+    3. 每个分片按 storage 创建新的 IndexIDMap2 (Flat / SQ / PQ)，写入新的分片目录。
+    4. 发布新一代索引并原子切换 CURRENT；Delta 中只保留未并入的条目与构建期间的新增条目。
+
+    :param top_n: 仅处理前 N 条数据（用于测试）
+    :param storage: 向量存储方式，见 SUPPORTED_STORAGES
+    :param shards: 仅重建指定分片，默认全部
+    """
+    groups, high_water = load_active_chunks_by_shard(top_n)
+    if not groups:
         raise RuntimeError("active chunks 为空：请先 ingest")
 
-    chunk_ids = np.array([r[0] for r in rows], dtype="int64")
-    texts = [r[1] for r in rows]
+    print(f"[index] loaded active chunks: {sum(len(v) for v in groups.values())} in {len(groups)} shards")
 
-    print(f"[index] loaded active chunks: {len(texts)}")
+    if shards is None:
+        # 全量：已不存在的分片也一并下线
+        keys = set(groups) | set(read_manifest().get("shards", {}))
+    else:
+        keys = set(shards)
+    _rebuild_shards(groups, high_water, keys, storage, reuse=False)
+    _remove_legacy_files()
 
-    # 批量计算向量
-    embedder = Embedder(EMBED_MODEL_NAME)
-    vecs = embedder.encode(texts, batch_size=32)
-    dim = int(vecs.shape[1])
 
-    # 构建 Base Index
-    base = faiss.IndexFlatIP(dim)
-    index = faiss.IndexIDMap2(base)
-    index.add_with_ids(vecs, chunk_ids)
+def compact_index(storage: str = INDEX_STORAGE) -> List[str]:
+    """
+    增量压缩：只重建内容发生变化的分片。
+    分片中已索引的 id 与当前 Active id 不一致（有删除、或有 Delta 中的新 chunk）时才重建，
+    重建时复用旧分片与 Delta 中已有的向量，无需重新 Embedding。
+    构建在新一代目录中进行，完成后原子切换，期间查询始终使用旧一代。
+
+    :return: 重建的分片列表
+    """
+    groups, high_water = load_active_chunks_by_shard()
+    entries = read_manifest().get("shards", {})
+    if not groups and not entries:
+        print("[index] nothing to compact")
+        return []
 
-    FAISS_INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(FAISS_INDEX_PATH))
-    print(f"[index] saved base: {FAISS_INDEX_PATH}")
+    changed: List[str] = []
+    for key in set(groups) | set(entries):
+        active = np.array([cid for cid, _ in groups.get(key, [])], dtype="int64")
+        entry = entries.get(key)
+        if entry is None:
+            changed.append(key)
+            continue
+        indexed, _ = load_shard_vectors(entry)
+        if len(indexed) != len(active) or not np.array_equal(np.asarray(indexed), active):
+            changed.append(key)
 
-    # 重置 Delta Index
-    # Base Index 已经包含了所有当前有效数据，因此 Delta 可以清空
-    empty_delta = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
-    faiss.write_index(empty_delta, str(FAISS_DELTA_INDEX_PATH))
-    print(f"[index] reset delta: {FAISS_DELTA_INDEX_PATH}")
+    if not changed:
+        print("[index] all shards up to date")
+        return []
+    rebuilt = _rebuild_shards(groups, high_water, changed, storage, reuse=True)
+    _remove_legacy_files()
+    return rebuilt
 
 
 if __name__ == "__main__":
@@ -3,34 +3,224 @@ from __future__ import annotations
 from app.bootstrap import bootstrap
 bootstrap()
 
-from sentence_transformers import SentenceTransformer
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple
+
 import numpy as np
 
+from app import metrics
+from app.config import EMBED_BACKEND, EMBED_MAX_BATCH_TOKENS, EMBED_MODEL_NAME, EMBED_NUM_THREADS
+
+if TYPE_CHECKING:
+    # sentence_transformers 会连带导入 torch（数秒），只在真正加载模型时导入
+    from sentence_transformers import SentenceTransformer
+
+# 支持的推理后端
+SUPPORTED_BACKENDS = ("torch", "torch-int8", "onnx")
+
+_EMBED_TEXTS = metrics.counter("extracthelper_embed_texts_total", "Texts embedded")
+_EMBED_SECONDS = metrics.counter("extracthelper_embed_seconds_total", "Time spent in Embedder.encode")
+
+
+def _resolve_threads(num_threads: int) -> int:
+    """解析线程数配置，0 或负数表示使用全部逻辑核"""
+    if num_threads and num_threads > 0:
+        return int(num_threads)
+    return max(1, os.cpu_count() or 1)
+
 
 class Embedder:
     """
     向量嵌入服务
     封装 SentenceTransformer，提供统一的 encode 接口。
+    支持 PyTorch float32 / PyTorch 动态 int8 量化 / ONNX Runtime 三种后端。
     """
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, backend: str = EMBED_BACKEND, num_threads: int = EMBED_NUM_THREADS):
         """
         初始化加载模型
         :param model_name: Hugging Face 模型名称或本地路径
+        :param backend: 推理后端，见 SUPPORTED_BACKENDS
+        :param num_threads: CPU 推理线程数，0 表示自动
+        """
+        backend = (backend or "torch").lower()
+        if backend not in SUPPORTED_BACKENDS:
+            raise ValueError(f"Unsupported embed backend: {backend}")
+
+        self.model_name = model_name
+        self.backend = backend
+        self.num_threads = _resolve_threads(num_threads)
+
+        if backend == "onnx":
+            self.model = self._load_onnx(model_name)
+        else:
+            self.model = self._load_torch(model_name, quantize=(backend == "torch-int8"))
+
+    def _load_torch(self, model_name: str, quantize: bool) -> SentenceTransformer:
+        """加载 PyTorch 模型，可选动态 int8 量化"""
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(self.num_threads)
+        if not quantize:
+            return SentenceTransformer(model_name)
+
+        # 动态量化只支持 CPU：权重预先量化为 int8，激活在运行时量化
+        model = SentenceTransformer(model_name, device="cpu")
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+
+    def _load_onnx(self, model_name: str) -> SentenceTransformer:
+        """通过 ONNX Runtime 加载同一模型（首次会自动导出 ONNX 权重）"""
+        import onnxruntime as ort
+        from sentence_transformers import SentenceTransformer
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = self.num_threads
+        opts.inter_op_num_threads = 1
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return SentenceTransformer(
+            model_name,
+            device="cpu",
+            backend="onnx",
+            model_kwargs={"provider": "CPUExecutionProvider", "session_options": opts},
+        )
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        """
+        计算每条文本分词后的长度（含特殊 token，按模型 max_seq_length 截断）。
+        :param texts: 文本列表
+        """
+        max_len = int(self.model.max_seq_length or 512)
+        enc = self.model.tokenizer(
+            list(texts),
+            add_special_tokens=True,
+            truncation=True,
+            max_length=max_len,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return [len(ids) for ids in enc["input_ids"]]
+
+    def plan_batches(
+        self,
+        lengths: list[int],
+        batch_size: int = 256,
+        max_tokens: int = EMBED_MAX_BATCH_TOKENS,
+    ) -> list[list[int]]:
         """
-        self.model = SentenceTransformer(model_name)
+        按 token 长度降序排序后切分批次。
+        每个批次的 padding 后 token 数（批内最长 * 条数）不超过 max_tokens，
+        且条数不超过 batch_size。
 
-    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        :param lengths: 每条文本的 token 长度
+        :param batch_size: 单批最大条数
+        :param max_tokens: 单批 token 预算
+        :return: 批次列表，每个批次为原始下标列表
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        batches: list[list[int]] = []
+        cur: list[int] = []
+        cur_max = 0
+        for i in order:
+            n = max(1, lengths[i])
+            new_max = max(cur_max, n)
+            if cur and (new_max * (len(cur) + 1) > max_tokens or len(cur) >= batch_size):
+                batches.append(cur)
+                cur, new_max = [], n
+            cur.append(i)
+            cur_max = new_max
+        if cur:
+            batches.append(cur)
+        return batches
+
+    def encode(
+        self,
+        texts: list[str],
+        batch_size: int = 256,
+        max_tokens: int = EMBED_MAX_BATCH_TOKENS,
+        show_progress_bar: Optional[bool] = None,
+        on_batch: Optional[Callable[[int], None]] = None,
+    ) -> np.ndarray:
         """
         批量计算文本向量。
-        
+        输入按 token 长度分桶，在 token 预算内组批以减少 padding，输出恢复原始顺序。
+
         :param texts: 文本列表
-        :param batch_size: 批处理大小
+        :param batch_size: 单批最大条数
+        :param max_tokens: 单批 token 预算
+        :param show_progress_bar: 是否显示进度条，默认仅在多个批次时显示
+        :param on_batch: 每个批次完成后以该批条数回调（用于进度上报 / 取消检查）
         :return: Numpy 数组 (n_samples, embedding_dim)，float32 类型
         """
-        vecs = self.model.encode(
-            texts,
-            batch_size=batch_size,
-            show_progress_bar=True,
-            normalize_embeddings=True, # 启用归一化，使得点积等同于余弦相似度
-        )
-        return np.asarray(vecs, dtype="float32")
+        texts = list(texts)
+        dim = int(self.model.get_sentence_embedding_dimension())
+        if not texts:
+            return np.zeros((0, dim), dtype="float32")
+
+        if len(texts) == 1:
+            batches = [[0]]
+        else:
+            batches = self.plan_batches(self.token_lengths(texts), batch_size, max_tokens)
+
+        if show_progress_bar is None:
+            show_progress_bar = len(batches) > 1
+
+        t0 = time.perf_counter()
+        out = np.empty((len(texts), dim), dtype="float32")
+        it = batches
+        if show_progress_bar:
+            from tqdm import tqdm
+            it = tqdm(batches, desc="Batches", unit="batch")
+
+        for idxs in it:
+            vecs = self.model.encode(
+                [texts[i] for i in idxs],
+                batch_size=len(idxs),
+                show_progress_bar=False,
+                normalize_embeddings=True, # 启用归一化，使得点积等同于余弦相似度
+            )
+            out[idxs] = np.asarray(vecs, dtype="float32")
+            if on_batch is not None:
+                on_batch(len(idxs))
+        _EMBED_TEXTS.inc(len(texts))
+        _EMBED_SECONDS.inc(time.perf_counter() - t0)
+        return out
+
+
+def padding_ratio(lengths: list[int], batches: list[list[int]]) -> float:
+    """
+    计算给定批次划分下的 padding 浪费比例：1 - 真实 token 数 / padding 后 token 数。
+    :param lengths: 每条文本的 token 长度
+    :param batches: 批次划分（原始下标列表）
+    """
+    real = 0
+    padded = 0
+    for idxs in batches:
+        if not idxs:
+            continue
+        lens = [lengths[i] for i in idxs]
+        real += sum(lens)
+        padded += max(lens) * len(lens)
+    return 1.0 - real / padded if padded else 0.0
+
+
+# 进程内 Embedder 缓存，避免每次检索/入库都重新加载模型
+_EMBEDDERS: Dict[Tuple[str, str], Embedder] = {}
+_EMBEDDERS_LOCK = threading.Lock()
+
+
+def get_embedder(model_name: str = EMBED_MODEL_NAME, backend: str = EMBED_BACKEND) -> Embedder:
+    """
+    获取（并缓存）指定模型与后端的 Embedder 实例。
+    :param model_name: 模型名称
+    :param backend: 推理后端
+    """
+    key = (model_name, (backend or "torch").lower())
+    with _EMBEDDERS_LOCK:
+        emb = _EMBEDDERS.get(key)
+        if emb is None:
+            emb = Embedder(model_name, backend=key[1])
+            _EMBEDDERS[key] = emb
+        return emb
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import json
+import time
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 import numpy as np
@@ -8,17 +10,39 @@ import faiss
 from app.config import (
     DB_PATH,
     EMBED_MODEL_NAME,
-    FAISS_INDEX_PATH,
-    FAISS_DELTA_INDEX_PATH,
+    RETRIEVAL_DUP_THRESHOLD,
+    RETRIEVAL_MMR,
+    RETRIEVAL_MMR_LAMBDA,
 )
-from app.retrieval.embedder import Embedder
-from app.ingest.db import connect, ensure_schema
+from app.retrieval.embedder import get_embedder
+from app.retrieval.shards import (
+    current_generation,
+    delta_path,
+    index_write_lock,
+    load_delta_index,
+    load_sharded_index,
+    merge_topk,
+    write_index_atomic,
+)
+from app import metrics
+from app.ingest.db import get_pool
+from app.ingest.dedup import jaccard, shingles
+from app.tracing import record, span
 
 """
 检索模块
 负责从 FAISS 索引（Base + Delta）中检索最相似的 Chunks。
 """
 
+_RETRIEVAL_SECONDS = metrics.histogram("extracthelper_retrieval_seconds", "Latency of one retrieval call (a whole batch for batched calls)")
+_RETRIEVAL_QUERIES = metrics.counter("extracthelper_retrieval_queries_total", "Queries retrieved")
+_DUPS_SUPPRESSED = metrics.counter("extracthelper_retrieval_duplicates_suppressed_total", "Near-duplicate candidates dropped by the diversity step")
+
+# MMR 候选池大小（top_k 的倍数）
+MMR_POOL_FACTOR = 3
+# 每条证据最多列出的其他出处数
+MAX_ALSO_IN = 10
+
 def _load_index_maybe(path: Path):
     """尝试加载 FAISS 索引，不存在则返回 None"""
     if path.exists():
@@ -31,9 +55,13 @@ def _ensure_delta_index(dim: int):
     return faiss.IndexIDMap2(base)
 
 def load_base_and_delta() -> Tuple[Any, Any]:
-    """加载 Base 和 Delta 两个索引"""
-    base = _load_index_maybe(FAISS_INDEX_PATH)
-    delta = _load_index_maybe(FAISS_DELTA_INDEX_PATH)
+    """
+    加载当前索引代的 Base（分片集合）和 Delta 两个索引。
+    每次调用都会重新读取 CURRENT，后台压缩切换索引代后下一次查询即生效。
+    """
+    gen = current_generation()
+    base = load_sharded_index(gen)
+    delta = load_delta_index(gen)
     return base, delta
 
 def fetch_chunk(conn, chunk_id: int):
@@ -51,79 +79,188 @@ def fetch_chunk(conn, chunk_id: int):
     """
     return conn.execute(sql, (chunk_id,)).fetchone()
 
+def fetch_chunks(conn, chunk_ids) -> Dict[int, Tuple]:
+    """
+    批量回查 Chunk 详情（一次 SQL），过滤已删除的 Chunk 或 Document。
+    ID 列表以 JSON 数组作为单个参数传入，不受 SQLite 参数个数上限限制。
+
+    :param chunk_ids: chunk id 序列
+    :return: {chunk_id: (path, doc_type, page, chunk_id, content)}
+    """
+    ids = [int(x) for x in chunk_ids]
+    if not ids:
+        return {}
+    sql = """
+    SELECT d.path, d.doc_type, c.page, c.id, c.content
+    FROM chunks c
+    JOIN documents d ON d.id = c.doc_id
+    WHERE c.id IN (SELECT value FROM json_each(?))
+      AND c.is_deleted = 0
+      AND d.is_deleted = 0
+    """
+    return {int(row[3]): row for row in conn.execute(sql, (json.dumps(ids),))}
+
+def fetch_duplicates(conn, chunk_ids) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    批量查询共享这些规范 chunk 向量的重复 chunk 的出处（入库去重，见 app.ingest.dedup）。
+    :return: {规范 chunk_id: [{"path", "filename", "page"}, ...]}
+    """
+    ids = [int(x) for x in chunk_ids]
+    if not ids:
+        return {}
+    sql = """
+    SELECT c.canonical_id, d.path, c.page
+    FROM chunks c
+    JOIN documents d ON d.id = c.doc_id
+    WHERE c.canonical_id IN (SELECT value FROM json_each(?))
+      AND c.is_deleted = 0
+      AND d.is_deleted = 0
+    ORDER BY c.id
+    """
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    for cid, path, page in conn.execute(sql, (json.dumps(ids),)):
+        dups = out.setdefault(int(cid), [])
+        if len(dups) < MAX_ALSO_IN:
+            dups.append({"path": str(path), "filename": Path(str(path)).name, "page": page})
+    return out
+
+def diversify_evidence(candidates: List[Dict[str, Any]], top_k: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    MMR 选取证据：每步选 λ·相关度 - (1-λ)·与已选证据的最大文本相似度 最大的候选，
+    与已选证据相似度不低于 RETRIEVAL_DUP_THRESHOLD 的候选视为重复直接丢弃（不回填）。
+    文本相似度为字符 3-gram Jaccard，只在前 top_k * MMR_POOL_FACTOR 个候选中计算。
+
+    :param candidates: 按分数降序的候选证据
+    :return: (选出的证据, 丢弃的重复候选数)
+    """
+    pool = candidates[: max(top_k * MMR_POOL_FACTOR, top_k)]
+    if len(pool) <= 1:
+        return pool[:top_k], 0
+    feats = [shingles(e["content"]) for e in pool]
+    max_sim = [0.0] * len(pool)
+    remaining = list(range(len(pool)))
+    selected: List[Dict[str, Any]] = []
+    dropped = 0
+    while remaining and len(selected) < top_k:
+        best = max(remaining, key=lambda i: RETRIEVAL_MMR_LAMBDA * pool[i]["score"] - (1 - RETRIEVAL_MMR_LAMBDA) * max_sim[i])
+        remaining.remove(best)
+        selected.append(pool[best])
+        keep = []
+        for i in remaining:
+            sim = jaccard(feats[i], feats[best])
+            if sim >= RETRIEVAL_DUP_THRESHOLD:
+                dropped += 1
+                continue
+            max_sim[i] = max(max_sim[i], sim)
+            keep.append(i)
+        remaining = keep
+    return selected, dropped
+
+def _evidence_from_row(score: float, row) -> Dict[str, Any]:
+    path, doc_type, page, chunk_id, content = row
+    return {
+        "score": float(score),
+        "path": str(path),
+        "filename": Path(str(path)).name,
+        "doc_type": doc_type,
+        "page": page,
+        "chunk_id": int(chunk_id),
+        "content": content,
+        "snippet": (content or "").replace("\n", " ")[:240],
+    }
+
 def retrieve_evidence(query: str, top_k: int = 5, overfetch: int = 5) -> List[Dict[str, Any]]:
     """
-    执行向量检索。
+    执行向量检索（单条查询，等价于只含一条查询的 retrieve_evidence_batch）。
     
-    1. 加载 Base 和 Delta 索引。
+    1. 加载 Base（分片并行检索）和 Delta 索引。
     2. 计算 Query 向量。
     3. 在两个索引中分别检索 Top K * overfetch 个结果。
     4. 合并结果，按分数排序并去重。
     5. 从 DB 回查内容，过滤已删除项。
-    6. 返回最终 Top K 结果。
+    6. 按 MMR 抑制近似重复的证据（RETRIEVAL_MMR），返回最终 Top K 结果。
     
     :param query: 查询语句
     :param top_k: 目标结果数量
     :param overfetch: 预取倍数（应对删除项过滤）
     :return: 证据列表
     """
-    base, delta = load_base_and_delta()
+    return retrieve_evidence_batch([query], top_k=top_k, overfetch=overfetch)[0]
+
+def retrieve_evidence_batch(queries: List[str], top_k: int = 5, overfetch: int = 5) -> List[List[Dict[str, Any]]]:
+    """
+    批量向量检索：
+    1. 所有查询一次编码为 (n, dim) 查询矩阵；
+    2. Base / Delta 各检索一次，用 NumPy 按行归并为全局排序；
+    3. 所有候选 chunk 一次 SQL 回查，再按行过滤已删除项并截取 Top K。
+    比逐条调用少 n-1 次模型前向、索引调用与数据库往返。
+
+    :param queries: 查询语句列表
+    :param top_k: 每个查询的目标结果数量
+    :param overfetch: 预取倍数（应对删除项过滤）
+    :return: 与 queries 一一对应的证据列表
+    """
+    if not queries:
+        return []
+
+    t0 = time.perf_counter()
+    with span("load_index"):
+        base, delta = load_base_and_delta()
     if base is None and delta is None:
         raise RuntimeError("找不到任何索引文件：请先 build_index 或先 ingest 生成 delta")
 
-    embedder = Embedder(EMBED_MODEL_NAME)
-    qvec = embedder.encode([query], batch_size=1)
+    with span("embed_load"):
+        embedder = get_embedder(EMBED_MODEL_NAME)
+    with span("embed"):
+        qvecs = np.ascontiguousarray(embedder.encode(list(queries), show_progress_bar=False), dtype="float32")
 
     k = max(top_k * overfetch, top_k)
-    pairs: List[Tuple[float, int]] = []
-
-    # 分别搜索 Base 和 Delta
-    for idx in (base, delta):
-        if idx is None:
-            continue
-        scores, ids = idx.search(qvec, k)
-        for s, cid in zip(scores[0], ids[0]):
-            cid = int(cid)
-            if cid == -1:
-                continue
-            pairs.append((float(s), cid))
-
-    # 全局排序
-    pairs.sort(key=lambda x: x[0], reverse=True)
-
-    # 去重 (同一 Chunk ID 取最高分，理论上不会有重复ID，除非索引错乱，这里做保险)
-    best: Dict[int, float] = {}
-    for s, cid in pairs:
-        if cid not in best:
-            best[cid] = s
-
-    conn = connect(DB_PATH)
-    ensure_schema(conn)
-
-    evidence: List[Dict[str, Any]] = []
-    # 逐个回查 DB，直到凑够 top_k
-    for cid, score in sorted(best.items(), key=lambda x: x[1], reverse=True):
-        row = fetch_chunk(conn, cid)
-        if not row:
-            continue # 已删除或不存在
-        path, doc_type, page, chunk_id, content = row
-        evidence.append(
-            {
-                "score": float(score),
-                "path": str(path),
-                "filename": Path(str(path)).name,
-                "doc_type": doc_type,
-                "page": page,
-                "chunk_id": int(chunk_id),
-                "content": content,
-                "snippet": (content or "").replace("\n", " ")[:240],
-            }
-        )
-        if len(evidence) >= top_k:
-            break
-
-    conn.close()
-    return evidence
+    with span("search"):
+        results = [idx.search(qvecs, k) for idx in (base, delta) if idx is not None]
+        # 按行归并 Base / Delta 结果（按分数降序，空位 id=-1）
+        scores, ids = merge_topk(results, len(results) * k)
+
+    with span("hydrate"):
+        conn = get_pool(DB_PATH).reader()
+        rows = fetch_chunks(conn, np.unique(ids[ids != -1]).tolist())
+
+    # MMR 需要比 top_k 更多的候选
+    n_cand = top_k * MMR_POOL_FACTOR if RETRIEVAL_MMR else top_k
+    out: List[List[Dict[str, Any]]] = []
+    suppressed = 0
+    with span("diversify"):
+        for row_scores, row_ids in zip(scores.tolist(), ids.tolist()):
+            evidence: List[Dict[str, Any]] = []
+            # 同一 Chunk ID 取最高分（理论上不会重复，除非索引错乱，这里做保险）
+            seen = set()
+            for score, cid in zip(row_scores, row_ids):
+                if cid == -1 or cid in seen:
+                    continue
+                seen.add(cid)
+                row = rows.get(cid)
+                if row is None:
+                    continue # 已删除或不存在
+                evidence.append(_evidence_from_row(score, row))
+                if len(evidence) >= n_cand:
+                    break
+            if RETRIEVAL_MMR:
+                evidence, dropped = diversify_evidence(evidence, top_k)
+                suppressed += dropped
+            out.append(evidence[:top_k])
+
+        # 去重后共享同一向量的其他出处
+        dups = fetch_duplicates(conn, [e["chunk_id"] for evidence in out for e in evidence])
+        for evidence in out:
+            for e in evidence:
+                if e["chunk_id"] in dups:
+                    e["also_in"] = dups[e["chunk_id"]]
+    if suppressed:
+        _DUPS_SUPPRESSED.inc(suppressed)
+        record("duplicates_suppressed", suppressed)
+
+    _RETRIEVAL_SECONDS.observe(time.perf_counter() - t0)
+    _RETRIEVAL_QUERIES.inc(len(queries))
+    return out
 
 def add_to_delta_index(chunk_ids: List[int], texts: List[str]) -> None:
     """
@@ -135,16 +272,17 @@ def add_to_delta_index(chunk_ids: List[int], texts: List[str]) -> None:
     if not chunk_ids:
         return
 
-    embedder = Embedder(EMBED_MODEL_NAME)
-    vecs = embedder.encode(texts, batch_size=32)
+    embedder = get_embedder(EMBED_MODEL_NAME)
+    vecs = embedder.encode(texts)
     dim = int(vecs.shape[1])
 
-    delta = _load_index_maybe(FAISS_DELTA_INDEX_PATH)
-    if delta is None:
-        delta = _ensure_delta_index(dim)
-
-    ids = np.asarray(chunk_ids, dtype="int64")
-    delta.add_with_ids(vecs, ids)
+    # 与索引代切换互斥：保证写入的 Delta 要么在切换前被重放，要么写入新一代
+    with index_write_lock:
+        path = delta_path(current_generation())
+        delta = _load_index_maybe(path)
+        if delta is None:
+            delta = _ensure_delta_index(dim)
 
-    FAISS_DELTA_INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(delta, str(FAISS_DELTA_INDEX_PATH))
+        ids = np.asarray(chunk_ids, dtype="int64")
+        delta.add_with_ids(vecs, ids)
+        write_index_atomic(delta, path)
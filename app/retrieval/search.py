@@ -1,17 +1,38 @@
 from __future__ import annotations
 import sys
-from app.retrieval.retrieve import retrieve_evidence
+from app import daemon, profiling
+from app.tracing import Trace, tracing
 
 """
 命令行检索工具
-用法: python -m app.retrieval.search "查询语句"
+用法: python -m app.retrieval.search [--profile] "查询语句"
+常驻服务（python -m app.daemon serve）运行时转发给它执行，否则在进程内加载模型检索。
+--profile：在进程内执行并把剖析报告写入 data/kb/profiles/（见 app.profiling）。
 """
 
-def search(query: str, top_k: int = 5) -> None:
+def _search_profiled(query: str, top_k: int) -> list[dict]:
+    """进程内检索并剖析（含加载模型与索引），分阶段耗时一并写入报告"""
+    with profiling.Profiler("search") as prof:
+        from app.retrieval.retrieve import retrieve_evidence
+        trace = Trace()
+        with prof.stage("search"), tracing(trace):
+            evidence = retrieve_evidence(query, top_k=top_k)
+        prof.add_timings("search", trace.to_dict())
+    return evidence
+
+def search(query: str, top_k: int = 5, profile: bool = False) -> None:
     """
     执行检索并打印结果到控制台。
+    :param profile: 是否在进程内剖析本次检索
     """
-    evidence = retrieve_evidence(query, top_k=top_k)
+    resp = None if profile else daemon.try_call("search", {"query": query, "top_k": top_k})
+    if resp is not None:
+        evidence = resp["result"]
+    elif profile:
+        evidence = _search_profiled(query, top_k)
+    else:
+        from app.retrieval.retrieve import retrieve_evidence
+        evidence = retrieve_evidence(query, top_k=top_k)
 
     print(f"\nQuery: {query}\n")
     for rank, e in enumerate(evidence, start=1):
@@ -22,8 +43,11 @@ def search(query: str, top_k: int = 5) -> None:
         print(f"    text  : {snippet}\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print('用法: python -m app.retrieval.search "query"')
+    argv = sys.argv[1:]
+    profile = "--profile" in argv
+    argv = [a for a in argv if a != "--profile"]
+    if not argv:
+        print('用法: python -m app.retrieval.search [--profile] "query"')
         sys.exit(1)
-    q = " ".join(sys.argv[1:])
-    search(q, top_k=5)
+    q = " ".join(argv)
+    search(q, top_k=5, profile=profile)
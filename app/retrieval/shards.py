@@ -0,0 +1,528 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from app import metrics
+from app.config import (
+    FAISS_INDEX_PATH,
+    FAISS_DELTA_INDEX_PATH,
+    INDEX_DIR,
+    INDEX_CURRENT_PATH,
+    INDEX_KEEP_GENERATIONS,
+    INDEX_EXACT_RERANK,
+    INDEX_SEARCH_THREADS,
+    INDEX_SHARD_BY,
+    RAW_DIR,
+)
+
+"""
+分片索引模块
+Base Index 按 RAW_DIR 下的一级目录拆分为多个分片，每个分片可独立重建。
+检索时由线程池并行搜索各分片，再归并出全局 Top K。
+
+索引以"代"(generation) 为单位发布：每一代是一个 gen-XXXXXX 目录，包含分片清单与 Delta Index，
+CURRENT 文件指向当前代。分片目录一经写入即不再修改；重建总是先写好新一代，
+再原子替换 CURRENT，检索器在下一次查询时自动切换，查询过程中不会看到半成品。
+
+Delta 追加与代切换由 index_write_lock 互斥，它同时持有进程内的锁与 index/.write.lock 上的
+咨询式文件锁（fcntl.flock / Windows 上为 msvcrt.locking），常驻服务、Web 界面与命令行
+同时写同一个索引目录时也不会丢失 Delta 写入。
+"""
+
+MANIFEST_VERSION = 1
+GEN_PREFIX = "gen-"
+# 跨进程写锁文件
+WRITE_LOCK_NAME = ".write.lock"
+
+
+class IndexWriteLock:
+    """
+    索引写锁（可重入）：进程内 RLock + 跨进程文件锁。
+    文件锁只在最外层获取 / 释放，同一线程嵌套进入不会重复加锁。
+    """
+    def __init__(self, root: Path = INDEX_DIR) -> None:
+        self.root = Path(root)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self) -> "IndexWriteLock":
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._acquire_file()
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                self._release_file()
+        finally:
+            self._lock.release()
+
+    def _acquire_file(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        f = open(self.root / WRITE_LOCK_NAME, "a+b")
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        # LK_LOCK 约 10 秒未取得锁时抛出 OSError，继续等待
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+
+    def _release_file(self) -> None:
+        f, self._file = self._file, None
+        if f is None:
+            return
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
+# 索引写锁：Delta 追加与代切换互斥（进程内与跨进程）
+index_write_lock = IndexWriteLock()
+# 不在 RAW_DIR 下的文档（如 add 指定的外部文件）统一归入该分片
+EXTERNAL_SHARD = "_external"
+# RAW_DIR 根目录下的文档
+ROOT_SHARD = "_root"
+
+
+def shard_key_for_path(path: str, raw_dir: Path = RAW_DIR) -> str:
+    """
+    根据文档路径计算所属分片。
+    :param path: 文档路径（documents.path）
+    :param raw_dir: 原始文档根目录
+    """
+    if INDEX_SHARD_BY == "none":
+        return ROOT_SHARD
+    try:
+        rel = Path(path).resolve().relative_to(Path(raw_dir).resolve())
+    except ValueError:
+        return EXTERNAL_SHARD
+    return rel.parts[0] if len(rel.parts) > 1 else ROOT_SHARD
+
+
+def _shard_dirname(key: str) -> str:
+    """分片目录名：目录名可能含任意字符，统一取哈希"""
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+def empty_manifest() -> Dict[str, Any]:
+    return {"version": MANIFEST_VERSION, "dim": 0, "shards": {}}
+
+
+def current_generation(root: Path = INDEX_DIR) -> Optional[str]:
+    """读取 CURRENT 指向的索引代名称，尚未生成任何代时返回 None"""
+    current = root / INDEX_CURRENT_PATH.name
+    if not current.exists():
+        return None
+    name = current.read_text(encoding="utf-8").strip()
+    return name if name and (root / name).is_dir() else None
+
+
+def delta_path(gen: Optional[str], root: Path = INDEX_DIR) -> Path:
+    """指定索引代的 Delta Index 路径；gen 为 None 时使用旧版单文件路径"""
+    if gen is None:
+        return FAISS_DELTA_INDEX_PATH
+    return root / gen / "delta.index"
+
+
+def read_manifest(gen: Optional[str] = None, root: Path = INDEX_DIR) -> Dict[str, Any]:
+    """
+    读取指定索引代（默认当前代）的分片清单，不存在或损坏时返回空清单。
+    """
+    gen = gen or current_generation(root)
+    if gen is None:
+        return empty_manifest()
+    path = root / gen / "manifest.json"
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return empty_manifest()
+
+
+def write_index_atomic(index, path: Path) -> None:
+    """先写临时文件再 os.replace，读者不会读到写了一半的索引"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    faiss.write_index(index, str(tmp))
+    os.replace(tmp, path)
+
+
+def _generation_number(name: str) -> int:
+    try:
+        return int(name[len(GEN_PREFIX):])
+    except ValueError:
+        return -1
+
+
+def list_generations(root: Path = INDEX_DIR) -> List[str]:
+    """按代数升序列出所有索引代目录"""
+    if not root.exists():
+        return []
+    names = [p.name for p in root.iterdir() if p.is_dir() and p.name.startswith(GEN_PREFIX)]
+    return sorted((n for n in names if _generation_number(n) >= 0), key=_generation_number)
+
+
+def publish_generation(manifest: Dict[str, Any], delta, root: Path = INDEX_DIR) -> str:
+    """
+    写出新一代（清单 + Delta Index）并原子切换 CURRENT。
+    调用方需持有 index_write_lock（含跨进程文件锁），并在锁内重新读取 CURRENT、
+    重放当前代的 Delta，保证其他线程或进程在切换前后写入的 Delta 不会丢失。
+
+    :return: 新一代名称
+    """
+    with index_write_lock:
+        return _publish_generation(manifest, delta, root)
+
+
+def _publish_generation(manifest: Dict[str, Any], delta, root: Path) -> str:
+    gens = list_generations(root)
+    number = (_generation_number(gens[-1]) + 1) if gens else 1
+    name = f"{GEN_PREFIX}{number:06d}"
+    d = root / name
+    d.mkdir(parents=True, exist_ok=False)
+    (d / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    faiss.write_index(delta, str(d / "delta.index"))
+
+    current = root / INDEX_CURRENT_PATH.name
+    tmp = current.with_name(current.name + ".tmp")
+    tmp.write_text(name, encoding="utf-8")
+    os.replace(tmp, current)
+    return name
+
+
+def write_shard(
+    key: str,
+    index,
+    vecs: np.ndarray,
+    ids: np.ndarray,
+    storage: str,
+    generation: int,
+    root: Path = INDEX_DIR,
+) -> Dict[str, Any]:
+    """
+    将一个分片写入新的代数目录：faiss.index + 全精度向量 vectors.npy + ids.npy。
+
+    :param key: 分片名
+    :param index: 已 add 完成的 FAISS 索引
+    :param vecs: 全精度向量（与 ids 一一对应，ids 升序）
+    :param ids: chunk id
+    :param storage: 存储方式
+    :param generation: 分片代数
+    :return: 清单中的分片条目
+    """
+    rel = Path("shards") / _shard_dirname(key) / f"g{generation:06d}"
+    d = root / rel
+    d.mkdir(parents=True, exist_ok=True)
+    faiss.write_index(index, str(d / "faiss.index"))
+    np.save(d / "vectors.npy", vecs)
+    np.save(d / "ids.npy", ids)
+    return {
+        "dir": rel.as_posix(),
+        "generation": generation,
+        "ntotal": int(index.ntotal),
+        "storage": storage,
+        "built_at": time.time(),
+    }
+
+
+def cleanup_generations(keep: int = INDEX_KEEP_GENERATIONS, root: Path = INDEX_DIR) -> None:
+    """
+    删除较旧的索引代，以及不再被保留代引用的分片目录。
+    保留最近 keep 代，给仍在使用旧代的检索器留出切换时间。
+    """
+    gens = list_generations(root)
+    current = current_generation(root)
+    kept = gens[-max(1, keep):]
+    if current and current not in kept:
+        kept.append(current)
+    for name in gens:
+        if name not in kept:
+            shutil.rmtree(root / name, ignore_errors=True)
+
+    shards_root = root / "shards"
+    if not shards_root.exists():
+        return
+    live = set()
+    for name in kept:
+        for e in read_manifest(name, root).get("shards", {}).values():
+            live.add((root / e["dir"]).resolve())
+    for shard_dir in shards_root.iterdir():
+        for gen_dir in shard_dir.iterdir():
+            if gen_dir.resolve() not in live:
+                # Windows 下仍被 mmap 的文件删除会失败，留待下次清理
+                shutil.rmtree(gen_dir, ignore_errors=True)
+        if not any(shard_dir.iterdir()):
+            shard_dir.rmdir()
+
+
+def load_shard_vectors(entry: Dict[str, Any], root: Path = INDEX_DIR) -> Tuple[np.ndarray, np.ndarray]:
+    """以 mmap 方式读取分片的 (ids, vecs)，无需加载 FAISS 索引"""
+    d = root / entry["dir"]
+    return np.load(d / "ids.npy", mmap_mode="r"), np.load(d / "vectors.npy", mmap_mode="r")
+
+
+def rescore_exact(qvec: np.ndarray, ids: np.ndarray, scores: np.ndarray, all_ids, all_vecs) -> np.ndarray:
+    """
+    使用全精度向量对量化索引返回的候选重新计算内积。
+
+    :param qvec: 查询向量 (n, dim)
+    :param ids: 候选 chunk id (n, k)，-1 表示空位
+    :param scores: 量化索引给出的近似分数 (n, k)
+    :param all_ids: 分片内全部 chunk id（升序）
+    :param all_vecs: 与 all_ids 对应的全精度向量
+    :return: 重打分后的分数 (n, k)
+    """
+    if all_ids is None or len(all_ids) == 0:
+        return scores
+
+    out = np.array(scores, dtype="float32", copy=True)
+    # all_ids 按升序保存，searchsorted 直接定位行号
+    pos = np.searchsorted(all_ids, ids)
+    pos = np.clip(pos, 0, len(all_ids) - 1)
+    found = (ids != -1) & (np.asarray(all_ids)[pos] == ids)
+    for row in range(ids.shape[0]):
+        cols = np.nonzero(found[row])[0]
+        if len(cols) == 0:
+            continue
+        cand = np.asarray(all_vecs[pos[row, cols]], dtype="float32")
+        out[row, cols] = cand @ qvec[row]
+    return out
+
+
+def merge_topk(results: List[Tuple[np.ndarray, np.ndarray]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    将多个 (scores, ids) 结果按分数归并为全局 Top K。
+    空位以 score=-inf、id=-1 表示，与 FAISS 返回格式一致。
+    """
+    scores = np.concatenate([r[0] for r in results], axis=1)
+    ids = np.concatenate([r[1] for r in results], axis=1)
+    scores = np.where(ids == -1, -np.inf, scores)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    top_scores = np.take_along_axis(scores, order, axis=1)
+    top_ids = np.take_along_axis(ids, order, axis=1)
+    if top_ids.shape[1] < k:
+        pad = k - top_ids.shape[1]
+        top_scores = np.pad(top_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        top_ids = np.pad(top_ids, ((0, 0), (0, pad)), constant_values=-1)
+    return top_scores, top_ids
+
+
+class Shard:
+    """
+    单个分片：FAISS 索引 + mmap 的全精度向量（用于量化索引的精排）。
+    """
+    def __init__(self, key: str, entry: Dict[str, Any], root: Path = INDEX_DIR):
+        self.key = key
+        self.entry = entry
+        self.dir = root / entry["dir"]
+        self.storage = entry.get("storage", "flat")
+        self.index = faiss.read_index(str(self.dir / "faiss.index"))
+        self.ids, self.vecs = load_shard_vectors(entry, root)
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.index.ntotal)
+
+    def search(self, qvec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores, ids = self.index.search(qvec, k)
+        if self.storage != "flat" and INDEX_EXACT_RERANK:
+            scores = rescore_exact(qvec, ids, scores, self.ids, self.vecs)
+        return scores, ids
+
+
+class ShardedIndex:
+    """
+    分片集合，对外提供与 FAISS 索引一致的 search(qvec, k) 接口。
+    """
+    def __init__(self, shards: List[Any]):
+        self.shards = shards
+
+    @property
+    def ntotal(self) -> int:
+        return sum(int(s.ntotal) for s in self.shards)
+
+    def search(self, qvec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """并行搜索所有分片并归并结果"""
+        if len(self.shards) == 1:
+            return self.shards[0].search(qvec, k)
+        results = list(_search_pool().map(lambda s: s.search(qvec, k), self.shards))
+        return merge_topk(results, k)
+
+
+class _LegacyShard:
+    """旧版单文件 Base Index，作为只读分片兜底"""
+    def __init__(self, path: Path):
+        self.key = ROOT_SHARD
+        self.index = faiss.read_index(str(path))
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.index.ntotal)
+
+    def search(self, qvec: np.ndarray, k: int):
+        return self.index.search(qvec, k)
+
+
+_POOL: Optional[ThreadPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+# 已加载的分片缓存：分片目录不可变，按目录缓存即可
+_SHARD_CACHE: Dict[str, Shard] = {}
+_SHARD_CACHE_LOCK = threading.Lock()
+_SHARD_CACHE_HITS = metrics.counter("extracthelper_shard_cache_hits_total", "Shard loads served from the in-process cache")
+_SHARD_CACHE_MISSES = metrics.counter("extracthelper_shard_cache_misses_total", "Shard loads that read the index from disk")
+
+
+def _search_pool() -> ThreadPoolExecutor:
+    """FAISS 搜索会释放 GIL，线程池即可并行"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=max(1, INDEX_SEARCH_THREADS), thread_name_prefix="shard-search")
+        return _POOL
+
+
+def load_sharded_index(gen: Optional[str] = None, root: Path = INDEX_DIR) -> Optional[ShardedIndex]:
+    """
+    按索引代（默认当前代）的清单加载所有分片（复用已加载的分片），
+    尚未生成任何代时尝试旧版单文件索引。
+    :return: ShardedIndex，无任何索引时返回 None
+    """
+    gen = gen or current_generation(root)
+    if gen is None:
+        if FAISS_INDEX_PATH.exists():
+            return ShardedIndex([_LegacyShard(FAISS_INDEX_PATH)])
+        return None
+
+    entries = read_manifest(gen, root).get("shards", {})
+    if not entries:
+        return None
+
+    shards: List[Shard] = []
+    with _SHARD_CACHE_LOCK:
+        live = set()
+        for key, entry in entries.items():
+            cache_key = str(root / entry["dir"])
+            live.add(cache_key)
+            shard = _SHARD_CACHE.get(cache_key)
+            if shard is None:
+                _SHARD_CACHE_MISSES.inc()
+                shard = Shard(key, entry, root=root)
+                _SHARD_CACHE[cache_key] = shard
+            else:
+                _SHARD_CACHE_HITS.inc()
+            shards.append(shard)
+        # 淘汰已被替换的旧代数分片（正在使用它们的查询持有引用，不受影响）
+        for cache_key in list(_SHARD_CACHE):
+            if cache_key not in live:
+                del _SHARD_CACHE[cache_key]
+    return ShardedIndex(shards)
+
+
+# Delta Index 缓存：(路径, mtime_ns, size) 不变时复用已加载的索引
+_DELTA_CACHE: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+_DELTA_CACHE_LOCK = threading.Lock()
+_DELTA_CACHE_HITS = metrics.counter("extracthelper_delta_cache_hits_total", "Delta index loads served from the in-process cache")
+_DELTA_CACHE_MISSES = metrics.counter("extracthelper_delta_cache_misses_total", "Delta index loads that read the file from disk")
+
+
+def load_delta_index(gen: Optional[str] = None, root: Path = INDEX_DIR):
+    """
+    加载指定索引代（默认当前代）的 Delta Index，文件未变化时复用缓存。
+    Delta 总是原子替换写入，这里读到的一定是完整文件。
+    :return: FAISS 索引，不存在时返回 None
+    """
+    if gen is None:
+        gen = current_generation(root)
+    path = delta_path(gen, root)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _DELTA_CACHE_LOCK:
+        cached = _DELTA_CACHE.get(str(path))
+        if cached is not None and cached[0] == stamp:
+            _DELTA_CACHE_HITS.inc()
+            return cached[1]
+    _DELTA_CACHE_MISSES.inc()
+    index = faiss.read_index(str(path))
+    with _DELTA_CACHE_LOCK:
+        # 只保留当前路径，旧代的 Delta 随之释放
+        _DELTA_CACHE.clear()
+        _DELTA_CACHE[str(path)] = (stamp, index)
+    return index
+
+
+def index_memory_stats() -> dict:
+    """
+    统计当前代 Base（所有分片）/Delta 索引占用（索引常驻内存约等于文件大小）。
+    float32_bytes 为同等数量原始 float32 向量的大小，用于计算压缩比。
+    """
+    gen = current_generation()
+    manifest = read_manifest(gen)
+    dim = int(manifest.get("dim", 0))
+    entries = manifest.get("shards", {})
+    ntotal = sum(int(e.get("ntotal", 0)) for e in entries.values())
+    base_bytes = 0
+    rerank_bytes = 0
+    storages = set()
+    for e in entries.values():
+        d = INDEX_DIR / e["dir"]
+        storages.add(e.get("storage", "flat"))
+        if (d / "faiss.index").exists():
+            base_bytes += (d / "faiss.index").stat().st_size
+        if (d / "vectors.npy").exists():
+            rerank_bytes += (d / "vectors.npy").stat().st_size
+    dpath = delta_path(gen)
+    delta_bytes = dpath.stat().st_size if dpath.exists() else 0
+    float32_bytes = ntotal * dim * 4
+    return {
+        "generation": gen,
+        "storage": "/".join(sorted(storages)) or "flat",
+        "shards": len(entries),
+        "vectors": ntotal,
+        "dim": dim,
+        "base_bytes": base_bytes,
+        "delta_bytes": delta_bytes,
+        "rerank_bytes": rerank_bytes,  # mmap 读取，不常驻内存
+        "float32_bytes": float32_bytes,
+        "compression": (float32_bytes / base_bytes) if base_bytes else 0.0,
+    }
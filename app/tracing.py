@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+"""
+轻量级耗时追踪
+记录一次问答中各阶段的耗时（毫秒）与计数（token 数、tokens/s 等）。
+
+- 追踪对象绑定在当前线程上（与 app.jobs 的当前任务相同的方式），检索 / 生成代码
+  通过模块级的 span() / record() 上报，不需要层层传参；
+- 当前线程没有进行中的追踪时，span() 返回共享的空上下文、record() 直接返回，
+  关闭追踪（TRACE_ENABLED = False）时开销只有一次线程局部变量读取。
+"""
+
+
+class Trace:
+    """
+    一次调用的追踪结果
+    spans: 阶段名 -> 累计耗时（毫秒），按首次出现顺序排列；同名阶段多次出现时累加
+    values: 计数类指标，如 prompt_tokens / completion_tokens / tokens_per_s
+    """
+    def __init__(self) -> None:
+        self.spans: Dict[str, float] = {}
+        self.values: Dict[str, Any] = {}
+        self.started_at = time.perf_counter()
+        self.total_ms: Optional[float] = None
+
+    def add_span(self, name: str, ms: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + ms
+
+    def finish(self) -> None:
+        self.total_ms = (time.perf_counter() - self.started_at) * 1e3
+
+    def to_dict(self) -> Dict[str, Any]:
+        """可 JSON 序列化的结果（耗时保留 0.1 ms）"""
+        total = self.total_ms if self.total_ms is not None else (time.perf_counter() - self.started_at) * 1e3
+        return {
+            "total_ms": round(total, 1),
+            "spans": {k: round(v, 1) for k, v in self.spans.items()},
+            "values": dict(self.values),
+        }
+
+
+# 当前线程正在记录的追踪
+_current = threading.local()
+
+
+class _NullSpan:
+    """未追踪时使用的空上下文（共享单例，避免每次创建对象）"""
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("trace", "name", "t0")
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc) -> bool:
+        self.trace.add_span(self.name, (time.perf_counter() - self.t0) * 1e3)
+        return False
+
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_current, "trace", None)
+
+
+def span(name: str):
+    """
+    记录代码块耗时：with span("search"): ...
+    当前线程没有进行中的追踪时为空操作。
+    """
+    trace = getattr(_current, "trace", None)
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, name)
+
+
+def record(name: str, value: Any) -> None:
+    """记录计数类指标；当前线程没有进行中的追踪时为空操作"""
+    trace = getattr(_current, "trace", None)
+    if trace is not None:
+        trace.values[name] = value
+
+
+@contextmanager
+def tracing(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """
+    在当前线程中激活追踪，结束时记录总耗时并恢复之前的追踪。
+    :param trace: 追踪对象；为 None 时不追踪（span / record 保持空操作）
+    """
+    if trace is None:
+        yield None
+        return
+    previous = getattr(_current, "trace", None)
+    _current.trace = trace
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        _current.trace = previous
+
+
+def format_timings(timings: Dict[str, Any]) -> str:
+    """将 Trace.to_dict() 的结果格式化为一行文本（CLI 输出用）"""
+    parts = [f"total={timings.get('total_ms', 0):.0f}ms"]
+    parts += [f"{k}={v:.0f}ms" for k, v in (timings.get("spans") or {}).items()]
+    parts += [f"{k}={v}" for k, v in (timings.get("values") or {}).items()]
+    return " ".join(parts)
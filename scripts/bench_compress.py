@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+# 允许直接以脚本方式运行: python scripts/bench_compress.py
+project_root = Path(__file__).resolve().parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from app.rag.ask import answer_once, create_llm
+from app.tracing import Trace, tracing
+
+"""
+证据压缩基准测试
+对同一组问题分别在关闭 / 开启证据压缩（CONTEXT_COMPRESS）时生成回答，
+比较上下文字符数（按 build_context_for_llm 截断后的实际 prompt 计）、prompt token 数、
+prompt 处理耗时、压缩本身的耗时与端到端耗时。
+两种模式共用同一个已加载的模型。
+用法: python scripts/bench_compress.py --questions questions.txt --top-k 5
+"""
+
+DEFAULT_QUESTIONS = [
+    "动态规划的核心思想是什么？",
+    "请总结资料中关于状态转移方程的说明。",
+    "资料中提到了哪些边界条件？",
+]
+
+
+def _run_mode(llm, compress: bool, questions: list[str], top_k: int) -> dict:
+    # 预热一次（向量模型加载、mmap 缺页），不计入
+    answer_once(llm, questions[0], top_k=top_k, compress=compress)
+
+    total_ms = prompt_ms = compress_ms = 0.0
+    prompt_tokens = chars = 0
+    for q in questions:
+        trace = Trace()
+        with tracing(trace):
+            answer_once(llm, q, top_k=top_k, compress=compress)
+        t = trace.to_dict()
+        total_ms += t["total_ms"]
+        prompt_ms += t["spans"].get("prompt_eval", 0.0)
+        compress_ms += t["spans"].get("compress", 0.0)
+        prompt_tokens += t["values"].get("prompt_tokens", 0)
+        chars += t["values"].get("context_chars", 0)
+    n = len(questions)
+    return {
+        "mode": "compress" if compress else "full",
+        "prompt_tokens": prompt_tokens / n,
+        "prompt_ms": prompt_ms / n,
+        "compress_ms": compress_ms / n,
+        "avg_ms": total_ms / n,
+        "context_chars": chars / n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python scripts/bench_compress.py")
+    parser.add_argument("--questions", type=str, default=None, help="问题文件，每行一条")
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        lines = Path(args.questions).read_text(encoding="utf-8").splitlines()
+        questions = [q.strip() for q in lines if q.strip()]
+
+    llm = create_llm()
+    base, comp = (_run_mode(llm, c, questions, args.top_k) for c in (False, True))
+    print(f"[bench] questions={len(questions)} top_k={args.top_k}")
+    for r in (base, comp):
+        print(
+            f"[bench] {r['mode']:<8} context {r['context_chars']:7.0f} chars  prompt {r['prompt_tokens']:7.0f} tok  "
+            f"prompt_eval {r['prompt_ms']:8.0f} ms  compress {r['compress_ms']:6.1f} ms  avg {r['avg_ms']:8.0f} ms/answer"
+        )
+    if base["prompt_tokens"] and base["avg_ms"]:
+        print(
+            f"[bench] reduction: context {1 - comp['context_chars'] / max(base['context_chars'], 1e-9):.1%}  "
+            f"prompt tokens {1 - comp['prompt_tokens'] / base['prompt_tokens']:.1%}  "
+            f"prompt_eval {1 - comp['prompt_ms'] / max(base['prompt_ms'], 1e-9):.1%}  "
+            f"end-to-end {1 - comp['avg_ms'] / base['avg_ms']:.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# 允许直接以脚本方式运行: python scripts/bench_embedder.py
+project_root = Path(__file__).resolve().parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+import numpy as np
+
+from app.config import DB_PATH, EMBED_MAX_BATCH_TOKENS, EMBED_MODEL_NAME
+from app.ingest.db import get_pool
+from app.retrieval.embedder import SUPPORTED_BACKENDS, Embedder, padding_ratio
+
+"""
+Embedding 后端基准测试
+对比各推理后端的吞吐（chunks/s），并以 torch float32 为基准检查向量一致性（余弦相似度），
+同时报告 SentenceTransformer 默认批次（按字符长度排序、固定条数）与 token 分桶批次的 padding 浪费比例。
+用法: python scripts/bench_embedder.py --backends torch onnx torch-int8 --limit 512
+"""
+
+
+def _load_texts(limit: int) -> list[str]:
+    """优先读取知识库中的真实 chunks，库为空时退化为合成文本"""
+    texts: list[str] = []
+    if DB_PATH.exists():
+        rows = get_pool(DB_PATH).reader().execute(
+            "SELECT content FROM chunks WHERE is_deleted=0 ORDER BY id ASC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        texts = [r[0] for r in rows if r[0]]
+    if not texts:
+        base = "动态规划的核心是定义状态与状态转移方程，并确定边界条件。"
+        texts = [base * (1 + i % 30) for i in range(limit)]
+    return texts
+
+
+def _st_batches(texts: list[str], batch_size: int) -> list[list[int]]:
+    """
+    SentenceTransformer.encode 自身的批次划分：整次调用的输入按字符长度降序排序（稳定排序），
+    再按固定条数切分
+    """
+    order = np.argsort([-len(t) for t in texts], kind="stable").tolist()
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def _report_padding(emb: Embedder, texts: list[str], fixed_batch: int, max_tokens: int) -> None:
+    """对比 SentenceTransformer 默认批次（按字符长度排序、固定条数）与 token 分桶批次的 padding 比例"""
+    lengths = emb.token_lengths(texts)
+    fixed = _st_batches(texts, fixed_batch)
+    bucketed = emb.plan_batches(lengths, max_tokens=max_tokens)
+    print(
+        f"[bench] padding before={padding_ratio(lengths, fixed):.1%} ({len(fixed)} batches of {fixed_batch}) "
+        f"after={padding_ratio(lengths, bucketed):.1%} ({len(bucketed)} batches, budget={max_tokens} tokens)"
+    )
+
+
+def _bench(emb: Embedder, texts: list[str], max_tokens: int, repeat: int) -> tuple[np.ndarray, float]:
+    """预热一次后重复编码，返回向量与最佳 chunks/s"""
+    emb.encode(texts[:32], max_tokens=max_tokens, show_progress_bar=False)
+    best = float("inf")
+    vecs = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        vecs = emb.encode(texts, max_tokens=max_tokens, show_progress_bar=False)
+        best = min(best, time.perf_counter() - t0)
+    return vecs, len(texts) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python scripts/bench_embedder.py")
+    parser.add_argument("--backends", nargs="+", default=list(SUPPORTED_BACKENDS), choices=SUPPORTED_BACKENDS)
+    parser.add_argument("--limit", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32, help="padding 对比中 SentenceTransformer 默认批次的条数")
+    parser.add_argument("--max-tokens", type=int, default=EMBED_MAX_BATCH_TOKENS)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="与 torch 向量的最小余弦相似度")
+    args = parser.parse_args()
+
+    texts = _load_texts(args.limit)
+    print(f"[bench] model={EMBED_MODEL_NAME} texts={len(texts)} threads={args.threads or 'auto'}")
+
+    # 一致性检查以 torch float32 作为参考
+    backends = list(dict.fromkeys(["torch"] + args.backends))
+    ref = None
+    ref_rate = None
+    failed = False
+
+    for backend in backends:
+        emb = Embedder(EMBED_MODEL_NAME, backend=backend, num_threads=args.threads)
+        if ref is None:
+            _report_padding(emb, texts, args.batch_size, args.max_tokens)
+        vecs, rate = _bench(emb, texts, args.max_tokens, args.repeat)
+        line = f"[bench] {backend:<10} {rate:9.1f} chunks/s"
+        if ref is None:
+            ref, ref_rate = vecs, rate
+        else:
+            # 向量已归一化，逐行点积即余弦相似度
+            cos = np.sum(ref * vecs, axis=1)
+            line += f"  speedup={rate / ref_rate:.2f}x  cos(min/mean)={cos.min():.4f}/{cos.mean():.4f}"
+            if cos.min() < args.min_cosine:
+                line += "  PARITY FAIL"
+                failed = True
+        print(line)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import sys
+from pathlib import Path
+
+# 允许直接以脚本方式运行: python scripts/bench_speculative.py
+project_root = Path(__file__).resolve().parent.parent
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from app.config import LLM_DRAFT_GGUF_PATH
+from app.rag.ask import answer_once, create_llm
+from app.tracing import Trace, tracing
+
+"""
+投机解码基准测试
+对同一组问题分别以不同的投机解码方式（none / prompt_lookup / draft）生成回答，
+比较生成阶段 tokens/s、端到端耗时与草稿接受率。
+用法: python scripts/bench_speculative.py --questions questions.txt --modes none prompt_lookup
+"""
+
+DEFAULT_QUESTIONS = [
+    "动态规划的核心思想是什么？",
+    "请总结资料中关于状态转移方程的说明。",
+    "资料中提到了哪些边界条件？",
+]
+
+
+def _run_mode(mode: str, questions: list[str], top_k: int) -> dict:
+    llm = create_llm(speculative=mode)
+    # 预热一次（prompt 缓存、mmap 缺页），不计入
+    answer_once(llm, questions[0], top_k=top_k)
+
+    total_ms = gen_ms = 0.0
+    tokens = proposed = 0
+    accepted = 0.0
+    for q in questions:
+        trace = Trace()
+        with tracing(trace):
+            answer_once(llm, q, top_k=top_k)
+        t = trace.to_dict()
+        total_ms += t["total_ms"]
+        gen_ms += t["spans"].get("generate", 0.0)
+        n = t["values"].get("completion_tokens", 0)
+        tokens += n
+        p = t["values"].get("draft_proposed", 0)
+        proposed += p
+        accepted += p * t["values"].get("draft_acceptance", 0.0)
+    del llm
+    gc.collect()
+    return {
+        "mode": mode,
+        "tokens": tokens,
+        "gen_tps": tokens / (gen_ms / 1e3) if gen_ms else 0.0,
+        "avg_ms": total_ms / len(questions),
+        "acceptance": accepted / proposed if proposed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python scripts/bench_speculative.py")
+    parser.add_argument("--questions", type=str, default=None, help="问题文件，每行一条")
+    parser.add_argument("--modes", nargs="+", default=["none", "prompt_lookup"], choices=["none", "prompt_lookup", "draft"])
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        lines = Path(args.questions).read_text(encoding="utf-8").splitlines()
+        questions = [q.strip() for q in lines if q.strip()]
+    if "draft" in args.modes and not LLM_DRAFT_GGUF_PATH.exists():
+        print(f"[bench] draft model not found: {LLM_DRAFT_GGUF_PATH}")
+        sys.exit(1)
+
+    rows = [_run_mode(mode, questions, args.top_k) for mode in args.modes]
+    base = rows[0]["gen_tps"] or None
+    print(f"[bench] questions={len(questions)} top_k={args.top_k}")
+    for r in rows:
+        acc = f"{r['acceptance']:.1%}" if r["acceptance"] is not None else "-"
+        speedup = f"{r['gen_tps'] / base:.2f}x" if base else "-"
+        print(
+            f"[bench] {r['mode']:<14} gen {r['gen_tps']:7.2f} tok/s ({speedup})  "
+            f"avg {r['avg_ms']:8.0f} ms/answer  tokens={r['tokens']}  acceptance={acc}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# 允许直接以脚本方式运行: python scripts/bench_startup.py
+project_root = Path(__file__).resolve().parent.parent
+
+"""
+启动耗时基准测试
+对每个入口模块在独立子进程中执行 `python -X importtime -c "import <module>"`，
+统计导入总耗时、按根包汇总的导入耗时，并检查重量级依赖（torch / sentence_transformers /
+faiss / llama_cpp / fitz）是否在导入阶段被加载。
+用法: python scripts/bench_startup.py [--repeat 3] [--output startup.json] [--baseline startup.json]
+"""
+
+# 入口模块（CLI 与 Web）
+ENTRY_MODULES = (
+    "app.ingest.ingest",
+    "app.retrieval.search",
+    "app.rag.ask",
+    "app.app_core",
+    "app.gui.web_app",
+)
+
+# 入口导入阶段不应加载的重量级依赖
+HEAVY_PACKAGES = ("torch", "sentence_transformers", "llama_cpp", "fitz", "faiss")
+
+
+def _parse_importtime(stderr: str) -> tuple[dict[str, int], dict[str, int]]:
+    """
+    解析 -X importtime 输出
+    :return: ({顶层导入的模块名: 累计耗时(us)}, {根包名: 自身耗时之和(us)})
+    """
+    cumulative: dict[str, int] = {}
+    packages: dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            own = int(parts[0].strip())
+            cum = int(parts[1].strip())
+        except ValueError:
+            continue  # 表头
+        name = parts[2].rstrip()
+        root = name.strip().split(".")[0]
+        packages[root] = packages.get(root, 0) + own
+        # 缩进表示嵌套层级，耗时只累计顶层导入，避免重复计算
+        if name.startswith("  "):
+            continue
+        cumulative[name.strip()] = cumulative.get(name.strip(), 0) + cum
+    return cumulative, packages
+
+
+def _measure(module: str) -> dict:
+    """在干净的子进程中导入模块一次"""
+    code = f"import {module}"
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=str(project_root),
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - t0
+    modules, packages = _parse_importtime(proc.stderr)
+    return {
+        "ok": proc.returncode == 0,
+        "error": proc.stderr.strip().splitlines()[-1] if proc.returncode != 0 and proc.stderr.strip() else "",
+        "wall_s": wall,
+        "import_s": sum(modules.values()) / 1e6,
+        "packages": packages,
+        "heavy": sorted(p for p in HEAVY_PACKAGES if p in packages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python scripts/bench_startup.py")
+    parser.add_argument("--modules", nargs="+", default=list(ENTRY_MODULES))
+    parser.add_argument("--repeat", type=int, default=3, help="每个模块测量次数（取最小值）")
+    parser.add_argument("--top", type=int, default=5, help="显示导入耗时最多的前 N 个包")
+    parser.add_argument("--output", type=str, default=None, help="将结果写入 JSON 文件")
+    parser.add_argument("--baseline", type=str, default=None, help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+
+    results = {}
+    failed = False
+    for module in args.modules:
+        runs = [_measure(module) for _ in range(max(1, args.repeat))]
+        best = min(runs, key=lambda r: r["wall_s"])
+        results[module] = {k: best[k] for k in ("ok", "error", "wall_s", "import_s", "heavy")}
+
+        if not best["ok"]:
+            print(f"[startup] {module:<22} FAILED: {best['error']}")
+            failed = True
+            continue
+
+        line = f"[startup] {module:<22} wall={best['wall_s']:.3f}s import={best['import_s']:.3f}s"
+        prev = baseline.get(module)
+        if prev and prev.get("ok"):
+            line += f" (baseline {prev['wall_s']:.3f}s, {best['wall_s'] / prev['wall_s']:.2f}x)"
+        if best["heavy"]:
+            line += f"  heavy={','.join(best['heavy'])}"
+        print(line)
+
+        top = sorted(best["packages"].items(), key=lambda kv: kv[1], reverse=True)[: args.top]
+        for name, us in top:
+            print(f"            {us / 1e3:9.1f} ms  {name}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"[startup] results written to {args.output}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()